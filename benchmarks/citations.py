@@ -0,0 +1,115 @@
+"""
+Micro-benchmark of the citation rewriting in AssistantMessage.
+
+Compares the single pass rewrite (offset based) against the previous
+str.replace per annotation implementation on large synthetic answers.
+No network or redis is used; file names are served from FileNameCache.
+
+    uv run python -m benchmarks.citations --paragraphs 2000 --citations 300
+"""
+
+import time
+import random
+import argparse
+from types import SimpleNamespace
+
+from src.file_search.openai_assistant import AssistantMessage, FileNameCache
+
+
+def legacy_call(parser: AssistantMessage, message):
+    """The replace based implementation, kept here as the reference"""
+    citations = {}
+
+    for m in message:
+        for c in m.content:
+            body = c.text.value
+
+            for a in c.text.annotations:
+                try:
+                    document = parser[a]
+                except LookupError:
+                    continue
+                refn = citations.setdefault(document, len(citations) + 1)
+                body = body.replace(a.text, f" [{refn}]")
+
+            if citations:
+                iterable = (f"[{y}] {x}" for (x, y) in citations.items())
+                citestr = "\n\n{}".format("\n".join(iterable))
+                citations.clear()
+            else:
+                citestr = ""
+
+            yield f"{body}{citestr}"
+
+
+def synthetic_message(paragraphs: int, citations: int, files: int):
+    """One message whose text has `citations` unique markers over `files` files"""
+    rng = random.Random(42)
+    words = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur", "adipiscing"]
+    chunks = [
+        " ".join(rng.choice(words) for _ in range(60)) + "." for _ in range(paragraphs)
+    ]
+
+    annotations = []
+    slots = sorted(rng.sample(range(paragraphs), min(citations, paragraphs)))
+    body = ""
+    for i, chunk in enumerate(chunks):
+        body += chunk
+        if slots and i == slots[0]:
+            slots.pop(0)
+            marker = f"【{len(annotations)}:{i}†source】"
+            annotations.append(
+                SimpleNamespace(
+                    text=marker,
+                    start_index=len(body),
+                    end_index=len(body) + len(marker),
+                    file_citation=SimpleNamespace(file_id=f"file-{i % files}"),
+                )
+            )
+            body += marker
+        body += "\n"
+
+    text = SimpleNamespace(value=body, annotations=annotations)
+    return [SimpleNamespace(content=[SimpleNamespace(text=text)])]
+
+
+def timeit(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--paragraphs", type=int, default=2000)
+    parser.add_argument("--citations", type=int, default=300)
+    parser.add_argument("--files", type=int, default=5)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    FileNameCache.seed({f"file-{i}": f"doc_{i}.pdf" for i in range(args.files)})
+
+    message = synthetic_message(args.paragraphs, args.citations, args.files)
+    assistant_message = AssistantMessage(client=None)
+
+    legacy = "\n".join(legacy_call(assistant_message, message))
+    single_pass = assistant_message.to_string(message)
+    assert legacy == single_pass, "implementations disagree"
+
+    size = len(message[0].content[0].text.value)
+    legacy_secs = timeit(
+        lambda: list(legacy_call(assistant_message, message)), args.repeat
+    )
+    single_pass_secs = timeit(lambda: list(assistant_message(message)), args.repeat)
+
+    print(f"answer: {size} chars, {args.citations} citations over {args.files} files")
+    print(f"str.replace per annotation: {legacy_secs * 1000:.2f} ms")
+    print(f"single pass:                {single_pass_secs * 1000:.2f} ms")
+    print(f"speedup:                    {legacy_secs / single_pass_secs:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+"""
+Local stand-in for the AI platform, for benchmarking.
+Implements the endpoints used by src/services/ai_platform_src.py with
+configurable latencies and counts every request it serves.
+
+    uv run uvicorn benchmarks.fake_platform:app --port 7101
+
+Latencies (seconds) are read from the env:
+    FAKE_PLATFORM_UPLOAD_LATENCY_SECS      time taken to accept a document
+    FAKE_PLATFORM_COLLECTION_LATENCY_SECS  time till a collection job is ready
+    FAKE_PLATFORM_THREAD_LATENCY_SECS      time till a thread has its answer
+"""
+
+import os
+import time
+import uuid
+import asyncio
+from collections import Counter
+
+from fastapi import FastAPI, Request
+
+UPLOAD_LATENCY = float(os.getenv("FAKE_PLATFORM_UPLOAD_LATENCY_SECS", 0.2))
+COLLECTION_LATENCY = float(os.getenv("FAKE_PLATFORM_COLLECTION_LATENCY_SECS", 5))
+THREAD_LATENCY = float(os.getenv("FAKE_PLATFORM_THREAD_LATENCY_SECS", 3))
+
+app = FastAPI()
+
+request_counts: Counter = Counter()
+jobs: dict[str, float] = {}  # job id -> ready at
+threads: dict[str, float] = {}  # thread id -> ready at
+
+
+@app.middleware("http")
+async def count_requests(request: Request, call_next):
+    response = await call_next(request)
+    route = request.scope.get("route")
+    if route and not route.path.startswith("/_"):
+        request_counts[f"{request.method} {route.path}"] += 1
+    return response
+
+
+@app.post("/documents/")
+async def upload_document(request: Request):
+    async for _ in request.stream():
+        pass
+    await asyncio.sleep(UPLOAD_LATENCY)
+    return {"success": True, "data": {"id": str(uuid.uuid4())}}
+
+
+@app.delete("/documents/{document_id}")
+async def delete_document(document_id: str):
+    return {"success": True, "data": {"id": document_id}}
+
+
+@app.post("/collections/")
+async def create_collection():
+    job_id = str(uuid.uuid4())
+    jobs[job_id] = time.monotonic() + COLLECTION_LATENCY
+    return {"success": True, "data": {"job_id": job_id}}
+
+
+@app.get("/collections/jobs/{job_id}")
+async def collection_job(job_id: str):
+    ready_at = jobs.get(job_id)
+    if ready_at is None:
+        return {
+            "success": False,
+            "error": "job not found",
+            "data": {"status": "FAILED"},
+        }
+    if time.monotonic() < ready_at:
+        return {"success": True, "data": {"status": "PROCESSING"}}
+    return {
+        "success": True,
+        "data": {
+            "status": "SUCCESSFUL",
+            "collection": {"llm_service_id": f"asst_{job_id}"},
+        },
+    }
+
+
+@app.post("/threads/start")
+async def start_thread(payload: dict):
+    thread_id = payload.get("thread_id") or str(uuid.uuid4())
+    threads[thread_id] = time.monotonic() + THREAD_LATENCY
+    return {"success": True, "data": {"thread_id": thread_id}}
+
+
+@app.get("/threads/result/{thread_id}")
+async def thread_result(thread_id: str):
+    ready_at = threads.get(thread_id)
+    if ready_at is not None and time.monotonic() < ready_at:
+        return {"success": True, "data": {"status": "processing"}}
+    return {
+        "success": True,
+        "data": {"status": "success", "response": f"answer from {thread_id}"},
+    }
+
+
+@app.get("/_stats")
+async def stats():
+    return {"requests": dict(request_counts), "total": sum(request_counts.values())}
+
+
+@app.post("/_reset")
+async def reset():
+    request_counts.clear()
+    jobs.clear()
+    threads.clear()
+    return {"success": True}
@@ -0,0 +1,166 @@
+"""
+Cold start of the api (`main:app`) and the celery worker (`main.celery` with its
+task modules loaded), each measured in fresh interpreters.
+
+    uv run python -m benchmarks.import_time --repeat 5
+
+Reports the median import time of every target, the slowest imports under it
+(from `python -X importtime`) and checks that modules which must stay off the
+startup path (`--forbid`, default pandas, numpy & openai) were not imported.
+Save a run with `--save-baseline import_baseline.json` and compare later runs
+with `--baseline import_baseline.json`; the run fails (exit code 1) if a target
+got slower by more than `--tolerance`, went over its `--budget`, or imported a
+forbidden module.
+"""
+
+import os
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+from statistics import median
+
+ROOT = Path(__file__).resolve().parent.parent
+
+TARGETS = {
+    "api": "import main",
+    "worker": "import main; main.celery.loader.import_default_modules()",
+}
+
+PROBE = """
+import sys, json, time
+start = time.perf_counter()
+{code}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"secs": elapsed, "modules": sorted(sys.modules)}}))
+"""
+
+
+def _env() -> dict:
+    env = dict(os.environ)
+    # modules that refuse to import without their config
+    env.setdefault("AI_PLATFORM_BASE_URI", "http://localhost:7101")
+    env["PYTHONPATH"] = str(ROOT)
+    return env
+
+
+def measure(code: str) -> tuple[float, list[str]]:
+    """Seconds taken by the imports in `code` & the modules loaded after it"""
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE.format(code=code)],
+        cwd=ROOT,
+        env=_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    result = json.loads(out.stdout.strip().splitlines()[-1])
+    return result["secs"], result["modules"]
+
+
+def slowest_imports(code: str, top: int) -> list[tuple[str, float]]:
+    """Packages with the highest cumulative import time, via -X importtime"""
+    out = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=ROOT,
+        env=_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    packages = {}
+    for line in out.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line.split("|")
+        name = name.strip().split(".")[0]
+        packages[name] = max(packages.get(name, 0), int(cumulative) / 1e6)
+    return sorted(packages.items(), key=lambda item: -item[1])[:top]
+
+
+def run(args) -> dict:
+    report = {}
+    for name, code in TARGETS.items():
+        samples, modules = [], []
+        for _ in range(args.repeat):
+            secs, modules = measure(code)
+            samples.append(secs)
+        report[name] = {
+            "secs": median(samples),
+            "forbidden": [m for m in args.forbid if m in modules],
+            "slowest": slowest_imports(code, args.top),
+        }
+    return report
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Regressions of the report against the baseline beyond the tolerance"""
+    regressions = []
+    for name, result in report.items():
+        before = baseline.get(name, {}).get("secs")
+        if before and result["secs"] > before * (1 + tolerance):
+            regressions.append(
+                f"{name}: {result['secs']:.3f}s > baseline {before:.3f}s"
+            )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs per target")
+    parser.add_argument("--top", type=int, default=8, help="slowest imports shown")
+    parser.add_argument(
+        "--forbid",
+        nargs="*",
+        default=["pandas", "numpy", "openai"],
+        help="modules that must not be imported at startup",
+    )
+    parser.add_argument(
+        "--budget",
+        action="append",
+        default=[],
+        metavar="TARGET=SECS",
+        help="max import time of a target, e.g. api=1.5",
+    )
+    parser.add_argument("--baseline", help="compare against this saved run")
+    parser.add_argument("--save-baseline", help="save this run as the baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    report = run(args)
+    for name, result in report.items():
+        print(f"{name}: {result['secs'] * 1000:.0f} ms")
+        for package, secs in result["slowest"]:
+            print(f"    {package:<24} {secs * 1000:8.0f} ms")
+        if result["forbidden"]:
+            print(f"    imports {', '.join(result['forbidden'])} at startup")
+
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(report, indent=2))
+        print(f"Saved the baseline to {args.save_baseline}")
+
+    failures = [
+        f"{name}: imports {', '.join(result['forbidden'])}"
+        for name, result in report.items()
+        if result["forbidden"]
+    ]
+    for budget in args.budget:
+        name, secs = budget.split("=")
+        if report[name]["secs"] > float(secs):
+            failures.append(
+                f"{name}: {report[name]['secs']:.3f}s over the {float(secs):.3f}s budget"
+            )
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        failures += compare(report, baseline, args.tolerance)
+
+    if failures:
+        print("Regressions:\n  " + "\n  ".join(failures))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,406 @@
+"""
+End to end load test of the v1 file query flow on a single box.
+
+Starts a local AI platform stand-in (benchmarks/fake_platform.py), a webhook
+receiver (benchmarks/webhook_receiver.py), the real FastAPI app and a celery
+worker, then drives `--sessions` upload + query flows with `--concurrency` of
+them in flight. Only a Redis server is needed.
+
+    uv run python -m benchmarks.loadtest --sessions 50 --concurrency 10 --queries 3
+
+Reports throughput, p50/p95/p99 latency (query submitted -> results delivered
+to the webhook), outbound platform requests and worker cpu utilisation.
+Save a run with `--save-baseline benchmarks/baseline.json` and compare later
+runs with `--baseline benchmarks/baseline.json`; the run fails (exit code 1)
+if it regressed by more than `--tolerance`.
+"""
+
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+from statistics import quantiles
+
+import httpx
+
+ROOT = Path(__file__).resolve().parent.parent
+API_KEY = "benchmark"
+
+
+def _percentiles(values: list[float]) -> dict:
+    if len(values) < 2:
+        value = values[0] if values else 0.0
+        return {"p50": value, "p95": value, "p99": value}
+    cuts = quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+def _cpu_seconds(pid: int) -> float:
+    """cpu time (user + sys) of the process and all its live descendants"""
+    ticks = os.sysconf("SC_CLK_TCK")
+    total = 0.0
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        total += (int(fields[11]) + int(fields[12])) / ticks
+        for task in Path(f"/proc/{pid}/task").iterdir():
+            children = (task / "children").read_text().split()
+            total += sum(_cpu_seconds(int(child)) for child in children)
+    except (FileNotFoundError, ProcessLookupError):
+        pass
+    return total
+
+
+class Services:
+    """The processes under test; started in order & torn down on exit"""
+
+    def __init__(self, args, log_dir: Path):
+        self.args = args
+        self.log_dir = log_dir
+        self.procs: dict[str, subprocess.Popen] = {}
+        self.platform_uri = f"http://127.0.0.1:{args.platform_port}"
+        self.webhook_uri = f"http://127.0.0.1:{args.webhook_port}"
+        self.api_uri = f"http://127.0.0.1:{args.api_port}"
+
+    def env(self) -> dict:
+        redis = httpx.URL(self.args.redis_url)
+        return {
+            **os.environ,
+            "API_KEY": API_KEY,
+            "REDIS_HOST": redis.host,
+            "REDIS_PORT": str(redis.port or 6379),
+            "CELERY_BROKER_URL": self.args.redis_url,
+            "CELERY_RESULT_BACKEND": self.args.redis_url,
+            "AI_PLATFORM_API_KEY": API_KEY,
+            "AI_PLATFORM_BASE_URI": self.platform_uri,
+            "FAKE_PLATFORM_UPLOAD_LATENCY_SECS": str(self.args.upload_latency),
+            "FAKE_PLATFORM_COLLECTION_LATENCY_SECS": str(self.args.collection_latency),
+            "FAKE_PLATFORM_THREAD_LATENCY_SECS": str(self.args.thread_latency),
+        }
+
+    def start(self, name: str, cmd: list[str]):
+        log = open(self.log_dir / f"{name}.log", "w")
+        self.procs[name] = subprocess.Popen(
+            cmd, cwd=ROOT, env=self.env(), stdout=log, stderr=subprocess.STDOUT
+        )
+
+    def uvicorn(self, name: str, app: str, port: int):
+        self.start(
+            name,
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                app,
+                "--port",
+                str(port),
+                "--log-level",
+                "warning",
+            ],
+        )
+
+    def up(self):
+        self.uvicorn(
+            "platform", "benchmarks.fake_platform:app", self.args.platform_port
+        )
+        self.uvicorn(
+            "webhook", "benchmarks.webhook_receiver:app", self.args.webhook_port
+        )
+        self.uvicorn("api", "main:app", self.args.api_port)
+        worker = [sys.executable, "-m", "celery", "-A", "main.celery", "worker"]
+        worker += [
+            "-n",
+            "llm-benchmark@%h",
+            "-Q",
+            "llm,llm_bulk,control,webhooks",
+            "--loglevel=WARNING",
+        ]
+        worker += ["-P", self.args.pool, "-c", str(self.args.worker_concurrency)]
+        self.start("worker", worker)
+
+    def down(self):
+        for proc in self.procs.values():
+            proc.terminate()
+        for proc in self.procs.values():
+            try:
+                proc.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+
+    @property
+    def worker_pid(self) -> int:
+        return self.procs["worker"].pid
+
+
+async def _wait_until_up(client: httpx.AsyncClient, url: str, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            await client.get(url)
+            return
+        except httpx.TransportError:
+            await asyncio.sleep(0.2)
+    raise RuntimeError(f"{url} did not come up in {timeout}s")
+
+
+async def _wait_for_worker(client: httpx.AsyncClient, services: Services):
+    """A query on an empty session; returns once the worker picked up a task"""
+    res = await client.post(
+        f"{services.api_uri}/api/v1/file/upload",
+        files={"file": ("warmup.txt", b"warmup")},
+        headers={"Authorization": API_KEY},
+    )
+    res.raise_for_status()
+    res = await client.post(
+        f"{services.api_uri}/api/v1/file/query",
+        json={
+            "queries": ["warmup"],
+            "assistant_prompt": "warmup",
+            "session_id": res.json()["session_id"],
+        },
+        headers={"Authorization": API_KEY},
+    )
+    task_id = res.json()["task_id"]
+    while True:
+        status = await client.get(
+            f"{services.api_uri}/api/task/{task_id}", headers={"Authorization": API_KEY}
+        )
+        if status.json()["status"] in ("SUCCESS", "FAILURE"):
+            return
+        await asyncio.sleep(0.5)
+
+
+async def _run_session(client, services, args, index: int, deliveries: dict) -> dict:
+    headers = {"Authorization": API_KEY}
+    session_id = None
+    upload_start = time.time()
+    for doc in range(args.documents):
+        data = {"session_id": session_id} if session_id else {}
+        res = await client.post(
+            f"{services.api_uri}/api/v1/file/upload",
+            files={"file": (f"doc_{index}_{doc}.pdf", os.urandom(args.document_size))},
+            data=data,
+            headers=headers,
+        )
+        res.raise_for_status()
+        session_id = res.json()["session_id"]
+    upload_time = time.time() - upload_start
+
+    submitted_at = time.time()
+    res = await client.post(
+        f"{services.api_uri}/api/v1/file/query",
+        json={
+            "queries": [f"question {q}" for q in range(args.queries)],
+            "assistant_prompt": args.prompt,
+            "session_id": session_id,
+            "webhook_config": {
+                "endpoint": f"{services.webhook_uri}/webhook",
+                "headers": {},
+                "batch": args.webhook_batch,
+            },
+        },
+        headers=headers,
+    )
+    res.raise_for_status()
+
+    deadline = time.monotonic() + args.timeout
+    while session_id not in deliveries:
+        if time.monotonic() > deadline:
+            return {"ok": False, "upload": upload_time}
+        await asyncio.sleep(0.1)
+    return {
+        "ok": True,
+        "upload": upload_time,
+        "latency": deliveries[session_id]["received_at"] - submitted_at,
+    }
+
+
+async def _watch_deliveries(client, services, deliveries: dict, stop: asyncio.Event):
+    """One request fetches every delivery so far; keeps `deliveries` current"""
+    while not stop.is_set():
+        res = await client.get(f"{services.webhook_uri}/_deliveries")
+        deliveries.update(res.json())
+        await asyncio.sleep(0.1)
+
+
+async def run(args) -> dict:
+    with tempfile.TemporaryDirectory(prefix="llm-loadtest-") as log_dir:
+        services = Services(args, Path(log_dir))
+        services.up()
+        try:
+            async with httpx.AsyncClient(timeout=60) as client:
+                for uri in (
+                    services.platform_uri,
+                    services.webhook_uri,
+                    services.api_uri,
+                ):
+                    await _wait_until_up(client, f"{uri}/docs")
+                await _wait_for_worker(client, services)
+                await client.post(f"{services.platform_uri}/_reset")
+                await client.post(f"{services.webhook_uri}/_reset")
+
+                deliveries: dict = {}
+                stop = asyncio.Event()
+                watcher = asyncio.create_task(
+                    _watch_deliveries(client, services, deliveries, stop)
+                )
+                slots = asyncio.Semaphore(args.concurrency)
+
+                async def bounded(i):
+                    async with slots:
+                        return await _run_session(client, services, args, i, deliveries)
+
+                cpu_start = _cpu_seconds(services.worker_pid)
+                wall_start = time.monotonic()
+                outcomes = await asyncio.gather(
+                    *(bounded(i) for i in range(args.sessions))
+                )
+                wall = time.monotonic() - wall_start
+                cpu = _cpu_seconds(services.worker_pid) - cpu_start
+
+                stop.set()
+                await watcher
+                platform = (await client.get(f"{services.platform_uri}/_stats")).json()
+        finally:
+            services.down()
+            if args.keep_logs:
+                for log in Path(log_dir).iterdir():
+                    print(f"--- {log.name}\n{log.read_text()[-5000:]}")
+
+    completed = [o for o in outcomes if o["ok"]]
+    answers = len(completed) * args.queries
+    return {
+        "config": {
+            k: getattr(args, k)
+            for k in (
+                "sessions",
+                "concurrency",
+                "queries",
+                "documents",
+                "document_size",
+                "upload_latency",
+                "collection_latency",
+                "thread_latency",
+                "pool",
+                "worker_concurrency",
+            )
+        },
+        "completed": len(completed),
+        "failed": len(outcomes) - len(completed),
+        "wall_secs": wall,
+        "throughput_sessions_per_sec": len(completed) / wall,
+        "throughput_answers_per_sec": answers / wall,
+        "latency_secs": _percentiles(sorted(o["latency"] for o in completed)),
+        "upload_secs": _percentiles(sorted(o["upload"] for o in outcomes)),
+        "platform_requests": platform["requests"],
+        "platform_requests_per_answer": (
+            platform["total"] / answers if answers else None
+        ),
+        "worker_cpu_secs": cpu,
+        "worker_cpu_utilisation": cpu / wall,
+    }
+
+
+def compare(report: dict, baseline: dict, tolerance: float) -> list[str]:
+    """Regressions of the report against the baseline beyond the tolerance"""
+    regressions = []
+    lower_is_better = {
+        f"latency_secs.{p}": (report["latency_secs"][p], baseline["latency_secs"][p])
+        for p in ("p50", "p95", "p99")
+    }
+    lower_is_better["platform_requests_per_answer"] = (
+        report["platform_requests_per_answer"],
+        baseline["platform_requests_per_answer"],
+    )
+    for name, (now, before) in lower_is_better.items():
+        if now is not None and before and now > before * (1 + tolerance):
+            regressions.append(f"{name}: {now:.3f} > baseline {before:.3f}")
+
+    now, before = (
+        report["throughput_answers_per_sec"],
+        baseline["throughput_answers_per_sec"],
+    )
+    if before and now < before * (1 - tolerance):
+        regressions.append(
+            f"throughput_answers_per_sec: {now:.3f} < baseline {before:.3f}"
+        )
+    if report["failed"] > baseline["failed"]:
+        regressions.append(
+            f"failed: {report['failed']} > baseline {baseline['failed']}"
+        )
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument(
+        "--sessions", type=int, default=20, help="no of upload + query flows"
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=5, help="flows in flight at once"
+    )
+    parser.add_argument(
+        "--queries", type=int, default=3, help="questions per query request"
+    )
+    parser.add_argument(
+        "--documents", type=int, default=1, help="documents uploaded per session"
+    )
+    parser.add_argument(
+        "--document-size", type=int, default=256 * 1024, help="bytes per document"
+    )
+    parser.add_argument("--prompt", default="You are a helpful assistant")
+    parser.add_argument("--upload-latency", type=float, default=0.2)
+    parser.add_argument("--collection-latency", type=float, default=5)
+    parser.add_argument("--thread-latency", type=float, default=3)
+    parser.add_argument("--pool", default="threads", help="celery worker pool")
+    parser.add_argument("--worker-concurrency", type=int, default=64)
+    parser.add_argument("--timeout", type=float, default=600, help="max secs per flow")
+    parser.add_argument("--redis-url", default="redis://localhost:6379/0")
+    parser.add_argument("--api-port", type=int, default=7100)
+    parser.add_argument("--platform-port", type=int, default=7101)
+    parser.add_argument("--webhook-port", type=int, default=7102)
+    parser.add_argument(
+        "--webhook-batch",
+        action="store_true",
+        help="let the receiver take coalesced {batch: [...]} deliveries",
+    )
+    parser.add_argument(
+        "--baseline", type=Path, help="baseline report to compare against"
+    )
+    parser.add_argument(
+        "--save-baseline", type=Path, help="write this run as the baseline"
+    )
+    parser.add_argument(
+        "--tolerance", type=float, default=0.1, help="allowed regression (fraction)"
+    )
+    parser.add_argument(
+        "--keep-logs", action="store_true", help="print service logs at the end"
+    )
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    print(json.dumps(report, indent=2))
+
+    if args.save_baseline:
+        args.save_baseline.write_text(json.dumps(report, indent=2) + "\n")
+        print(f"Baseline saved to {args.save_baseline}")
+
+    if args.baseline:
+        regressions = compare(
+            report, json.loads(args.baseline.read_text()), args.tolerance
+        )
+        if regressions:
+            print("Regressed against the baseline:\n  " + "\n  ".join(regressions))
+            sys.exit(1)
+        print("No regression against the baseline")
+
+
+if __name__ == "__main__":
+    main()
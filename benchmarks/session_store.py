@@ -0,0 +1,131 @@
+"""
+Micro-benchmark of the file search session store (FileSearchSession).
+
+Compares get, set & appending an upload on the hash/list layout against the
+previous single json string per session, whose append is a read-modify-write
+of the whole blob. Also fires concurrent appends at one session with both and
+counts the uploads lost to the race. Runs against the configured redis
+(REDIS_HOST / REDIS_PORT); the sessions it writes are removed afterwards.
+
+    uv run python -m benchmarks.session_store --documents 50 --ops 2000
+"""
+
+import json
+import time
+import uuid
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from config.redis_client import RedisClient
+from src.file_search.session import (
+    SESSION_INDEX,
+    FileSearchSession,
+    OpenAISessionState,
+    _key_expiry,
+)
+
+
+class LegacySessionStore:
+    """The json string implementation, kept here as the reference"""
+
+    _redis_client = RedisClient.get_instance()
+
+    @classmethod
+    def set(cls, key: str, value: OpenAISessionState) -> OpenAISessionState:
+        pipe = cls._redis_client.pipeline()
+        pipe.set(key, json.dumps(value.model_dump()), ex=_key_expiry())
+        pipe.zadd(SESSION_INDEX, {key: time.time()})
+        pipe.execute()
+        return value
+
+    @classmethod
+    def get(cls, key) -> OpenAISessionState:
+        pipe = cls._redis_client.pipeline()
+        pipe.get(key)
+        if _key_expiry():
+            pipe.expire(key, _key_expiry())
+            pipe.zadd(SESSION_INDEX, {key: time.time()}, xx=True)
+        result = pipe.execute()[0]
+        if result:
+            return OpenAISessionState(**json.loads(result))
+        return None
+
+    @classmethod
+    def append(cls, key: str, field: str, value: str, digest: str = None) -> None:
+        session = cls.get(key) or OpenAISessionState(id=key, local_fpaths=[])
+        getattr(session, field).append(value)
+        if digest:
+            session.document_hashes[value] = digest
+        cls.set(key, session)
+
+
+def synthetic_session(documents: int) -> OpenAISessionState:
+    session_id = str(uuid.uuid4())
+    document_ids = [f"file-{uuid.uuid4().hex[:24]}" for _ in range(documents)]
+    return OpenAISessionState(
+        id=session_id,
+        local_fpaths=[],
+        document_ids=document_ids,
+        document_names={d: f"{d}.pdf" for d in document_ids},
+        document_hashes={d: uuid.uuid4().hex * 2 for d in document_ids},
+        thread_id=f"thread_{uuid.uuid4().hex[:24]}",
+        assistant_id=f"asst_{uuid.uuid4().hex[:24]}",
+        vector_store_id=f"vs_{uuid.uuid4().hex[:24]}",
+    )
+
+
+def throughput(fn, ops: int) -> float:
+    """Calls of fn per second"""
+    start = time.perf_counter()
+    for i in range(ops):
+        fn(i)
+    return ops / (time.perf_counter() - start)
+
+
+def lost_appends(store, uploads: int, concurrency: int) -> int:
+    """Uploads missing from a session after appending them all concurrently"""
+    session_id = str(uuid.uuid4())
+    store.set(session_id, OpenAISessionState(id=session_id, local_fpaths=[]))
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(
+            pool.map(
+                lambda i: store.append(session_id, "document_ids", f"file-{i}"),
+                range(uploads),
+            )
+        )
+    lost = uploads - len(store.get(session_id).document_ids)
+    FileSearchSession.remove(session_id)
+    return lost
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--documents", type=int, default=50, help="per session")
+    parser.add_argument("--ops", type=int, default=2000)
+    parser.add_argument("--uploads", type=int, default=200, help="for the race")
+    parser.add_argument("--concurrency", type=int, default=8)
+    args = parser.parse_args()
+
+    session = synthetic_session(args.documents)
+    stores = {"json string": LegacySessionStore, "hash & lists": FileSearchSession}
+
+    print(f"session: {args.documents} documents, {args.ops} ops per measurement")
+    print(f"{'':<14}{'set/s':>10}{'get/s':>10}{'append/s':>10}{'lost':>8}")
+    for name, store in stores.items():
+        store.set(session.id, session)
+        assert store.get(session.id) == session, f"{name} doesn't round trip"
+
+        set_ops = throughput(lambda _: store.set(session.id, session), args.ops)
+        get_ops = throughput(lambda _: store.get(session.id), args.ops)
+        append_ops = throughput(
+            lambda i: store.append(session.id, "local_fpaths", f"tmp/{i}.pdf"),
+            args.ops,
+        )
+        FileSearchSession.remove(session.id)
+
+        lost = lost_appends(store, args.uploads, args.concurrency)
+        print(f"{name:<14}{set_ops:>10.0f}{get_ops:>10.0f}{append_ops:>10.0f}{lost:>8}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,38 @@
+"""
+Fake webhook receiver, for benchmarking.
+Records when the results of each session were delivered.
+
+    uv run uvicorn benchmarks.webhook_receiver:app --port 7102
+"""
+
+import time
+
+from fastapi import FastAPI
+
+app = FastAPI()
+
+deliveries: dict[str, dict] = {}  # session id -> delivery
+
+
+@app.post("/webhook")
+async def receive(payload: dict):
+    # a batching receiver gets {"batch": [payload, ...]}
+    received_at = time.time()
+    for item in payload.get("batch") or [payload]:
+        deliveries[item.get("session_id")] = {
+            "received_at": received_at,
+            "results": len(item.get("results") or []),
+            "batched": "batch" in payload,
+        }
+    return {"success": True}
+
+
+@app.get("/_deliveries")
+async def get_deliveries():
+    return deliveries
+
+
+@app.post("/_reset")
+async def reset():
+    deliveries.clear()
+    return {"success": True}
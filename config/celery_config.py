@@ -1,24 +1,91 @@
 import os
 from kombu import Queue
 
+# how often expired file search sessions are released
+SESSION_SWEEP_INTERVAL = float(os.getenv("SESSION_SWEEP_INTERVAL_SECS", 5 * 60))
+
+# queries are routed by priority: short interactive ones never wait behind bulk
+# runs. The close & sweep tasks (quick, and they free resources) get their own queue
+INTERACTIVE_QUEUE = os.getenv("CELERY_INTERACTIVE_QUEUE", "llm")
+BULK_QUEUE = os.getenv("CELERY_BULK_QUEUE", "llm_bulk")
+CONTROL_QUEUE = os.getenv("CELERY_CONTROL_QUEUE", "control")
+PRIORITY_QUEUES = {"interactive": INTERACTIVE_QUEUE, "bulk": BULK_QUEUE}
+
+
+def _task_queues(value: str) -> dict[str, str]:
+    """Parses `task=queue,task=queue`; raises ValueError naming a malformed entry"""
+    routes = {}
+    for route in filter(None, (r.strip() for r in value.split(","))):
+        name, _, queue = (part.strip() for part in route.partition("="))
+        if not name or not queue or "=" in queue:
+            raise ValueError(
+                f"CELERY_TASK_ROUTES_OVERRIDE: expected task=queue, got {route!r}"
+            )
+        routes[name] = queue
+    return routes
+
+
+# tasks pinned to a queue by name; CELERY_TASK_ROUTES_OVERRIDE (task=queue,...)
+# overrides. Not CELERY_TASK_QUEUES, which is the celery setting defined below
+TASK_QUEUES = {
+    "close_file_search_session": CONTROL_QUEUE,
+    "close_file_search_session_v1": CONTROL_QUEUE,
+    "sweep_file_search_sessions": CONTROL_QUEUE,
+    **_task_queues(os.getenv("CELERY_TASK_ROUTES_OVERRIDE", "")),
+}
+
 
 def route_task(name, args, kwargs, options, task=None, **kw):
     if ":" in name:
         queue, _ = name.split(":")
         return {"queue": queue}
-    return {"queue": "llm"}
+    if name in TASK_QUEUES:
+        return {"queue": TASK_QUEUES[name]}
+    priority = (kwargs or {}).get("priority")
+    return {"queue": PRIORITY_QUEUES.get(priority, INTERACTIVE_QUEUE)}
 
 
 class CeleryConfig:
     CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL", "redis://localhost:6379/0")
     result_backend = os.getenv("CELERY_RESULT_BACKEND", "redis://localhost:6379/0")
-    CELERY_TASK_DEFAULT_QUEUE = "llm"
-    CELERY_TASK_QUEUES: list = (
-        # default queue
-        Queue("llm"),
-    )
+    CELERY_TASK_DEFAULT_QUEUE = INTERACTIVE_QUEUE
+    CELERY_TASK_QUEUES: list = [
+        Queue(queue)
+        for queue in dict.fromkeys(
+            [
+                # default queue
+                INTERACTIVE_QUEUE,
+                BULK_QUEUE,
+                CONTROL_QUEUE,
+                # webhook deliveries; tasks named "webhooks:..."
+                "webhooks",
+                *TASK_QUEUES.values(),
+            ]
+        )
+    ]
     CELERY_TASK_ROUTES = (route_task,)
+    # query tasks spend nearly all their time waiting on the ai platform / openai
+    # (query_file_v1 via an event loop, PollingEngine); with the threads pool a
+    # waiting task only holds a cheap thread, so a worker runs many of them at once.
+    # With prefork, in-flight queries are bounded by the no of processes
+    CELERY_WORKER_POOL = os.getenv("CELERY_WORKER_POOL", "threads")
+    CELERY_WORKER_CONCURRENCY = int(os.getenv("CELERY_WORKER_CONCURRENCY") or 64)
+    # a worker reserves only the task it is about to run; with long llm tasks a
+    # deeper prefetch parks queued work on a busy worker while others sit idle
+    CELERY_WORKER_PREFETCH_MULTIPLIER = int(
+        os.getenv("CELERY_WORKER_PREFETCH_MULTIPLIER", 1)
+    )
     broker_connection_retry_on_startup = True
 
+    # periodic tasks; run `celery -A main.celery beat` alongside the workers
+    CELERY_BEAT_SCHEDULE = {
+        "sweep-file-search-sessions": {
+            "task": "sweep_file_search_sessions",
+            "schedule": SESSION_SWEEP_INTERVAL,
+            # a sweep that waited past the next one is redundant
+            "options": {"expires": SESSION_SWEEP_INTERVAL},
+        },
+    }
+
     # Instead, use autodiscover_tasks in your Celery app initialization (main.py or celery.py):
     # celery.autodiscover_tasks(['src.apis'])
@@ -2,6 +2,24 @@ import os
 import threading
 
 from redis import Redis
+from redis.asyncio import (
+    Redis as AsyncRedis,
+    BlockingConnectionPool as AsyncBlockingConnectionPool,
+)
+
+
+_scripts: dict = {}
+
+
+def registered_script(client, source: str):
+    """
+    The lua script registered on the client (sync or asyncio), once rather than
+    on every call; registered again only for a new client
+    """
+    script = _scripts.get((type(client), source))
+    if script is None or script.registered_client is not client:
+        script = _scripts[(type(client), source)] = client.register_script(source)
+    return script
 
 
 class RedisClient:
@@ -40,3 +58,68 @@ class RedisClient:
         Reset the instance to None
         """
         cls._redis_instance = None
+
+
+class AsyncRedisClient:
+    """
+    Singleton Class to instantiate an asyncio Redis client.
+    Use this class in async code (fastapi handlers) so that redis round trips
+    don't block the event loop.
+    Commands that hold a connection while they wait on redis (XREAD with block,
+    pub/sub) use `get_blocking_instance`, so long lived SSE streams can't take
+    every connection from the lookups & uploads
+    """
+
+    _redis_instance = None
+    _blocking_instance = None
+
+    @staticmethod
+    def _build(max_connections: int) -> AsyncRedis:
+        host = os.getenv("REDIS_HOST", "localhost")
+        port = int(os.getenv("REDIS_PORT", "6379"))
+        # a request waits up to REDIS_POOL_TIMEOUT_SECS for a free connection
+        # instead of failing at once when the pool is exhausted
+        pool = AsyncBlockingConnectionPool(
+            host=host,
+            port=port,
+            max_connections=max_connections,
+            timeout=float(os.getenv("REDIS_POOL_TIMEOUT_SECS", "5")),
+        )
+        return AsyncRedis(connection_pool=pool)
+
+    @classmethod
+    def get_instance(cls) -> AsyncRedis:
+        """
+        Returns the asyncio Redis instance; configured the same way as RedisClient.
+        Connections come from a pool of at most REDIS_MAX_CONNECTIONS (default 50).
+        No lock is needed since it is only created from the (single) event loop thread
+        Returns:
+            AsyncRedis: The asyncio Redis instance.
+        """
+        if cls._redis_instance is None:
+            cls._redis_instance = cls._build(
+                int(os.getenv("REDIS_MAX_CONNECTIONS", "50"))
+            )
+        return cls._redis_instance
+
+    @classmethod
+    def get_blocking_instance(cls) -> AsyncRedis:
+        """
+        Returns the asyncio Redis instance for blocking reads; its own pool of at
+        most REDIS_MAX_STREAM_CONNECTIONS (default 500), i.e. open SSE streams
+        Returns:
+            AsyncRedis: The asyncio Redis instance.
+        """
+        if cls._blocking_instance is None:
+            cls._blocking_instance = cls._build(
+                int(os.getenv("REDIS_MAX_STREAM_CONNECTIONS", "500"))
+            )
+        return cls._blocking_instance
+
+    @classmethod
+    def reset_instance(cls) -> None:
+        """
+        Reset the instances to None
+        """
+        cls._redis_instance = None
+        cls._blocking_instance = None
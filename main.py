@@ -19,6 +19,7 @@ from src.apis.api import router as text_summarization_router
 from src.apis.api_v1 import router as text_summarization_router_v1
 from config.celery_config import CeleryConfig
 from config.constants import TMP_UPLOAD_DIR_NAME, LOGS_DIR_NAME
+from src.utils.metrics import metrics_middleware, metrics_response
 
 log_dir = Path(__file__).resolve().parent / LOGS_DIR_NAME
 log_dir.mkdir(parents=True, exist_ok=True)
@@ -67,6 +68,7 @@ dictConfig(
 
 
 app = FastAPI()
+app.middleware("http")(metrics_middleware)
 
 security = HTTPBearer()
 
@@ -85,6 +87,8 @@ celery = Celery(
     "t4d-ai-llm",
 )
 celery.config_from_object(CeleryConfig, namespace="CELERY")
+# the app is only "current" in this thread; sync handlers run in a threadpool
+celery.set_default()
 celery.autodiscover_tasks(
     [
         "src.apis",
@@ -110,6 +114,14 @@ def health_check():
     return {"status": "ok"}
 
 
+@app.get("/metrics", include_in_schema=False)
+def metrics():
+    """
+    Prometheus metrics of the api (and of the tasks published from it)
+    """
+    return metrics_response()
+
+
 # home route
 @app.get("/api")
 async def home(auth_user: dict = Depends(authenticate_user)):
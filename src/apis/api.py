@@ -1,23 +1,44 @@
 import os
+import json
+import asyncio
 import uuid
 import logging
 from typing import Optional
 from pathlib import Path
-from pydantic import BaseModel
-from fastapi import APIRouter, HTTPException, UploadFile, Form
+import anyio
+from pydantic import BaseModel, Field
+from fastapi import APIRouter, HTTPException, UploadFile, Form, Query
+from fastapi.responses import StreamingResponse
 from celery import shared_task
 from celery.result import AsyncResult, states
 from config.constants import TMP_UPLOAD_DIR_NAME
 
 
-from src.file_search.openai_assistant import SessionStatusEnum
-from src.file_search.session import FileSearchSession, OpenAISessionState
+from src.file_search.session import (
+    AsyncFileSearchSession,
+    OpenAISessionState,
+    SessionStatusEnum,
+)
 from src.custom_webhook import WebhookConfig
-from src.utils.celery_tasks import query_file, close_file_search_session
+from src.utils.celery_tasks import (
+    QUERY_CONCURRENCY_LIMIT,
+    QUERY_MAX_CONCURRENCY,
+    close_file_search_session,
+    query_file,
+)
+from src.utils.fair_share import QueryPriority, resolve_priority, tenant_for
+from src.utils.task_progress import TaskProgress
+from src.utils.task_status import TaskStatus, TaskCompletion
+from src.utils.uploads import check_upload_size, content_hasher, save_upload
 
 
 router = APIRouter()
 
+TASK_EVENTS_TIMEOUT = int(os.getenv("TASK_EVENTS_TIMEOUT_SECS", 30 * 60))
+TASK_STATUS_BATCH_MAX = int(os.getenv("TASK_STATUS_BATCH_MAX", 1000))
+TASK_WAIT_TIMEOUT = float(os.getenv("TASK_WAIT_TIMEOUT_SECS", 30))
+TASK_WAIT_MAX_TIMEOUT = float(os.getenv("TASK_WAIT_MAX_TIMEOUT_SECS", 120))
+
 logger = logging.getLogger()
 
 
@@ -26,6 +47,24 @@ class FileQueryRequest(BaseModel):
     assistant_prompt: str = None
     session_id: str
     webhook_config: Optional[WebhookConfig] = None
+    # queries don't build on each other's answers; answer them concurrently
+    independent_queries: bool = False
+    max_concurrency: int = Field(
+        default=QUERY_MAX_CONCURRENCY, ge=1, le=QUERY_CONCURRENCY_LIMIT
+    )
+    # serve repeat questions on the same documents & prompt from the answer cache
+    answer_cache: bool = False
+    # interactive or bulk (separate queues); by default bulk for many queries
+    priority: Optional[QueryPriority] = None
+    # the api client the query is on behalf of; its share of the workers is capped.
+    # Defaults to the webhook's host
+    client_id: Optional[str] = None
+
+
+class TaskStatusRequest(BaseModel):
+    task_ids: list[str] = Field(min_length=1, max_length=TASK_STATUS_BATCH_MAX)
+    include_result: bool = True
+    include_traceback: bool = False
 
 
 @router.delete("/file/search/session/{session_id}")
@@ -55,7 +94,7 @@ async def post_query_file(payload: FileQueryRequest):
     if payload.queries is None or len(payload.queries) == 0:
         raise HTTPException(status_code=400, detail="Input query is required")
 
-    session = FileSearchSession.get(payload.session_id)
+    session = await AsyncFileSearchSession.get(payload.session_id)
     logger.info("Session: %s", session)
 
     if not payload.session_id or not session:
@@ -70,6 +109,11 @@ async def post_query_file(payload: FileQueryRequest):
             "webhook_config": (
                 payload.webhook_config.model_dump() if payload.webhook_config else None
             ),
+            "independent_queries": payload.independent_queries,
+            "max_concurrency": payload.max_concurrency,
+            "answer_cache": payload.answer_cache,
+            "priority": resolve_priority(payload.priority, payload.queries),
+            "client_id": tenant_for(payload.client_id, payload.webhook_config),
         }
     )
     return {"task_id": task.id, "session_id": session.id}
@@ -88,7 +132,7 @@ async def post_upload_knowledge_file(file: UploadFile, session_id: str = Form(No
     session = None
     if session_id:
         logger.info("Fetching the current session")
-        session: OpenAISessionState = FileSearchSession.get(session_id)
+        session: OpenAISessionState = await AsyncFileSearchSession.get(session_id)
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
 
@@ -107,22 +151,37 @@ async def post_upload_knowledge_file(file: UploadFile, session_id: str = Form(No
     if file is None:
         raise HTTPException(status_code=400, detail="No file uploaded")
 
+    check_upload_size(file)
+
     try:
-        logger.info("reading file contents")
+        logger.info("streaming file contents to disk")
         # uploading the file to the tmp directory under a session_id
-        file_dir = Path(f"{TMP_UPLOAD_DIR_NAME}/{session.id}")
-        file_dir.mkdir(parents=True, exist_ok=True)
-        fpath = file_dir / file.filename
-        with open(fpath, "wb") as buffer:
-            buffer.write(file.file.read())
+        file_dir = anyio.Path(f"{TMP_UPLOAD_DIR_NAME}/{session.id}")
+        await file_dir.mkdir(parents=True, exist_ok=True)
+        fpath = Path(file_dir) / file.filename
+        hasher = content_hasher()
+        await save_upload(file, fpath, hasher)
 
-        # update the session
-        session.local_fpaths.append(str(fpath))
-        session = FileSearchSession.set(session.id, session)
+        # update the session; appended atomically so concurrent uploads all land
+        if not await AsyncFileSearchSession.append(
+            session.id,
+            "local_fpaths",
+            str(fpath),
+            hasher.hexdigest(),
+            create=not session_id,
+        ):
+            # closed while the file was being saved
+            await anyio.Path(fpath).unlink(missing_ok=True)
+            raise HTTPException(status_code=404, detail="Session not found")
 
         logger.info("File uploaded successfully")
 
         return {"file_path": str(fpath), "session_id": session.id}
+    except HTTPException as err:
+        if err.status_code in (404, 413):
+            raise
+        logger.error(err)
+        raise HTTPException(status_code=500, detail="Internal Server Error")
     except Exception as err:
         logger.error(err)
         raise HTTPException(status_code=500, detail="Internal Server Error")
@@ -144,3 +203,84 @@ def get_summarize_job(task_id):
         "err_trace": task_result.traceback if task_result.traceback else None,
     }
     return result
+
+
+@router.post("/tasks/status")
+def get_tasks_status(payload: TaskStatusRequest):
+    """
+    Status of many tasks in one call, read from the result backend in a single
+    round trip. Results come back in the order of `task_ids`; `err_trace` is only
+    included with `include_traceback`
+    """
+    return {
+        "tasks": TaskStatus.many(
+            payload.task_ids,
+            include_result=payload.include_result,
+            include_traceback=payload.include_traceback,
+        )
+    }
+
+
+@router.get("/task/{task_id}/wait")
+async def wait_for_task(
+    task_id: str,
+    timeout: float = Query(default=TASK_WAIT_TIMEOUT, gt=0, le=TASK_WAIT_MAX_TIMEOUT),
+    include_traceback: bool = False,
+):
+    """
+    Long-poll; returns as soon as the task has finished (or right away if it
+    already has), else its current status once `timeout` seconds are up. The
+    result backend is only read when the request starts and when it returns
+    """
+
+    def status() -> dict:
+        return TaskStatus.many([task_id], include_traceback=include_traceback)[0]
+
+    waiter = await TaskCompletion.subscribe(task_id)
+    try:
+        result = await anyio.to_thread.run_sync(status)
+        if result["status"] in states.READY_STATES:
+            return result
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+    finally:
+        TaskCompletion.unsubscribe(task_id, waiter)
+    return await anyio.to_thread.run_sync(status)
+
+
+@router.get("/task/{task_id}/events")
+async def stream_task_events(task_id: str):
+    """
+    Server-Sent Events for a file query task (v0 or v1).
+    - `answer` event with `{index, answer}` as soon as each query is answered
+    - `done` event with `{status}` once the task has finished
+    Unknown tasks get a 404; tasks that finished before their stream expired (or
+    that don't stream progress) only get the `done` event
+    """
+
+    def current_status() -> str:
+        return TaskStatus.many([task_id], include_result=False)[0]["status"]
+
+    status = None
+    if not await TaskProgress.exists(task_id):
+        status = await anyio.to_thread.run_sync(current_status)
+        if status == states.PENDING:
+            raise HTTPException(status_code=404, detail="Task not found")
+
+    async def events():
+        if status in states.READY_STATES:
+            yield f"event: done\ndata: {json.dumps({'status': status})}\n\n"
+            return
+        async for event, data in TaskProgress.listen(task_id, TASK_EVENTS_TIMEOUT):
+            if event == "heartbeat":
+                yield ": keep-alive\n\n"
+            else:
+                yield f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+    return StreamingResponse(
+        events(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -3,15 +3,26 @@ import uuid
 import logging
 from typing import Optional
 from pathlib import Path
-from pydantic import BaseModel
+import anyio
+from pydantic import BaseModel, Field
 from fastapi import APIRouter, HTTPException, UploadFile, Form
 
 
-from src.file_search.openai_assistant import SessionStatusEnum
-from src.file_search.session import FileSearchSession, OpenAISessionState
+from src.file_search.session import (
+    AsyncFileSearchSession,
+    OpenAISessionState,
+    SessionStatusEnum,
+)
 from src.custom_webhook import WebhookConfig
 from src.services import ai_platform_src
-from src.utils.celery_tasks import query_file_v1, close_file_search_session_v1
+from src.utils.celery_tasks import (
+    QUERY_CONCURRENCY_LIMIT,
+    QUERY_MAX_CONCURRENCY,
+    close_file_search_session_v1,
+    query_file_v1,
+)
+from src.utils.fair_share import QueryPriority, resolve_priority, tenant_for
+from src.utils.uploads import hash_upload
 
 
 router = APIRouter()
@@ -24,6 +35,45 @@ class FileQueryRequest(BaseModel):
     assistant_prompt: str = None
     session_id: str
     webhook_config: Optional[WebhookConfig] = None
+    # queries don't build on each other's answers; answer them concurrently
+    independent_queries: bool = False
+    max_concurrency: int = Field(
+        default=QUERY_MAX_CONCURRENCY, ge=1, le=QUERY_CONCURRENCY_LIMIT
+    )
+    # serve repeat questions on the same documents & prompt from the answer cache
+    answer_cache: bool = False
+    # interactive or bulk (separate queues); by default bulk for many queries
+    priority: Optional[QueryPriority] = None
+    # the api client the query is on behalf of; its share of the workers is capped.
+    # Defaults to the webhook's host
+    client_id: Optional[str] = None
+
+
+def _delete_document_quietly(document_id: str) -> None:
+    try:
+        ai_platform_src.delete_document(document_id)
+    except Exception as err:
+        logger.error(f"Failed to delete the document {document_id}: {err}")
+
+
+async def _release_unlisted(session_id: str, digest: str, document_id: str) -> None:
+    """
+    Drops the session's reference to a document its upload failed to add to the
+    session (unless a concurrent upload of the same content did), deleting the
+    document if nobody else holds it
+    """
+
+    def release():
+        if ai_platform_src.DOCUMENT_INDEX.release(digest, session_id, document_id):
+            _delete_document_quietly(document_id)
+
+    try:
+        session = await AsyncFileSearchSession.get(session_id, touch=False)
+        if session and document_id in session.document_ids:
+            return
+        await anyio.to_thread.run_sync(release)
+    except Exception as err:
+        logger.error(f"Failed to release the document {document_id}: {err}")
 
 
 @router.delete("/file/search/session/{session_id}")
@@ -52,7 +102,7 @@ async def post_query_file(payload: FileQueryRequest):
     if payload.queries is None or len(payload.queries) == 0:
         raise HTTPException(status_code=400, detail="Input query is required")
 
-    session = FileSearchSession.get(payload.session_id)
+    session = await AsyncFileSearchSession.get(payload.session_id)
     logger.info("Session: %s", session)
 
     if not payload.session_id or not session:
@@ -68,6 +118,11 @@ async def post_query_file(payload: FileQueryRequest):
             "webhook_config": (
                 payload.webhook_config.model_dump() if payload.webhook_config else None
             ),
+            "independent_queries": payload.independent_queries,
+            "max_concurrency": payload.max_concurrency,
+            "answer_cache": payload.answer_cache,
+            "priority": resolve_priority(payload.priority, payload.queries),
+            "client_id": tenant_for(payload.client_id, payload.webhook_config),
         }
     )
     return {"task_id": task.id, "session_id": session.id}
@@ -86,7 +141,7 @@ async def post_upload_knowledge_file(file: UploadFile, session_id: str = Form(No
     session = None
     if session_id:
         logger.info("Fetching the current session")
-        session: OpenAISessionState = FileSearchSession.get(session_id)
+        session: OpenAISessionState = await AsyncFileSearchSession.get(session_id)
         if not session:
             raise HTTPException(status_code=404, detail="Session not found")
 
@@ -106,18 +161,48 @@ async def post_upload_knowledge_file(file: UploadFile, session_id: str = Form(No
         raise HTTPException(status_code=400, detail="No file uploaded")
 
     try:
-        logger.info("reading file contents")
-        # uploading the file
-        document_id = ai_platform_src.upload_document(file)
-
-        session.document_ids.append(document_id)
-
-        # update the session
-        session = FileSearchSession.set(session.id, session)
+        digest = await hash_upload(file)
+        # reuse the document if the same content was uploaded before
+        document_id = await ai_platform_src.DOCUMENT_INDEX.aacquire(digest, session.id)
+        if document_id:
+            logger.info(f"Content already uploaded as {document_id}; reusing it")
+        else:
+            logger.info("streaming file contents to the platform")
+            uploaded = await ai_platform_src.aupload_document(file)
+            document_id = await ai_platform_src.DOCUMENT_INDEX.aacquire(
+                digest, session.id, uploaded
+            )
+            if document_id != uploaded:
+                # an identical upload was indexed first; keep that one
+                await anyio.to_thread.run_sync(_delete_document_quietly, uploaded)
+
+        # update the session; appended atomically so concurrent uploads all land
+        if document_id not in session.document_ids:
+            try:
+                appended = await AsyncFileSearchSession.append(
+                    session.id,
+                    "document_ids",
+                    document_id,
+                    digest,
+                    create=not session_id,
+                )
+            except Exception:
+                # close would never release a reference the session doesn't list
+                await _release_unlisted(session.id, digest, document_id)
+                raise
+            if not appended:
+                # closed while the file was being uploaded
+                await _release_unlisted(session.id, digest, document_id)
+                raise HTTPException(status_code=404, detail="Session not found")
 
         logger.info("File uploaded successfully")
 
         return {"file_path": document_id, "session_id": session.id}
+    except HTTPException as err:
+        if err.status_code in (404, 413):
+            raise
+        logger.error(err)
+        raise HTTPException(status_code=500, detail="Internal Server Error")
     except Exception as err:
         logger.error(err)
         raise HTTPException(status_code=500, detail="Internal Server Error")
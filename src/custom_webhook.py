@@ -1,11 +1,24 @@
-import requests
+import os
+import json
+import time
+import hashlib
 from requests.exceptions import HTTPError
 from pydantic import BaseModel
 import logging
 
+from celery import current_app
+
+from config.redis_client import RedisClient
+from src.utils.http_helper import HttpClient
+
 
 logger = logging.getLogger()
 
+# results for a batching receiver are held this long to be posted together
+WEBHOOK_BATCH_WINDOW = float(os.getenv("WEBHOOK_BATCH_WINDOW_SECS", 2))
+WEBHOOK_BATCH_MAX = int(os.getenv("WEBHOOK_BATCH_MAX", 50))
+WEBHOOK_DEAD_LETTER_MAX = int(os.getenv("WEBHOOK_DEAD_LETTER_MAX", 1000))
+
 
 class WebhookConfig(BaseModel):
     """
@@ -14,6 +27,17 @@ class WebhookConfig(BaseModel):
 
     endpoint: str
     headers: dict
+    # the receiver accepts {"batch": [results, ...]}; results for the same
+    # endpoint are then coalesced into fewer posts
+    batch: bool = False
+
+
+class WebhookDeliveryError(Exception):
+    """A post to the webhook failed; `retryable` unless the receiver rejected it"""
+
+    def __init__(self, message: str, retryable: bool = True):
+        super().__init__(message)
+        self.retryable = retryable
 
 
 class CustomWebhook:
@@ -23,27 +47,139 @@ class CustomWebhook:
         # TODO: maybe some validations on the endpoint etc.
         self.config: WebhookConfig = config
 
-    def post_result(self, results: dict):
+    def post(self, payload: dict) -> dict:
         """
-        Posts data to the configured webhook endpoint.
+        Posts data to the configured webhook endpoint over the pooled http session.
+        Raises WebhookDeliveryError on failure; 4xx (except 408 & 429) aren't retryable
         """
         try:
-            response = requests.post(
+            response = HttpClient.get_instance().post(
                 self.config.endpoint,
-                json=results,
+                json=payload,
                 headers=self.config.headers,
                 timeout=self.timeout,
             )
-
             response.raise_for_status()
-
-            logging.info(f"Successfully posted results to {self.config.endpoint}")
-            return response.json()
         except HTTPError as err:
-            logging.error(f"Failed to post webhook results {err.response.text}")
-            return {"error": str(err.response.text)}
+            status = err.response.status_code
+            raise WebhookDeliveryError(
+                f"{status}: {err.response.text}",
+                retryable=not (400 <= status < 500) or status in (408, 429),
+            ) from err
         except Exception as err:
-            logging.error(
-                f"Failed to post webhook results {str(err)}. Something went wrong"
-            )
-            return {"error": str(err)}
+            raise WebhookDeliveryError(str(err)) from err
+
+        logger.info(f"Successfully posted results to {self.config.endpoint}")
+        try:
+            return response.json()
+        except ValueError:
+            return {}
+
+    def send(self, payload: dict) -> None:
+        """
+        Hands the payload over for delivery on the webhooks queue, so the calling
+        task doesn't wait on the receiver. Deliveries are retried with backoff and
+        dead-lettered in redis once the retries are exhausted
+        """
+        if self.config.batch:
+            WebhookBatch.add(self.config, payload)
+            return
+        self._enqueue(payload)
+
+    def send_batch(self, payloads: list[dict]) -> None:
+        """Queue results coalesced for a batching receiver as a single delivery"""
+        self._enqueue({"batch": payloads})
+
+    def _enqueue(self, payload: dict) -> None:
+        current_app.send_task(
+            "webhooks:deliver_webhook",
+            kwargs={"webhook_config": self.config.model_dump(), "payload": payload},
+        )
+
+
+class WebhookBatch:
+    """
+    Redis buffer of results bound for a batching receiver. The first result in a
+    window schedules a flush after WEBHOOK_BATCH_WINDOW_SECS; the flush posts
+    up to WEBHOOK_BATCH_MAX results as one {"batch": [...]} delivery
+    """
+
+    _redis_client = RedisClient.get_instance()
+    _prefix = "webhook_batch"
+    BATCH_TTL = 24 * 60 * 60  # drop what a stuck receiver never took
+
+    @classmethod
+    def key_for(cls, config: WebhookConfig) -> str:
+        digest = hashlib.sha256(
+            json.dumps([config.endpoint, config.headers], sort_keys=True).encode()
+        ).hexdigest()
+        return f"{cls._prefix}:{digest}"
+
+    @classmethod
+    def add(cls, config: WebhookConfig, payload: dict) -> None:
+        key = cls.key_for(config)
+        pipe = cls._redis_client.pipeline()
+        pipe.rpush(key, json.dumps(payload))
+        pipe.expire(key, cls.BATCH_TTL)
+        pipe.set(f"{key}:config", config.model_dump_json(), ex=cls.BATCH_TTL)
+        pipe.set(f"{key}:scheduled", 1, nx=True, ex=int(WEBHOOK_BATCH_WINDOW) + 60)
+        *_, schedule = pipe.execute()
+        if schedule:
+            cls.schedule(key, countdown=WEBHOOK_BATCH_WINDOW)
+
+    @classmethod
+    def schedule(cls, key: str, countdown: float = 0) -> None:
+        current_app.send_task(
+            "webhooks:flush_webhook_batch", kwargs={"key": key}, countdown=countdown
+        )
+
+    @classmethod
+    def take(cls, key: str) -> tuple[WebhookConfig, list[dict], bool]:
+        """
+        Pops up to WEBHOOK_BATCH_MAX results; returns the receiver's config, the
+        results & whether more are left. The flag is cleared first so a result
+        added meanwhile always schedules its own flush
+        """
+        cls._redis_client.delete(f"{key}:scheduled")
+        pipe = cls._redis_client.pipeline()
+        pipe.get(f"{key}:config")
+        pipe.lrange(key, 0, WEBHOOK_BATCH_MAX - 1)
+        pipe.ltrim(key, WEBHOOK_BATCH_MAX, -1)
+        pipe.llen(key)
+        config, items, _, left = pipe.execute()
+        if not items:
+            return None, [], False
+        return (
+            WebhookConfig.model_validate_json(config),
+            [json.loads(item) for item in items],
+            left > 0,
+        )
+
+
+class WebhookDeadLetters:
+    """Deliveries that ran out of retries, newest first; capped in size"""
+
+    _redis_client = RedisClient.get_instance()
+    _key = "webhook_dead_letters"
+
+    @classmethod
+    def add(cls, config: WebhookConfig, payload: dict, error: str) -> None:
+        entry = {
+            "webhook_config": config.model_dump(),
+            "payload": payload,
+            "error": error,
+            "failed_at": time.time(),
+        }
+        pipe = cls._redis_client.pipeline()
+        pipe.lpush(cls._key, json.dumps(entry))
+        pipe.ltrim(cls._key, 0, WEBHOOK_DEAD_LETTER_MAX - 1)
+        pipe.execute()
+
+    @classmethod
+    def take(cls, count: int = 100) -> list[dict]:
+        """Pops up to `count` of the oldest dead letters, oldest first"""
+        pipe = cls._redis_client.pipeline()
+        pipe.lrange(cls._key, -count, -1)
+        pipe.ltrim(cls._key, 0, -count - 1)
+        entries, _ = pipe.execute()
+        return [json.loads(entry) for entry in reversed(entries)]
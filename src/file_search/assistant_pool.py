@@ -0,0 +1,228 @@
+import os
+import time
+import hashlib
+import logging
+import threading
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Iterator, Optional
+
+from openai import OpenAI
+
+from src.file_search.openai_assistant import OpenAIFileAssistant, rate_limited_client
+from src.file_search.session import (
+    FileSearchSession,
+    OpenAISessionState,
+    SessionStatusEnum,
+)
+
+logger = logging.getLogger()
+
+CLIENT_POOL_SIZE = int(os.getenv("OPENAI_CLIENT_POOL_SIZE", 8))
+ASSISTANT_POOL_SIZE = int(os.getenv("OPENAI_ASSISTANT_POOL_SIZE", 32))
+ASSISTANT_POOL_IDLE_TTL = int(os.getenv("OPENAI_ASSISTANT_POOL_IDLE_TTL_SECS", 15 * 60))
+
+
+@dataclass
+class _PooledAssistant:
+    assistant: OpenAIFileAssistant
+    key_hash: str
+    last_used: float = field(default_factory=time.monotonic)
+    # a session's thread can only have one active run; tasks take turns on it
+    lock: threading.Lock = field(default_factory=threading.Lock)
+
+
+class AssistantPool:
+    """
+    Per process cache of openai clients (by api key & model) and of hydrated
+    OpenAIFileAssistant(s) (by session id), so back to back tasks on a hot session
+    skip the client & assistant setup. Both are LRU bounded; assistants idle for
+    longer than OPENAI_ASSISTANT_POOL_IDLE_TTL_SECS are dropped.
+
+    A pooled assistant is reused only while the session in redis is still locked
+    on the same assistant & thread; one redis read per checkout. Clients evicted
+    from the pool are closed once no pooled (or hydrating) assistant uses them.
+    The pool is emptied in the child after a fork (celery prefork)
+    """
+
+    lock = threading.Lock()
+    _clients: OrderedDict[str, OpenAI] = OrderedDict()
+    _assistants: OrderedDict[str, _PooledAssistant] = OrderedDict()
+    # evicted clients still used by an assistant; closed once they aren't
+    _retired: list[OpenAI] = []
+    # clients of the assistants being hydrated, by id
+    _hydrating: Counter = Counter()
+    _pid = os.getpid()
+
+    @staticmethod
+    def _hash(openai_key: str) -> str:
+        return hashlib.sha256(openai_key.encode()).hexdigest()
+
+    @classmethod
+    def _check_pid(cls) -> None:
+        if cls._pid != os.getpid():
+            cls.reset_instance()
+
+    @classmethod
+    def reset_instance(cls) -> None:
+        """Drop everything; clients hold sockets that must not cross a fork"""
+        cls.lock = threading.Lock()
+        cls._clients = OrderedDict()
+        cls._assistants = OrderedDict()
+        cls._retired = []
+        cls._hydrating = Counter()
+        cls._pid = os.getpid()
+
+    @classmethod
+    def _get_client(
+        cls, openai_key: str, model: str = "gpt-4o-mini", hydrating: bool = False
+    ) -> OpenAI:
+        cls._check_pid()
+        client_key = f"{cls._hash(openai_key)}:{model}"
+        with cls.lock:
+            client = cls._clients.get(client_key)
+            if client is None:
+                client = rate_limited_client(openai_key, model)
+                cls._clients[client_key] = client
+            cls._clients.move_to_end(client_key)
+            if hydrating:
+                cls._hydrating[id(client)] += 1
+            while len(cls._clients) > CLIENT_POOL_SIZE:
+                cls._retired.append(cls._clients.popitem(last=False)[1])
+        cls._close_retired()
+        return client
+
+    @classmethod
+    def _close_retired(cls) -> None:
+        """Closes the evicted clients (& their connections) no one uses anymore"""
+        with cls.lock:
+            in_use = {id(entry.assistant.client) for entry in cls._assistants.values()}
+            in_use.update(cls._hydrating)
+            closing = [c for c in cls._retired if id(c) not in in_use]
+            cls._retired = [c for c in cls._retired if id(c) in in_use]
+        for client in closing:
+            try:
+                client.close()
+            except Exception as err:
+                logger.warning("Failed to close an evicted openai client: %s", err)
+
+    @classmethod
+    def _evict_idle(cls) -> None:
+        """Called with cls.lock held; assistants checked out are never evicted"""
+        now = time.monotonic()
+        idle = [
+            session_id
+            for session_id, entry in cls._assistants.items()
+            if not entry.lock.locked()
+        ]
+        excess = max(len(cls._assistants) - ASSISTANT_POOL_SIZE, 0)
+        for i, session_id in enumerate(idle):
+            entry = cls._assistants[session_id]
+            if i < excess or now - entry.last_used > ASSISTANT_POOL_IDLE_TTL:
+                del cls._assistants[session_id]
+
+    @staticmethod
+    def _is_current(entry: _PooledAssistant, session: OpenAISessionState) -> bool:
+        pooled = entry.assistant.session
+        return (
+            session is not None
+            and session.status == SessionStatusEnum.locked
+            and session.assistant_id == pooled.assistant_id
+            and session.thread_id == pooled.thread_id
+        )
+
+    @classmethod
+    def _entry(
+        cls,
+        openai_key: str,
+        session_id: str,
+        instructions: str = None,
+        touch: bool = True,
+    ) -> _PooledAssistant:
+        cls._check_pid()
+        key_hash = cls._hash(openai_key)
+        with cls.lock:
+            cls._evict_idle()
+            entry = cls._assistants.get(session_id)
+            if entry is not None:
+                cls._assistants.move_to_end(session_id)
+
+        if (
+            entry is not None
+            and entry.key_hash == key_hash
+            and cls._is_current(entry, FileSearchSession.get(session_id, touch))
+        ):
+            return entry
+        if entry is not None:
+            # stale (the session moved on, or another key); never handed out again
+            cls.invalidate(session_id)
+
+        client = cls._get_client(openai_key, hydrating=True)
+        try:
+            assistant = OpenAIFileAssistant(
+                openai_key,
+                session_id=session_id,
+                instructions=instructions,
+                client=client,
+                touch=touch,
+            )
+            entry = _PooledAssistant(assistant=assistant, key_hash=key_hash)
+            with cls.lock:
+                # another thread may have hydrated the same session meanwhile; keep
+                # theirs if so, but not an entry that is stale by now
+                pooled = cls._assistants.get(session_id)
+                if (
+                    pooled is not None
+                    and pooled.key_hash == key_hash
+                    and cls._is_current(pooled, assistant.session)
+                ):
+                    entry = pooled
+                else:
+                    cls._assistants[session_id] = entry
+                cls._assistants.move_to_end(session_id)
+                cls._evict_idle()
+        finally:
+            with cls.lock:
+                cls._hydrating[id(client)] -= 1
+                if cls._hydrating[id(client)] <= 0:
+                    del cls._hydrating[id(client)]
+        cls._close_retired()
+        return entry
+
+    @classmethod
+    @contextmanager
+    def checkout(
+        cls,
+        openai_key: str,
+        session_id: str,
+        instructions: str = None,
+        touch: bool = True,
+    ) -> Iterator[OpenAIFileAssistant]:
+        """
+        Yields the pooled assistant for the session, hydrating it on a miss. It is
+        held exclusively until the block exits and dropped from the pool if the
+        block raises, since the thread may be left with a run in a bad state.
+        With touch=False the session's ttl isn't refreshed by the checkout
+        """
+        entry = cls._entry(openai_key, session_id, instructions, touch)
+        with entry.lock:
+            try:
+                yield entry.assistant
+            except Exception:
+                cls.invalidate(session_id)
+                raise
+            finally:
+                entry.last_used = time.monotonic()
+
+    @classmethod
+    def invalidate(cls, session_id: str) -> Optional[OpenAIFileAssistant]:
+        """Forget the session's assistant, e.g. once the session is closed"""
+        with cls.lock:
+            entry = cls._assistants.pop(session_id, None)
+        cls._close_retired()
+        return entry.assistant if entry else None
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=AssistantPool.reset_instance)
@@ -1,3 +1,4 @@
+import os
 import sys
 import math
 import time
@@ -9,16 +10,23 @@ from argparse import ArgumentParser
 from dataclasses import dataclass, asdict
 import logging
 import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 
-from openai import OpenAI
+from openai import OpenAI, DefaultHttpxClient, NotFoundError
 from openai.types.beta.assistant import Assistant
 from openai.types.beta.thread import Thread
-from openai.types.file_object import FileObject
 from openai.types.beta.threads.message import Message
 from openai.types.beta.threads.annotation import Annotation
-import pandas as pd
 
+from config.redis_client import RedisClient
+from src.utils.rate_limiter import RateLimiter, parse_duration
+from src.utils.uploads import file_sha256
+from src.services.document_index import DocumentIndex
 from src.file_search.session import (
+    SESSION_TTL,
     OpenAISessionState,
     FileSearchSession,
     SessionStatusEnum,
@@ -28,6 +36,99 @@ from src.file_search.session import (
 logger = logging.getLogger()
 
 
+FILE_NAME_CACHE_SIZE = int(os.getenv("OPENAI_FILE_NAME_CACHE_SIZE", 2048))
+FILE_NAME_CACHE_REDIS = (
+    os.getenv("OPENAI_FILE_NAME_CACHE_REDIS", "false").lower() == "true"
+)
+FILE_NAME_CACHE_TTL = int(os.getenv("OPENAI_FILE_NAME_CACHE_TTL_SECS", 24 * 60 * 60))
+# max no of files uploaded to (or deleted from) openai at a time per session
+OPENAI_UPLOAD_CONCURRENCY = int(os.getenv("OPENAI_UPLOAD_CONCURRENCY", 8))
+# requests/min per api key & model until openai's rate limit headers are seen
+OPENAI_RATE_LIMIT_RPM = int(os.getenv("OPENAI_RATE_LIMIT_RPM", 500))
+# safety net for sessions that are never closed; 0 keeps the vector store forever.
+# Not set when sessions don't expire (FILE_SEARCH_SESSION_TTL_SECS=0): those live
+# until closed and a session can't outlive its vector store
+VECTOR_STORE_EXPIRY_DAYS = int(os.getenv("OPENAI_VECTOR_STORE_EXPIRY_DAYS", 7))
+
+
+def rate_limited_client(openai_key: str, model: str) -> OpenAI:
+    """
+    OpenAI client whose every request first takes a token from the rate limiter
+    shared by all the workers using this key & model, and reports back the
+    rate limit headers of the response
+    """
+    limiter = RateLimiter("openai", openai_key, model, rpm=OPENAI_RATE_LIMIT_RPM)
+    http_client = DefaultHttpxClient(
+        event_hooks={
+            "request": [lambda request: limiter.acquire()],
+            "response": [
+                lambda response: limiter.learn(response.headers, response.status_code)
+            ],
+        }
+    )
+    return OpenAI(api_key=openai_key, http_client=http_client)
+
+
+class FileNameCache:
+    """
+    Bounded per process LRU of openai file id -> filename used to resolve citations
+    without a files.retrieve per annotation. With OPENAI_FILE_NAME_CACHE_REDIS set,
+    misses fall back to a redis tier shared by all the workers
+    """
+
+    lock = threading.Lock()
+    _cache: OrderedDict[str, str] = OrderedDict()
+    _prefix = "openai_file_name"
+
+    @classmethod
+    def get(cls, file_id: str) -> Optional[str]:
+        with cls.lock:
+            filename = cls._cache.get(file_id)
+            if filename is not None:
+                cls._cache.move_to_end(file_id)
+                return filename
+
+        if FILE_NAME_CACHE_REDIS:
+            filename = RedisClient.get_instance().get(f"{cls._prefix}:{file_id}")
+            if filename is not None:
+                filename = filename.decode()
+                cls._remember(file_id, filename)
+                return filename
+        return None
+
+    @classmethod
+    def _remember(cls, file_id: str, filename: str) -> None:
+        with cls.lock:
+            cls._cache[file_id] = filename
+            cls._cache.move_to_end(file_id)
+            while len(cls._cache) > FILE_NAME_CACHE_SIZE:
+                cls._cache.popitem(last=False)
+
+    @classmethod
+    def set(cls, file_id: str, filename: str) -> None:
+        cls._remember(file_id, filename)
+        if FILE_NAME_CACHE_REDIS:
+            RedisClient.get_instance().set(
+                f"{cls._prefix}:{file_id}", filename, ex=FILE_NAME_CACHE_TTL
+            )
+
+    @classmethod
+    def seed(cls, names: dict[str, str]) -> None:
+        """Remember the files (id -> filename) we already hold; only in process"""
+        for file_id, filename in names.items():
+            cls._remember(file_id, filename)
+
+    @classmethod
+    def evict(cls, file_ids: list[str]) -> None:
+        with cls.lock:
+            for file_id in file_ids:
+                cls._cache.pop(file_id, None)
+        if FILE_NAME_CACHE_REDIS and file_ids:
+            RedisClient.get_instance().delete(
+                *(f"{cls._prefix}:{file_id}" for file_id in file_ids)
+            )
+
+
 class AssistantMessage:
     _ctypes = (
         "file_citation",
@@ -41,39 +142,73 @@ class AssistantMessage:
         for c in self._ctypes:
             if hasattr(item, c):
                 citation = getattr(item, c)
-                reference = self.client.files.retrieve(citation.file_id)
-                return reference.filename
+                filename = FileNameCache.get(citation.file_id)
+                if filename is None:
+                    reference = self.client.files.retrieve(citation.file_id)
+                    filename = reference.filename
+                    FileNameCache.set(citation.file_id, filename)
+                return filename
 
         raise LookupError()
 
-    def __call__(self, message):
+    def rewrite(self, text) -> str:
+        """
+        Replaces the citation markers of a text content with [n] references in a
+        single pass over the body, using the annotation offsets; followed by the
+        list of cited documents
+        """
+        body = text.value
         citations = {}
+        parts = []
+        pos = 0
 
-        for m in message:
-            for c in m.content:
-                body = c.text.value
+        for a in sorted(text.annotations, key=lambda a: a.start_index or 0):
+            try:
+                document = self[a]
+            except LookupError:
+                continue
+
+            start = a.start_index
+            if start is None or body[start : a.end_index] != a.text:
+                # offsets don't point at the marker; find it after the last one
+                start = body.find(a.text, pos)
+            if start < pos:
+                continue
+
+            refn = citations.setdefault(document, len(citations) + 1)
+            parts.append(body[pos:start])
+            parts.append(f" [{refn}]")
+            pos = start + len(a.text)
 
-                for a in c.text.annotations:
-                    try:
-                        document = self[a]
-                    except LookupError:
-                        continue
-                    refn = citations.setdefault(document, len(citations) + 1)
-                    body = body.replace(a.text, f" [{refn}]")
+        parts.append(body[pos:])
 
-                if citations:
-                    iterable = (f"[{y}] {x}" for (x, y) in citations.items())
-                    citestr = "\n\n{}".format("\n".join(iterable))
-                    citations.clear()
-                else:
-                    citestr = ""
+        if citations:
+            iterable = (f"[{y}] {x}" for (x, y) in citations.items())
+            parts.append("\n\n{}".format("\n".join(iterable)))
 
-                yield f"{body}{citestr}"
+        return "".join(parts)
+
+    def __call__(self, message):
+        for m in message:
+            for c in m.content:
+                yield self.rewrite(c.text)
 
     def to_string(self, message):
         return "\n".join(self(message))
 
 
+# what locking a session writes; everything but the uploads (local_fpaths)
+_LOCKED_SESSION_FIELDS = [
+    "document_ids",
+    "document_names",
+    "document_hashes",
+    "vector_store_id",
+    "assistant_id",
+    "thread_id",
+    "status",
+]
+
+
 class OpenAIFileAssistant:
     _tools = [
         {
@@ -87,7 +222,9 @@ class OpenAIFileAssistant:
             for i in err.message.split(". "):
                 if i.startswith("Please try again in"):
                     (*_, wait) = i.split()
-                    return pd.to_timedelta(wait).total_seconds()
+                    seconds = parse_duration(wait.rstrip("."))
+                    if seconds is not None:
+                        return seconds
 
         raise TypeError(err.code)
 
@@ -98,74 +235,254 @@ class OpenAIFileAssistant:
         instructions: str = None,
         retries=2,
         model="gpt-4o-mini",
+        client: OpenAI = None,
+        touch: bool = True,
     ):
-        curr_session: OpenAISessionState = FileSearchSession.get(session_id)
+        # touch=False reads the session without keeping it alive (the sweeper)
+        curr_session: OpenAISessionState = FileSearchSession.get(session_id, touch)
         if not curr_session:
             raise ValueError("Session not found")
         self.retries = retries
-        self.client = OpenAI(api_key=openai_key)
+        self.client = client or rate_limited_client(openai_key, model)
+        self.limiter = RateLimiter(
+            "openai", openai_key, model, rpm=OPENAI_RATE_LIMIT_RPM
+        )
+        # openai files are only visible to the key's account
+        self.documents = DocumentIndex("openai", openai_key)
         self.parser = AssistantMessage(self.client)
 
-        self.documents: list[FileObject] = []
+        self.document_ids: list[str] = []
+        self.vector_store_id: Optional[str] = None
         if curr_session.status == SessionStatusEnum.locked:
             logger.info(
-                f"Resuming session {curr_session.id}; retrieving references to openai & loading them in memory"
+                f"Resuming session {curr_session.id}; retrieving the assistant & thread from openai"
             )
-            self.documents = [
-                self.client.files.retrieve(doc_id)
-                for doc_id in curr_session.document_ids
-            ]
-            self.assistant = self.client.beta.assistants.retrieve(
-                curr_session.assistant_id
-            )
-            self.thread = self.client.beta.threads.retrieve(curr_session.thread_id)
+            # attachments only need the ids; filenames come from the session
+            self.document_ids = list(curr_session.document_ids)
+            self.vector_store_id = curr_session.vector_store_id
+            with ThreadPoolExecutor(max_workers=2) as pool:
+                assistant = pool.submit(
+                    self.client.beta.assistants.retrieve, curr_session.assistant_id
+                )
+                thread = pool.submit(
+                    self.client.beta.threads.retrieve, curr_session.thread_id
+                )
+                self.assistant = assistant.result()
+                self.thread = thread.result()
         else:
             logger.info(
                 "Uploading documents to openai for the first time; setting the session to locked"
             )
-            for file_path in curr_session.local_fpaths:
-                with Path(file_path).open("rb") as fp:
-                    uploaded_doc = self.client.files.create(
-                        file=fp,
-                        purpose="assistants",
-                    )
-                    self.documents.append(uploaded_doc)
-
-            curr_session.document_ids = [
-                uploaded_doc.id for uploaded_doc in self.documents
-            ]
-
-            self.assistant: Assistant = self.client.beta.assistants.create(
-                model=model,
-                temperature=1e-6,
-                tools=self._tools,
-                instructions=instructions,
-                name=f"Dalgo_asst_{datetime.now().strftime('%y_%m_%d__%H_%M_%S')}",
+            documents = self._upload_documents(
+                curr_session.id,
+                curr_session.local_fpaths,
+                curr_session.document_hashes or {},
             )
-            curr_session.assistant_id = self.assistant.id
+            # files with the same content are uploaded (& attached) once
+            self.document_ids = list(dict.fromkeys(file_id for file_id, _ in documents))
+            document_hashes = {
+                file_id: digest for file_id, digest in documents if digest
+            }
+
+            self.assistant: Optional[Assistant] = None
+            self.thread: Optional[Thread] = None
+            try:
+                self.vector_store_id = self._create_vector_store(
+                    curr_session.id, self.document_ids
+                )
+                self.assistant = self.client.beta.assistants.create(
+                    model=model,
+                    temperature=1e-6,
+                    tools=self._tools,
+                    tool_resources={
+                        "file_search": {"vector_store_ids": [self.vector_store_id]}
+                    },
+                    instructions=instructions,
+                    name=f"Dalgo_asst_{datetime.now().strftime('%y_%m_%d__%H_%M_%S')}",
+                )
+                self.thread = self.client.beta.threads.create()
+
+                curr_session.document_ids = self.document_ids
+                curr_session.document_names = {}
+                for (file_id, _), fpath in zip(documents, curr_session.local_fpaths):
+                    curr_session.document_names.setdefault(file_id, Path(fpath).name)
+                curr_session.document_hashes = {
+                    **(curr_session.document_hashes or {}),
+                    **document_hashes,
+                }
+                curr_session.vector_store_id = self.vector_store_id
+                curr_session.assistant_id = self.assistant.id
+                curr_session.thread_id = self.thread.id
+
+                # update in redis; local_fpaths isn't rewritten so uploads appended
+                # while the documents went to openai aren't lost (nor their files)
+                curr_session.status = SessionStatusEnum.locked
+                if not FileSearchSession.update(
+                    curr_session.id, curr_session, _LOCKED_SESSION_FIELDS
+                ):
+                    raise ValueError("Session was closed while it was being set up")
+            except Exception:
+                # nothing set up for the session is left behind on openai
+                if self.thread:
+                    self._delete_quietly(
+                        self.client.beta.threads.delete, self.thread.id
+                    )
+                if self.assistant:
+                    self._delete_quietly(
+                        self.client.beta.assistants.delete, self.assistant.id
+                    )
+                if self.vector_store_id:
+                    self._delete_quietly(
+                        self.client.beta.vector_stores.delete, self.vector_store_id
+                    )
+                self._delete_documents(
+                    self.documents.released(
+                        self.document_ids, document_hashes, curr_session.id
+                    )
+                )
+                raise
 
-            self.thread: Thread = self.client.beta.threads.create()
-            curr_session.thread_id = self.thread.id
+        FileNameCache.seed(curr_session.document_names or {})
+        self.session = curr_session
 
-            # update in redis
-            curr_session.status = SessionStatusEnum.locked
-            FileSearchSession.set(curr_session.id, curr_session)
+    def _create_vector_store(self, session_id: str, document_ids: list[str]) -> str:
+        """
+        One vector store for the whole session, indexed once here and attached to
+        the assistant, so queries don't re-attach (& re-index) every file
+        """
+        options = {}
+        if VECTOR_STORE_EXPIRY_DAYS > 0 and SESSION_TTL > 0:
+            options["expires_after"] = {
+                "anchor": "last_active_at",
+                "days": VECTOR_STORE_EXPIRY_DAYS,
+            }
+        vector_store = self.client.beta.vector_stores.create(
+            name=f"Dalgo_vs_{session_id}", **options
+        )
+        try:
+            batch = self.client.beta.vector_stores.file_batches.create_and_poll(
+                vector_store_id=vector_store.id, file_ids=document_ids
+            )
+        except Exception:
+            self.client.beta.vector_stores.delete(vector_store.id)
+            raise
+
+        if batch.status != "completed" or batch.file_counts.failed:
+            logger.warning(
+                "Vector store %s indexing ended as %s; %d of %d file(s) failed",
+                vector_store.id,
+                batch.status,
+                batch.file_counts.failed,
+                batch.file_counts.total,
+            )
+        return vector_store.id
+
+    def _upload_documents(
+        self, session_id: str, fpaths: list[str], document_hashes: dict[str, str]
+    ) -> list[tuple[str, Optional[str]]]:
+        """
+        Uploads the files concurrently, OPENAI_UPLOAD_CONCURRENCY at a time, in the
+        order given; a file whose content is already on openai (uploaded by another
+        session with this key) is reused instead. Returns the file id & content
+        hash of each. If any upload fails the files taken so far are released (and
+        deleted unless shared) so nothing is orphaned on openai; the first error
+        is raised
+        """
+
+        def upload(fpath: str) -> tuple[str, Optional[str]]:
+            digest = document_hashes.get(fpath) or file_sha256(fpath)
+            file_id = self.documents.acquire(digest, session_id) if digest else None
+            if file_id:
+                logger.info("Reusing openai file %s for %s", file_id, fpath)
+                return file_id, digest
+
+            with Path(fpath).open("rb") as fp:
+                uploaded = self.client.files.create(file=fp, purpose="assistants").id
+            if not digest:
+                return uploaded, None
+            file_id = self.documents.acquire(digest, session_id, uploaded)
+            if file_id != uploaded:
+                # an identical upload was indexed first; keep that one
+                self._delete_documents([uploaded])
+            return file_id, digest
+
+        documents: list[tuple[str, Optional[str]]] = []
+        errors: list[Exception] = []
+        workers = max(1, min(OPENAI_UPLOAD_CONCURRENCY, len(fpaths)))
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            for future in [pool.submit(upload, fpath) for fpath in fpaths]:
+                try:
+                    documents.append(future.result())
+                except Exception as err:
+                    errors.append(err)
+
+        if errors:
+            logger.error(
+                "%d of %d upload(s) to openai failed; cleaning up the rest",
+                len(errors),
+                len(fpaths),
+            )
+            self._delete_documents(
+                self.documents.released(
+                    [file_id for file_id, _ in documents],
+                    {file_id: digest for file_id, digest in documents if digest},
+                    session_id,
+                )
+            )
+            raise errors[0]
+        return documents
 
-        self.session = curr_session
+    @staticmethod
+    def _delete_quietly(delete: Callable[[str], object], resource_id: str) -> None:
+        """Best effort delete, used to clean up after a failed setup"""
+        try:
+            delete(resource_id)
+        except Exception as err:
+            logger.error("Failed to delete openai resource %s: %s", resource_id, err)
 
-    def query(self, content):
+    @staticmethod
+    def _delete_if_exists(delete: Callable[[str], object], resource_id: str) -> None:
+        """Delete that treats a resource openai no longer has as already deleted"""
+        try:
+            delete(resource_id)
+        except NotFoundError:
+            logger.info("openai resource %s is already deleted", resource_id)
+
+    def _delete_documents(self, document_ids: list[str]) -> None:
+        """Best effort concurrent delete, used to clean up after a failed setup"""
+
+        def delete(document_id: str) -> None:
+            try:
+                self.client.files.delete(document_id)
+            except Exception as err:
+                logger.error("Failed to delete openai file %s: %s", document_id, err)
+
+        if not document_ids:
+            return
+        workers = min(OPENAI_UPLOAD_CONCURRENCY, len(document_ids))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(delete, document_ids))
+
+    def query(self, content, thread_id: str = None):
+        thread_id = thread_id or self.thread.id
         message = self.client.beta.threads.messages.create(
-            self.thread.id,
+            thread_id,
             role="user",
             content=content,
-            attachments=[
-                {"tools": self._tools, "file_id": doc.id} for doc in self.documents
-            ],
+            # sessions locked before vector stores were used still attach the files
+            attachments=(
+                []
+                if self.vector_store_id
+                else [
+                    {"tools": self._tools, "file_id": doc_id}
+                    for doc_id in self.document_ids
+                ]
+            ),
         )
 
         for i in range(self.retries):
             run = self.client.beta.threads.runs.create_and_poll(
-                thread_id=self.thread.id,
+                thread_id=thread_id,
                 assistant_id=self.assistant.id,
             )
             if run.status == "completed":
@@ -174,28 +491,65 @@ class OpenAIFileAssistant:
 
             rest = math.ceil(self.parse_wait_time(run.last_error))
             logger.warning("Sleeping %ds", rest)
+            self.limiter.pause(rest)  # the other workers on this key back off too
             time.sleep(rest)
         else:
             raise TimeoutError("Message retries exceeded")
 
         messages = self.client.beta.threads.messages.list(
-            thread_id=self.thread.id,
+            thread_id=thread_id,
             run_id=run.id,
         )
         self.client.beta.threads.messages.delete(
             message_id=message.id,
-            thread_id=self.thread.id,
+            thread_id=thread_id,
         )
 
         return self.parser.to_string(messages)
 
+    def query_independently(
+        self,
+        contents: list[str],
+        max_concurrency: int,
+        on_answer: Callable[[int, str], None] = None,
+    ):
+        """
+        Answers queries that don't depend on each other concurrently; each one on
+        its own short lived thread. Answers are returned in the order of contents;
+        on_answer(index, answer) is called as soon as each one is ready
+        """
+
+        def answer(index, content):
+            thread: Thread = self.client.beta.threads.create()
+            try:
+                response = self.query(content, thread_id=thread.id)
+            finally:
+                self.client.beta.threads.delete(thread.id)
+            if on_answer:
+                on_answer(index, response)
+            return response
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as pool:
+            return list(pool.map(answer, range(len(contents)), contents))
+
     def close(self):
         logger.info("Closing the session %s", self.session.id)
-        for doc in self.documents:
-            self.client.files.delete(doc.id)
+        # files other open sessions uploaded too are kept for them
+        for doc_id in self.documents.released(
+            self.document_ids, self.session.document_hashes or {}, self.session.id
+        ):
+            self._delete_if_exists(self.client.files.delete, doc_id)
+        FileNameCache.evict(self.document_ids)
         self.client.beta.threads.delete(self.thread.id)
         self.client.beta.assistants.delete(self.assistant.id)
-        for local_fpath in self.session.local_fpaths:
-            Path(local_fpath).unlink()
+        if self.vector_store_id:
+            # may have expired already, or been deleted by an earlier close attempt
+            self._delete_if_exists(
+                self.client.beta.vector_stores.delete, self.vector_store_id
+            )
+        # uploads may have been appended since the session was read
+        session = FileSearchSession.get(self.session.id, touch=False) or self.session
+        for local_fpath in session.local_fpaths:
+            Path(local_fpath).unlink(missing_ok=True)
         # remove from redis
         FileSearchSession.remove(self.session.id)
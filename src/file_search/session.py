@@ -1,9 +1,15 @@
-import json
+import os
+import time
 from typing import Dict, Optional
 from enum import Enum
 from pydantic import BaseModel
+from redis.exceptions import ResponseError
 
-from config.redis_client import RedisClient
+from config.redis_client import AsyncRedisClient, RedisClient, registered_script
+
+
+# session ids are uuid4s; their keys carry no prefix
+_SESSION_KEY_PATTERN = "????????-????-????-????-????????????"
 
 
 class SessionStatusEnum(str, Enum):
@@ -15,33 +21,327 @@ class OpenAISessionState(BaseModel):
     id: str
     local_fpaths: list[str]
     document_ids: Optional[list[str]] = []
+    document_names: Optional[dict[str, str]] = {}  # document id -> filename
+    # document id (or local path) -> sha256 of the content; keys the answer cache
+    document_hashes: Optional[dict[str, str]] = {}
     thread_id: Optional[str] = None
     assistant_id: Optional[str] = None
+    vector_store_id: Optional[str] = None
     status: SessionStatusEnum = SessionStatusEnum.active
 
 
+# sessions unused for this long are released by the sweeper; 0 keeps them forever
+SESSION_TTL = int(os.getenv("FILE_SEARCH_SESSION_TTL_SECS", 24 * 60 * 60))
+# the redis key outlives the ttl by this much so the sweeper can still read what
+# the session holds; past it the key expires even if the sweeper isn't running
+SESSION_KEY_GRACE = int(os.getenv("FILE_SEARCH_SESSION_GRACE_SECS", 24 * 60 * 60))
+# sorted set of session ids scored by when they were last used
+SESSION_INDEX = "file_search_sessions"
+
+
+# a session is a hash of its scalar fields, with a list / hash per collection
+# field under "{session_id}:{field}"; appending a document is a single RPUSH
+_LIST_FIELDS = ("local_fpaths", "document_ids")
+_HASH_FIELDS = ("document_names", "document_hashes")
+_SCALAR_FIELDS = ("id", "thread_id", "assistant_id", "vector_store_id", "status")
+
+
+def _key_expiry() -> Optional[int]:
+    return SESSION_TTL + SESSION_KEY_GRACE if SESSION_TTL > 0 else None
+
+
+def _keys(key: str) -> list[str]:
+    return [key, *(f"{key}:{field}" for field in _LIST_FIELDS + _HASH_FIELDS)]
+
+
+def _queue_expire(pipe, key: str, index: bool = True) -> None:
+    if _key_expiry():
+        for session_key in _keys(key):
+            pipe.expire(session_key, _key_expiry())
+    if index:
+        pipe.zadd(SESSION_INDEX, {key: time.time()})
+
+
+def _queue_set(pipe, key: str, value: OpenAISessionState, index=True) -> None:
+    """Replaces the whole session; queue on a transaction (MULTI) pipeline"""
+    state = value.model_dump(mode="json")
+    pipe.delete(*_keys(key))
+    pipe.hset(
+        key,
+        mapping={f: state[f] for f in _SCALAR_FIELDS if state[f] is not None},
+    )
+    for field in _LIST_FIELDS:
+        if state[field]:
+            pipe.rpush(f"{key}:{field}", *state[field])
+    for field in _HASH_FIELDS:
+        if state[field]:
+            pipe.hset(f"{key}:{field}", mapping=state[field])
+    _queue_expire(pipe, key, index)
+
+
+def _queue_update(pipe, key: str, value: OpenAISessionState, fields: list[str]):
+    """
+    Writes only the given fields of the session (lists are replaced, hashes merged);
+    the rest, e.g. uploads appended meanwhile, are left as they are. Queue on a
+    MULTI pipeline
+    """
+    state = value.model_dump(mode="json")
+    for field in fields:
+        if field in _SCALAR_FIELDS:
+            if state[field] is None:
+                pipe.hdel(key, field)
+            else:
+                pipe.hset(key, field, state[field])
+        elif field in _LIST_FIELDS:
+            pipe.delete(f"{key}:{field}")
+            if state[field]:
+                pipe.rpush(f"{key}:{field}", *state[field])
+        elif state[field]:
+            pipe.hset(f"{key}:{field}", mapping=state[field])
+    _queue_expire(pipe, key)
+
+
+# KEYS: session, list appended to, document_hashes, index, every key of the session
+# ARGV: session id, active status, value, digest ('' if none), key expiry ('' if
+# none), now, '1' to create the session if it doesn't exist
+# Adds an upload to the session; returns 0 (& writes nothing) if the session
+# doesn't exist and isn't to be created, e.g. it was closed meanwhile
+_APPEND_SCRIPT = """
+if ARGV[7] ~= '1' and redis.call('EXISTS', KEYS[1]) == 0 then
+    return 0
+end
+redis.call('HSET', KEYS[1], 'id', ARGV[1])
+redis.call('HSETNX', KEYS[1], 'status', ARGV[2])
+redis.call('RPUSH', KEYS[2], ARGV[3])
+if ARGV[4] ~= '' then
+    redis.call('HSET', KEYS[3], ARGV[3], ARGV[4])
+end
+if ARGV[5] ~= '' then
+    for i = 5, #KEYS do
+        redis.call('EXPIRE', KEYS[i], ARGV[5])
+    end
+end
+redis.call('ZADD', KEYS[4], ARGV[6], KEYS[1])
+return 1
+"""
+
+
+def _append_args(key: str, field: str, value: str, digest: str, create: bool):
+    keys = [key, f"{key}:{field}", f"{key}:document_hashes", SESSION_INDEX]
+    args = [
+        key,
+        SessionStatusEnum.active.value,
+        value,
+        digest or "",
+        _key_expiry() or "",
+        time.time(),
+        "1" if create else "0",
+    ]
+    return {"keys": keys + _keys(key), "args": args}
+
+
+def _queue_get(pipe, key: str, touch: bool) -> None:
+    pipe.hgetall(key)
+    for field in _LIST_FIELDS:
+        pipe.lrange(f"{key}:{field}", 0, -1)
+    for field in _HASH_FIELDS:
+        pipe.hgetall(f"{key}:{field}")
+    if touch and _key_expiry():
+        # using a session keeps it alive; never re-adds a removed one
+        _queue_expire(pipe, key, index=False)
+        pipe.zadd(SESSION_INDEX, {key: time.time()}, xx=True)
+
+
+def _decode(v: bytes) -> str:
+    return v.decode()
+
+
+def _parse(results: list) -> Optional[OpenAISessionState]:
+    """Session from the results of _queue_get; None if there is no such session"""
+    scalars, *collections = results[: 1 + len(_LIST_FIELDS) + len(_HASH_FIELDS)]
+    if not scalars:
+        return None
+    state = {_decode(f): _decode(v) for f, v in scalars.items()}
+    lists, hashes = collections[: len(_LIST_FIELDS)], collections[len(_LIST_FIELDS) :]
+    for field, items in zip(_LIST_FIELDS, lists):
+        # concurrent uploads of the same content may both have appended it
+        state[field] = list(dict.fromkeys(_decode(item) for item in items))
+    for field, mapping in zip(_HASH_FIELDS, hashes):
+        state[field] = {_decode(k): _decode(v) for k, v in mapping.items()}
+    return OpenAISessionState.model_validate(state)
+
+
+def _is_legacy(results: list) -> bool:
+    # sessions stored as a single json string before; HGETALL fails on them
+    return isinstance(results[0], ResponseError)
+
+
 class FileSearchSession:
+    """
+    Sessions in redis. Every read & write refreshes the session's ttl; the sweeper
+    (sweep_file_search_sessions) releases sessions idle for FILE_SEARCH_SESSION_TTL_SECS.
+    Sessions still stored as json (from before) are converted on their first read
+    """
+
     _redis_client = RedisClient.get_instance()
 
     @classmethod
     def set(cls, key: str, value: OpenAISessionState) -> OpenAISessionState:
-        cls._redis_client.set(key, json.dumps(value.model_dump()))
+        pipe = cls._redis_client.pipeline()
+        _queue_set(pipe, key, value)
+        pipe.execute()
         return value
 
     @classmethod
-    def get(cls, key) -> OpenAISessionState:
-        result = cls._redis_client.get(key)
-        if result:
-            return OpenAISessionState(**json.loads(result))
-        return None
+    def update(cls, key: str, value: OpenAISessionState, fields: list[str]) -> bool:
+        """
+        Writes only `fields` of the session, so nothing appended concurrently is
+        lost. False (& nothing written) if the session is gone, e.g. closed
+        """
+
+        def write(pipe) -> bool:
+            if not pipe.exists(key):
+                return False
+            pipe.multi()
+            _queue_update(pipe, key, value, fields)
+            return True
+
+        return cls._redis_client.transaction(write, key, value_from_callable=True)
+
+    @classmethod
+    def append(
+        cls, key: str, field: str, value: str, digest: str = None, create=False
+    ) -> bool:
+        """
+        Atomically adds an upload (to local_fpaths or document_ids) with its content
+        hash; concurrent uploads to the same session don't overwrite each other.
+        Returns False (& adds nothing) if the session doesn't exist, unless `create`
+        """
+        script = registered_script(cls._redis_client, _APPEND_SCRIPT)
+        return bool(script(**_append_args(key, field, value, digest, create)))
+
+    @classmethod
+    def get(cls, key, touch: bool = True) -> OpenAISessionState:
+        pipe = cls._redis_client.pipeline(transaction=False)
+        _queue_get(pipe, key, touch)
+        results = pipe.execute(raise_on_error=False)
+        if not _is_legacy(results):
+            return _parse(results)
+
+        session = OpenAISessionState.model_validate_json(cls._redis_client.get(key))
+        pipe = cls._redis_client.pipeline()
+        _queue_set(pipe, key, session, index=touch)
+        pipe.execute()
+        return session
 
     @classmethod
     def get_dict(cls, key) -> Dict:
-        result = cls._redis_client.get(key)
-        if result:
-            return json.loads(result)
-        return None
+        session = cls.get(key)
+        return session.model_dump(mode="json") if session else None
 
     @classmethod
     def remove(cls, key) -> None:
-        cls._redis_client.delete(key)
+        pipe = cls._redis_client.pipeline()
+        pipe.delete(*_keys(key))
+        pipe.zrem(SESSION_INDEX, key)
+        pipe.execute()
+
+    @classmethod
+    def unindex(cls, key) -> None:
+        cls._redis_client.zrem(SESSION_INDEX, key)
+
+    @classmethod
+    def last_used(cls, key) -> Optional[float]:
+        return cls._redis_client.zscore(SESSION_INDEX, key)
+
+    @classmethod
+    def expired(cls, count: int) -> list[str]:
+        """Ids of (up to count) sessions idle for longer than the ttl, oldest first"""
+        if SESSION_TTL <= 0:
+            return []
+        return [
+            key.decode()
+            for key in cls._redis_client.zrangebyscore(
+                SESSION_INDEX, "-inf", time.time() - SESSION_TTL, start=0, num=count
+            )
+        ]
+
+    @classmethod
+    def exists(cls, keys: list[str]) -> list[bool]:
+        pipe = cls._redis_client.pipeline()
+        for key in keys:
+            pipe.exists(key)
+        return [bool(found) for found in pipe.execute()]
+
+    @classmethod
+    def adopt(cls, count: int) -> int:
+        """
+        Indexes sessions written before they were indexed (& without a ttl), one
+        SCAN batch at a time; the cursor is kept in redis across calls. They are
+        treated as last used now. Returns the no of sessions adopted
+        """
+        cursor_key = f"{SESSION_INDEX}:scan_cursor"
+        cursor = int(cls._redis_client.get(cursor_key) or 0)
+        cursor, keys = cls._redis_client.scan(
+            cursor, match=_SESSION_KEY_PATTERN, count=count, _type="string"
+        )
+        cls._redis_client.set(cursor_key, cursor)
+
+        pipe = cls._redis_client.pipeline()
+        for key in keys:
+            pipe.zadd(SESSION_INDEX, {key: time.time()}, nx=True)
+        adopted = [key for key, added in zip(keys, pipe.execute()) if added]
+        if adopted and _key_expiry():
+            pipe = cls._redis_client.pipeline()
+            for key in adopted:
+                pipe.expire(key, _key_expiry(), nx=True)
+            pipe.execute()
+        return len(adopted)
+
+
+class AsyncFileSearchSession:
+    """
+    asyncio version of FileSearchSession with the same api, for the fastapi handlers.
+    FileSearchSession stays in use by the celery workers
+    """
+
+    @classmethod
+    async def set(cls, key: str, value: OpenAISessionState) -> OpenAISessionState:
+        pipe = AsyncRedisClient.get_instance().pipeline()
+        _queue_set(pipe, key, value)
+        await pipe.execute()
+        return value
+
+    @classmethod
+    async def append(
+        cls, key: str, field: str, value: str, digest: str = None, create=False
+    ) -> bool:
+        script = registered_script(AsyncRedisClient.get_instance(), _APPEND_SCRIPT)
+        return bool(await script(**_append_args(key, field, value, digest, create)))
+
+    @classmethod
+    async def get(cls, key, touch: bool = True) -> OpenAISessionState:
+        client = AsyncRedisClient.get_instance()
+        pipe = client.pipeline(transaction=False)
+        _queue_get(pipe, key, touch)
+        results = await pipe.execute(raise_on_error=False)
+        if not _is_legacy(results):
+            return _parse(results)
+
+        session = OpenAISessionState.model_validate_json(await client.get(key))
+        pipe = client.pipeline()
+        _queue_set(pipe, key, session, index=touch)
+        await pipe.execute()
+        return session
+
+    @classmethod
+    async def get_dict(cls, key) -> Dict:
+        session = await cls.get(key)
+        return session.model_dump(mode="json") if session else None
+
+    @classmethod
+    async def remove(cls, key) -> None:
+        pipe = AsyncRedisClient.get_instance().pipeline()
+        pipe.delete(*_keys(key))
+        pipe.zrem(SESSION_INDEX, key)
+        await pipe.execute()
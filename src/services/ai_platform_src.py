@@ -2,19 +2,51 @@ import os
 import logging
 from pydantic import BaseModel
 import time
-from typing import Optional
+import random
+import asyncio
+import threading
+import uuid
+from collections import OrderedDict
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional
 
 from fastapi import UploadFile, HTTPException
-from src.utils.http_helper import http_post, http_get, http_delete
+from src.utils.uploads import iter_upload, check_upload_size
+from src.utils.metrics import track_platform_call, PLATFORM_POLLS
+from src.utils.rate_limiter import RateLimiter
+from src.services.document_index import DocumentIndex
+from src.utils.http_helper import (
+    http_post,
+    http_get_with_headers,
+    http_delete,
+    ahttp_post,
+    ahttp_get_with_headers,
+)
 
 logger = logging.getLogger()
 
 API_KEY = os.getenv("AI_PLATFORM_API_KEY")
 BASE_URI = os.getenv("AI_PLATFORM_BASE_URI")
-POLLING_INTERVAL = int(os.getenv("AI_PLATFORM_POLLING_INTERVAL", 5))
+POLLING_INTERVAL = float(
+    os.getenv(
+        "AI_PLATFORM_POLLING_INTERVAL_SECS",
+        os.getenv("AI_PLATFORM_POLLING_INTERVAL", 5),
+    )
+)  # max interval between two polls
+POLLING_FIRST_DELAY = float(os.getenv("AI_PLATFORM_POLLING_FIRST_DELAY_SECS", 1))
+POLLING_BACKOFF = float(os.getenv("AI_PLATFORM_POLLING_BACKOFF", 1.5))
+POLLING_JITTER = float(os.getenv("AI_PLATFORM_POLLING_JITTER", 0.2))
 TIMEOUT = int(os.getenv("AI_PLATFORM_REQUEST_TIMEOUT_SECS", 120))
+COLLECTION_PENDING_STATES = ["PENDING", "PROCESSING"]
 PROJECT_ID = int(os.getenv("PROJECT_ID", 1))
 HEADERS = {"x-api-key": f"ApiKey {API_KEY}"}
+# shared by every worker; starts at this many requests/min until the platform's
+# rate limit headers say otherwise
+RATE_LIMIT_RPM = int(os.getenv("AI_PLATFORM_RATE_LIMIT_RPM", 600))
+RATE_LIMITER = RateLimiter("ai_platform", API_KEY, rpm=RATE_LIMIT_RPM)
+# documents already on the platform, by content; shared across sessions
+DOCUMENT_INDEX = DocumentIndex("ai_platform", API_KEY)
 
 if not BASE_URI:
     raise HTTPException(
@@ -42,6 +74,155 @@ class CreateAndStartThreadPayload(BaseModel):
     project_id: int = PROJECT_ID
 
 
+class PollingStrategy(BaseModel):
+    """
+    Wait between two status polls of a platform job/thread.
+    First poll is made quickly, then the wait grows exponentially up to
+    max_interval. Every wait is jittered (+/- jitter fraction) so tasks started
+    together don't poll in lockstep. A Retry-After/eta hint from the platform wins.
+    """
+
+    first_delay: float = POLLING_FIRST_DELAY
+    backoff: float = POLLING_BACKOFF
+    max_interval: float = POLLING_INTERVAL
+    jitter: float = POLLING_JITTER
+    timeout: float = TIMEOUT
+
+    def delay(self, attempt: int, hint: Optional[float] = None) -> float:
+        if hint is not None:
+            wait = hint
+        else:
+            wait = min(self.first_delay * self.backoff**attempt, self.max_interval)
+        if self.jitter:
+            wait *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(wait, 0)
+
+
+DEFAULT_POLLING_STRATEGY = PollingStrategy()
+
+# no of status requests made per job/thread id; latest POLL_COUNTS_SIZE are kept
+POLL_COUNTS_SIZE = 1000
+poll_counts: OrderedDict[str, int] = OrderedDict()
+_poll_counts_lock = threading.Lock()
+
+
+def get_poll_count(job_or_thread_id: str) -> Optional[int]:
+    """No of status requests it took to get a terminal response for the job/thread"""
+    return poll_counts.get(job_or_thread_id)
+
+
+def _record_poll_count(function: str, key: str, polls: int, elapsed: float):
+    PLATFORM_POLLS.labels(function).observe(polls)
+    with _poll_counts_lock:
+        poll_counts[key] = polls
+        poll_counts.move_to_end(key)
+        while len(poll_counts) > POLL_COUNTS_SIZE:
+            poll_counts.popitem(last=False)
+    logger.info("Polled %s %d times in %.2f seconds", key, polls, elapsed)
+
+
+def _retry_hint(res: dict, headers: dict) -> Optional[float]:
+    """
+    Seconds the platform asked us to wait before polling again, if it said so; via
+    the Retry-After header or a retry_after/eta in the response data
+    """
+    candidates = [headers.get("Retry-After")]
+    data = res.get("data") if isinstance(res, dict) else None
+    if isinstance(data, dict):
+        candidates += [data.get("retry_after"), data.get("eta")]
+
+    for value in candidates:
+        if value is None or value == "":
+            continue
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            pass
+        try:
+            when = parsedate_to_datetime(value)
+        except (TypeError, ValueError):
+            try:
+                when = datetime.fromisoformat(value)
+            except (TypeError, ValueError):
+                continue
+        if when.tzinfo is None:
+            when = when.replace(tzinfo=timezone.utc)
+        return (when - datetime.now(timezone.utc)).total_seconds()
+    return None
+
+
+def _poll(
+    status_url: str,
+    is_pending: Callable[[dict], bool],
+    function: str,
+    key: str,
+    strategy: PollingStrategy,
+) -> Optional[dict]:
+    """
+    Polls status_url as per the strategy till is_pending is False or it times out.
+    Returns the last response
+    """
+    start_time = time.monotonic()
+    polls = 0
+    hint = None
+    res = None
+    while True:
+        remaining = strategy.timeout - (time.monotonic() - start_time)
+        time.sleep(min(strategy.delay(polls, hint), max(remaining, 0)))
+        res, headers = http_get_with_headers(
+            status_url, headers=HEADERS, rate_limiter=RATE_LIMITER
+        )
+        polls += 1
+
+        if not is_pending(res):
+            break
+        if time.monotonic() - start_time > strategy.timeout:
+            break
+        hint = _retry_hint(res, headers)
+
+    _record_poll_count(function, key, polls, time.monotonic() - start_time)
+    return res
+
+
+async def _apoll(
+    status_url: str,
+    is_pending: Callable[[dict], bool],
+    function: str,
+    key: str,
+    strategy: PollingStrategy,
+) -> Optional[dict]:
+    """Non blocking version of _poll"""
+    start_time = time.monotonic()
+    polls = 0
+    hint = None
+    res = None
+    while True:
+        remaining = strategy.timeout - (time.monotonic() - start_time)
+        await asyncio.sleep(min(strategy.delay(polls, hint), max(remaining, 0)))
+        res, headers = await ahttp_get_with_headers(
+            status_url, headers=HEADERS, rate_limiter=RATE_LIMITER
+        )
+        polls += 1
+
+        if not is_pending(res):
+            break
+        if time.monotonic() - start_time > strategy.timeout:
+            break
+        hint = _retry_hint(res, headers)
+
+    _record_poll_count(function, key, polls, time.monotonic() - start_time)
+    return res
+
+
+def _collection_pending(res: dict) -> bool:
+    return res.get("data", {}).get("status") in COLLECTION_PENDING_STATES
+
+
+def _thread_pending(res: dict) -> bool:
+    return res.get("data", {}).get("status") == "processing"
+
+
+@track_platform_call("upload_document")
 def upload_document(file: UploadFile) -> str:
     """
     Uploads a document to the external platform.
@@ -58,7 +239,69 @@ def upload_document(file: UploadFile) -> str:
     # Ensure content_type is set, fallback to 'application/octet-stream' if None
     content_type = file.content_type or "application/octet-stream"
     files = {"src": (file.filename, file.file, content_type)}
-    res = http_post(upload_url, files=files, headers=HEADERS)
+    res = http_post(upload_url, files=files, headers=HEADERS, rate_limiter=RATE_LIMITER)
+
+    if not res or not res.get("data") or not res["data"].get("id"):
+        raise HTTPException(
+            status_code=500,
+            detail=f"Invalid response from document upload API: {res}",
+        )
+    return res["data"]["id"]
+
+
+def _quote_form_data(value: str) -> str:
+    """Escapes a multipart/form-data header parameter (WHATWG style)"""
+    return value.replace("\r", "%0D").replace("\n", "%0A").replace('"', "%22")
+
+
+def _strip_crlf(value: Optional[str]) -> Optional[str]:
+    return value.replace("\r", "").replace("\n", "") if value else value
+
+
+@track_platform_call("upload_document")
+async def aupload_document(file: UploadFile) -> str:
+    """
+    Non blocking version of upload_document. The multipart body is streamed to the
+    platform chunk by chunk straight from the upload, so the file is never buffered
+    fully in memory and the event loop is never blocked on it.
+
+    Args:
+        file: FastAPI UploadFile
+
+    Returns:
+        str: ID of the uploaded document.
+    """
+    check_upload_size(file)
+    upload_url = f"{BASE_URI}/documents/"
+
+    # percent encoded like browsers do, so a crafted name can't break out of the
+    # header into the body
+    content_type = _strip_crlf(file.content_type) or "application/octet-stream"
+    filename = _quote_form_data(file.filename or "upload")
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="src"; filename="{filename}"\r\n'
+        f"Content-Type: {content_type}\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+
+    async def body():
+        yield head
+        async for chunk in iter_upload(file):
+            yield chunk
+        yield tail
+
+    headers = {
+        **HEADERS,
+        "Content-Type": f"multipart/form-data; boundary={boundary}",
+    }
+    if file.size is not None:
+        headers["Content-Length"] = str(len(head) + file.size + len(tail))
+
+    res = await ahttp_post(
+        upload_url, content=body(), headers=headers, rate_limiter=RATE_LIMITER
+    )
 
     if not res or not res.get("data") or not res["data"].get("id"):
         raise HTTPException(
@@ -68,6 +311,7 @@ def upload_document(file: UploadFile) -> str:
     return res["data"]["id"]
 
 
+@track_platform_call("create_collection")
 def create_collection(payload: CollectionCreatePayload) -> str:
     """
     Creates a collection on the external platform.
@@ -79,8 +323,31 @@ def create_collection(payload: CollectionCreatePayload) -> str:
         str: The job ID of the collection creation in progress.
     """
     create_collection_url = f"{BASE_URI}/collections/"
-    res = http_post(create_collection_url, json=payload.model_dump(), headers=HEADERS)
+    res = http_post(
+        create_collection_url,
+        json=payload.model_dump(),
+        headers=HEADERS,
+        rate_limiter=RATE_LIMITER,
+    )
+    return _collection_job_id(res)
+
 
+@track_platform_call("create_collection")
+async def acreate_collection(payload: CollectionCreatePayload) -> str:
+    """
+    Non blocking version of create_collection; to be awaited on an event loop.
+    """
+    create_collection_url = f"{BASE_URI}/collections/"
+    res = await ahttp_post(
+        create_collection_url,
+        json=payload.model_dump(),
+        headers=HEADERS,
+        rate_limiter=RATE_LIMITER,
+    )
+    return _collection_job_id(res)
+
+
+def _collection_job_id(res: dict) -> str:
     if not res or not res.get("data") or not res["data"].get("job_id"):
         raise HTTPException(
             status_code=500,
@@ -89,61 +356,77 @@ def create_collection(payload: CollectionCreatePayload) -> str:
     return res["data"]["job_id"]
 
 
-def poll_collection_job_status(job_id: str) -> dict:
+@track_platform_call("poll_collection_job_status")
+def poll_collection_job_status(
+    job_id: str, strategy: Optional[PollingStrategy] = None
+) -> dict:
     """
     Polls the collection job status.
 
     Args:
         job_id (str): ID of the job to poll.
+        strategy (PollingStrategy): Wait between polls; defaults to env config.
 
     Returns:
         dict: The JSON response having the job details.
     """
+    strategy = strategy or DEFAULT_POLLING_STRATEGY
     status_url = f"{BASE_URI}/collections/jobs/{job_id}"
-    final_res = http_get(status_url, headers=HEADERS)
+    final_res = _poll(
+        status_url, _collection_pending, "poll_collection_job_status", job_id, strategy
+    )
 
-    timeout = TIMEOUT
-    start_time = time.time()
+    return _collection_from_job(job_id, final_res, strategy.timeout)
 
-    while True:
-        if final_res.get("data", {}).get("status") not in ["PENDING", "PROCESSING"]:
-            break
 
-        time.sleep(POLLING_INTERVAL)
-        final_res = http_get(status_url, headers=HEADERS)
+@track_platform_call("poll_collection_job_status")
+async def apoll_collection_job_status(
+    job_id: str, strategy: Optional[PollingStrategy] = None
+) -> dict:
+    """
+    Non blocking version of poll_collection_job_status; waits with asyncio.sleep
+    so many jobs can be polled concurrently on one event loop.
+    """
+    strategy = strategy or DEFAULT_POLLING_STRATEGY
+    status_url = f"{BASE_URI}/collections/jobs/{job_id}"
+    final_res = await _apoll(
+        status_url, _collection_pending, "poll_collection_job_status", job_id, strategy
+    )
+
+    return _collection_from_job(job_id, final_res, strategy.timeout)
 
-        if time.time() - start_time > timeout:
-            break
 
+def _collection_from_job(job_id: str, final_res: dict, timeout: float) -> dict:
     if not final_res:
         raise HTTPException(
             status_code=500,
             detail=f"Something went wrong while polling collection job status for job ID {job_id}. Couldn't fetch the response",
         )
 
-    elif final_res.get("data", {}).get("status") in ["PENDING", "PROCESSING"]:
+    elif _collection_pending(final_res):
         raise HTTPException(
             status_code=500,
             detail=f"Collection job polling timed out after {timeout} seconds",
         )
-    
+
     elif final_res.get("data", {}).get("status") == "FAILED":
         raise HTTPException(
             status_code=500,
             detail=f"Collection job failed: {final_res.get('error_message')}",
         )
-    
+
     elif final_res.get("success") is False:
         raise HTTPException(
             status_code=500,
             detail=f"Failed to fetch collection job status for job ID {job_id}: {final_res.get('error')}",
         )
-    
+
     logger.info(final_res)
 
-    return final_res.get("data", {}).get("collection", {}) 
+    return final_res.get("data", {}).get("collection", {})
 
 
+@track_platform_call("create_and_start_thread")
 def create_and_start_thread(payload: CreateAndStartThreadPayload) -> str:
     """
     Starts a thread to hit the external API for answering a query.
@@ -155,8 +438,31 @@ def create_and_start_thread(payload: CreateAndStartThreadPayload) -> str:
         thread_id (str): The ID of the thread created on the external platform.
     """
     thread_url = f"{BASE_URI}/threads/start"
-    res = http_post(thread_url, json=payload.model_dump(), headers=HEADERS)
+    res = http_post(
+        thread_url,
+        json=payload.model_dump(),
+        headers=HEADERS,
+        rate_limiter=RATE_LIMITER,
+    )
+    return _thread_id(res)
+
+
+@track_platform_call("create_and_start_thread")
+async def acreate_and_start_thread(payload: CreateAndStartThreadPayload) -> str:
+    """
+    Non blocking version of create_and_start_thread; to be awaited on an event loop.
+    """
+    thread_url = f"{BASE_URI}/threads/start"
+    res = await ahttp_post(
+        thread_url,
+        json=payload.model_dump(),
+        headers=HEADERS,
+        rate_limiter=RATE_LIMITER,
+    )
+    return _thread_id(res)
 
+
+def _thread_id(res: dict) -> str:
     if not res or not res.get("data") or not res["data"].get("thread_id"):
         raise HTTPException(
             status_code=500,
@@ -165,46 +471,57 @@ def create_and_start_thread(payload: CreateAndStartThreadPayload) -> str:
     return res["data"]["thread_id"]
 
 
-def poll_thread_result(thread_id: str, interval: int = 30, timeout: int = 120) -> str:
+@track_platform_call("poll_thread_result")
+def poll_thread_result(
+    thread_id: str, strategy: Optional[PollingStrategy] = None
+) -> str:
     """
     Polls the thread result status.
 
     Args:
         thread_id (str): ID of the thread to poll.
-        interval (int): Polling interval in seconds.
-        timeout (int): Maximum time to poll in seconds.
+        strategy (PollingStrategy): Wait between polls; defaults to env config.
 
     Returns:
         str: The result/answer from the thread, or raises HTTPException on timeout.
     """
+    strategy = strategy or DEFAULT_POLLING_STRATEGY
     status_url = f"{BASE_URI}/threads/result/{thread_id}"
-    start_time = time.time()
+    poll_res = _poll(
+        status_url, _thread_pending, "poll_thread_result", thread_id, strategy
+    )
 
-    interval = POLLING_INTERVAL
-    timeout = TIMEOUT
+    return _thread_answer(poll_res, strategy.timeout)
 
-    poll_res = None
-    final_res = None
-    while True:
-        time.sleep(interval)
-        poll_res = http_get(status_url, headers=HEADERS)
 
-        # Adjust the condition below based on your API's response structure
-        if poll_res.get("data", {}).get("status") != "processing":
-            final_res = poll_res
-            break
-        if time.time() - start_time > timeout:
-            break
+@track_platform_call("poll_thread_result")
+async def apoll_thread_result(
+    thread_id: str, strategy: Optional[PollingStrategy] = None
+) -> str:
+    """
+    Non blocking version of poll_thread_result; waits with asyncio.sleep so many
+    threads can be polled concurrently on one event loop.
+    """
+    strategy = strategy or DEFAULT_POLLING_STRATEGY
+    status_url = f"{BASE_URI}/threads/result/{thread_id}"
+    poll_res = await _apoll(
+        status_url, _thread_pending, "poll_thread_result", thread_id, strategy
+    )
 
-    if not final_res:
+    return _thread_answer(poll_res, strategy.timeout)
+
+
+def _thread_answer(poll_res: Optional[dict], timeout: float) -> str:
+    if not poll_res or _thread_pending(poll_res):
         raise HTTPException(
             status_code=500,
-            detail=f"Thread result polling timed out after {timeout} seconds. Last response: {poll_res.get('error')}",
+            detail=f"Thread result polling timed out after {timeout} seconds. Last response: {poll_res.get('error') if poll_res else None}",
         )
 
-    return final_res.get("data", {}).get("response")
+    return poll_res.get("data", {}).get("response")
 
 
+@track_platform_call("delete_document")
 def delete_document(document_id: str) -> bool:
     """
     Deletes a document from the external platform.
@@ -213,7 +530,7 @@ def delete_document(document_id: str) -> bool:
         document_id (str): ID of the document to delete.
     """
     delete_url = f"{BASE_URI}/documents/{document_id}"
-    res = http_delete(delete_url, headers=HEADERS)
+    res = http_delete(delete_url, headers=HEADERS, rate_limiter=RATE_LIMITER)
 
     if not res.get("success", False):
         raise HTTPException(
@@ -0,0 +1,122 @@
+import os
+import re
+import json
+import time
+import hashlib
+import logging
+from pathlib import Path
+from typing import Optional
+
+from config.redis_client import RedisClient
+from src.utils.uploads import file_sha256
+
+logger = logging.getLogger()
+
+ANSWER_CACHE_TTL = int(os.getenv("ANSWER_CACHE_TTL_SECS", 7 * 24 * 60 * 60))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", 100000))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question: str) -> str:
+    """Case, spacing & trailing punctuation don't change what is being asked"""
+    return _WHITESPACE.sub(" ", question).strip().casefold().rstrip("?.! ")
+
+
+class AnswerCache:
+    """
+    Opt-in redis cache of answers, keyed by the content of the documents (not their
+    ids; a re-upload of the same files hits), the assistant prompt, the model and
+    the normalized question. Chained questions are also keyed by the questions
+    asked before them on the thread.
+    Entries expire after ANSWER_CACHE_TTL_SECS; an index sorted by write time
+    evicts the oldest once there are more than ANSWER_CACHE_MAX_ENTRIES.
+    Fails open; if redis is unreachable every question is a miss
+    """
+
+    _redis_client = RedisClient.get_instance()
+    _prefix = "answer_cache"
+    _index = f"{_prefix}:index"
+
+    @classmethod
+    def enabled(cls) -> bool:
+        return ANSWER_CACHE_TTL > 0 and ANSWER_CACHE_MAX_ENTRIES > 0
+
+    @staticmethod
+    def fingerprint(
+        documents: list[str], document_hashes: dict[str, str]
+    ) -> Optional[list[str]]:
+        """
+        Sorted content hashes of the documents (ids or local paths). Local files
+        uploaded before hashes were recorded are hashed here; None if the content
+        of any document is unknown, in which case nothing is cached
+        """
+        hashes = []
+        for document in documents:
+            digest = document_hashes.get(document)
+            if digest is None and Path(document).is_file():
+                digest = file_sha256(document)
+            if digest is None:
+                return None
+            hashes.append(digest)
+        return sorted(hashes)
+
+    @classmethod
+    def keys_for(
+        cls,
+        fingerprint: list[str],
+        instructions: Optional[str],
+        model: str,
+        questions: list[str],
+        chained: bool = False,
+    ) -> list[str]:
+        """Cache key of every question; chained ones include the questions before"""
+        normalized = [normalize_question(q) for q in questions]
+        keys = []
+        for i, question in enumerate(normalized):
+            context = normalized[:i] if chained else []
+            digest = hashlib.sha256(
+                json.dumps(
+                    [fingerprint, instructions, model, context, question]
+                ).encode()
+            ).hexdigest()
+            keys.append(f"{cls._prefix}:{digest}")
+        return keys
+
+    @classmethod
+    def get_many(cls, keys: list[str]) -> list[Optional[str]]:
+        """Cached answers in the order of keys (one MGET); None for a miss"""
+        if not keys:
+            return []
+        try:
+            values = cls._redis_client.mget(keys)
+        except Exception as err:
+            logger.warning("Answer cache unavailable: %s", err)
+            return [None] * len(keys)
+        return [json.loads(value) if value else None for value in values]
+
+    @classmethod
+    def set_many(cls, answers: dict[str, str]) -> None:
+        """Caches the answers (key -> answer), evicting the oldest entries if full"""
+        if not answers:
+            return
+        try:
+            now = time.time()
+            pipe = cls._redis_client.pipeline()
+            for key, answer in answers.items():
+                pipe.set(key, json.dumps(answer), ex=ANSWER_CACHE_TTL)
+            pipe.zadd(cls._index, {key: now for key in answers})
+            # entries past their ttl are gone already
+            pipe.zremrangebyscore(cls._index, "-inf", now - ANSWER_CACHE_TTL)
+            pipe.zcard(cls._index)
+            size = pipe.execute()[-1]
+            if size > ANSWER_CACHE_MAX_ENTRIES:
+                evicted = [
+                    key.decode()
+                    for key, _ in cls._redis_client.zpopmin(
+                        cls._index, size - ANSWER_CACHE_MAX_ENTRIES
+                    )
+                ]
+                cls._redis_client.delete(*evicted)
+        except Exception as err:
+            logger.warning("Failed to cache answers: %s", err)
@@ -0,0 +1,98 @@
+import os
+import json
+import hashlib
+import logging
+from typing import Callable, Optional
+
+from config.redis_client import RedisClient
+from src.services.ai_platform_src import CollectionCreatePayload, TIMEOUT
+
+logger = logging.getLogger()
+
+CACHE_TTL = int(os.getenv("AI_PLATFORM_COLLECTION_CACHE_TTL_SECS", 6 * 60 * 60))
+
+
+class CollectionCache:
+    """
+    Redis cache of the platform collections (llm_service_id) created for a set of
+    documents & instructions, so repeat queries skip collection creation.
+    Entries are indexed by document id and dropped once any of the documents is
+    deleted from the platform.
+    """
+
+    _redis_client = RedisClient.get_instance()
+    _prefix = "collection_cache"
+
+    @classmethod
+    def key_for(cls, payload: CollectionCreatePayload) -> str:
+        """Cache key; hash of everything that decides what the collection answers"""
+        digest = hashlib.sha256(
+            json.dumps(
+                [
+                    sorted(payload.documents),
+                    payload.instructions,
+                    payload.model,
+                    payload.temperature,
+                ]
+            ).encode()
+        ).hexdigest()
+        return f"{cls._prefix}:{digest}"
+
+    @classmethod
+    def get(cls, key: str) -> Optional[str]:
+        result = cls._redis_client.get(key)
+        if result:
+            return result.decode()
+        return None
+
+    @classmethod
+    def set(cls, key: str, llm_service_id: str, document_ids: list[str]) -> None:
+        pipe = cls._redis_client.pipeline()
+        pipe.set(key, llm_service_id, ex=CACHE_TTL)
+        for document_id in document_ids:
+            doc_key = f"{cls._prefix}:doc:{document_id}"
+            pipe.sadd(doc_key, key)
+            pipe.expire(doc_key, CACHE_TTL)
+        pipe.execute()
+
+    @classmethod
+    def get_or_create(
+        cls, payload: CollectionCreatePayload, create: Callable[[], str]
+    ) -> tuple[str, bool]:
+        """
+        Returns the cached llm_service_id for the payload, creating (and caching) it
+        with `create` on a miss. Concurrent misses on the same key are single-flight;
+        only one of them creates the collection, the others wait and reuse it.
+
+        Returns:
+            tuple[str, bool]: llm_service_id & whether it came from the cache
+        """
+        if CACHE_TTL <= 0:
+            return create(), False
+
+        key = cls.key_for(payload)
+        llm_service_id = cls.get(key)
+        if llm_service_id:
+            return llm_service_id, True
+
+        with cls._redis_client.lock(
+            f"{key}:lock", timeout=TIMEOUT + 60, blocking_timeout=TIMEOUT + 60
+        ):
+            llm_service_id = cls.get(key)
+            if llm_service_id:
+                return llm_service_id, True
+
+            llm_service_id = create()
+            cls.set(key, llm_service_id, payload.documents)
+            return llm_service_id, False
+
+    @classmethod
+    def invalidate_documents(cls, document_ids: list[str]) -> None:
+        """Drop every cached collection built on any of the documents"""
+        doc_keys = [f"{cls._prefix}:doc:{document_id}" for document_id in document_ids]
+        if not doc_keys:
+            return
+        keys = cls._redis_client.sunion(doc_keys)
+        if keys:
+            logger.info("Invalidating %d cached collection(s)", len(keys))
+        cls._redis_client.delete(*keys, *doc_keys)
@@ -0,0 +1,111 @@
+import hashlib
+import logging
+from typing import Optional
+
+from config.redis_client import RedisClient, AsyncRedisClient, registered_script
+
+logger = logging.getLogger()
+
+# KEYS: document id, holders; ARGV: holder, id of a fresh upload ('' to only look up)
+# Takes a reference on the document indexed for the content, indexing the fresh
+# upload if there is none. Returns the indexed document id (false on a miss)
+_ACQUIRE_SCRIPT = """
+local id = redis.call('GET', KEYS[1])
+if not id then
+    if ARGV[2] == '' then
+        return false
+    end
+    id = ARGV[2]
+    redis.call('SET', KEYS[1], id)
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+return id
+"""
+
+# KEYS: document id, holders; ARGV: holder, document id
+# Drops the holder's reference. Returns 1 if nobody refers to the document anymore
+# (it isn't indexed, or this was the last reference) & it can be deleted
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[2] then
+    return 1
+end
+redis.call('SREM', KEYS[2], ARGV[1])
+if redis.call('SCARD', KEYS[2]) > 0 then
+    return 0
+end
+redis.call('DEL', KEYS[1], KEYS[2])
+return 1
+"""
+
+
+class DocumentIndex:
+    """
+    Content addressed index in redis of the documents uploaded to a provider with
+    an api key: sha256 of the content -> provider's document id, along with the
+    sessions holding it. Uploads of content already indexed reuse the document
+    instead of sending it again; a document is deleted from the provider only
+    once the last session holding it is closed.
+    References are sets of session ids, so releasing twice (a retried close task)
+    is harmless. Acquiring fails open; the upload then goes ahead unindexed
+    """
+
+    _prefix = "document_index"
+
+    def __init__(self, provider: str, api_key: str):
+        key_hash = hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+        self.prefix = f"{self._prefix}:{provider}:{key_hash}"
+
+    def _keys(self, digest: str) -> list[str]:
+        return [f"{self.prefix}:{digest}", f"{self.prefix}:{digest}:holders"]
+
+    def acquire(
+        self, digest: str, holder: str, document_id: str = None
+    ) -> Optional[str]:
+        """
+        Id of the document already uploaded with this content, referenced by
+        `holder` from now on; None if there is none. With `document_id` (a fresh
+        upload of the content) it is indexed unless another upload won the race,
+        whose id is returned instead; the caller then deletes its own copy
+        """
+        try:
+            script = registered_script(RedisClient.get_instance(), _ACQUIRE_SCRIPT)
+            result = script(keys=self._keys(digest), args=[holder, document_id or ""])
+        except Exception as err:
+            logger.warning("Document index unavailable: %s", err)
+            return document_id
+        return result.decode() if result else None
+
+    async def aacquire(
+        self, digest: str, holder: str, document_id: str = None
+    ) -> Optional[str]:
+        """acquire without blocking the event loop"""
+        try:
+            script = registered_script(AsyncRedisClient.get_instance(), _ACQUIRE_SCRIPT)
+            result = await script(
+                keys=self._keys(digest), args=[holder, document_id or ""]
+            )
+        except Exception as err:
+            logger.warning("Document index unavailable: %s", err)
+            return document_id
+        return result.decode() if result else None
+
+    def release(self, digest: Optional[str], holder: str, document_id: str) -> bool:
+        """
+        Drops the holder's reference to the document; True if it should now be
+        deleted from the provider. Documents uploaded without a content hash were
+        never shared and are always deleted
+        """
+        if not digest:
+            return True
+        script = registered_script(RedisClient.get_instance(), _RELEASE_SCRIPT)
+        return bool(script(keys=self._keys(digest), args=[holder, document_id]))
+
+    def released(
+        self, document_ids: list[str], document_hashes: dict[str, str], holder: str
+    ) -> list[str]:
+        """Releases the holder's documents; returns those that should be deleted"""
+        return [
+            document_id
+            for document_id in document_ids
+            if self.release(document_hashes.get(document_id), holder, document_id)
+        ]
@@ -0,0 +1,95 @@
+import os
+import asyncio
+import logging
+import threading
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from typing import Coroutine
+
+logger = logging.getLogger()
+
+MAX_IN_FLIGHT = int(os.getenv("AI_PLATFORM_MAX_IN_FLIGHT", 500))
+
+
+class PollingEngine:
+    """
+    Singleton per process that runs an asyncio event loop in a background thread.
+    Coroutines waiting on the ai platform (collection jobs, thread results) are
+    submitted here so that hundreds of them are multiplexed on a single loop instead
+    of each one blocking a worker in time.sleep.
+
+    Celery task threads hand their coroutine over with `run` and block on a future
+    till it is done, so a task still holds its worker slot while it waits. Workers
+    therefore run the threads pool (CELERY_WORKER_POOL, the default) with a high
+    concurrency: a waiting task only holds a cheap thread and the loop does the
+    waiting for all of them. Under prefork each in-flight query holds a process.
+    """
+
+    lock = threading.Lock()
+    _engine_instance = None
+    _pid = None
+
+    def __init__(self):
+        self.loop = asyncio.new_event_loop()
+        self.in_flight = 0
+        self._slots = None
+        self._thread = threading.Thread(
+            target=self._run_loop, name="ai-platform-polling-engine", daemon=True
+        )
+        self._thread.start()
+
+    @classmethod
+    def get_instance(cls) -> "PollingEngine":
+        """
+        Returns the engine for the current process; started lazily so that celery
+        prefork children each get their own loop thread after the fork
+        """
+        if cls._engine_instance is None or cls._pid != os.getpid():
+            if cls.lock.acquire(timeout=10):
+                if cls._engine_instance is None or cls._pid != os.getpid():
+                    cls._engine_instance = cls()
+                    cls._pid = os.getpid()
+                cls.lock.release()
+        return cls._engine_instance
+
+    @classmethod
+    def reset_instance(cls) -> None:
+        """
+        Reset the instance to None; threads do not survive a fork so the child
+        has to start its own loop
+        """
+        cls.lock = threading.Lock()
+        cls._engine_instance = None
+        cls._pid = None
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self._slots = asyncio.Semaphore(MAX_IN_FLIGHT)
+        self.loop.run_forever()
+
+    async def _guarded(self, coro: Coroutine):
+        async with self._slots:
+            self.in_flight += 1
+            try:
+                return await coro
+            finally:
+                self.in_flight -= 1
+
+    def submit(self, coro: Coroutine) -> Future:
+        """Schedule the coroutine on the engine loop; thread safe"""
+        return asyncio.run_coroutine_threadsafe(self._guarded(coro), self.loop)
+
+    def run(self, coro: Coroutine, timeout: float = None):
+        """
+        Schedule the coroutine and block the calling thread until it finishes; the
+        task thread is held for the whole wait
+        """
+        future = self.submit(coro)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=PollingEngine.reset_instance)
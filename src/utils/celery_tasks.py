@@ -1,20 +1,237 @@
+import os
+import asyncio
 import logging
+import time
+import shutil
+import itertools
 import traceback
-from typing import Optional
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Optional
 
-from celery import shared_task
+from celery import shared_task, Task
 from fastapi import HTTPException
 
-from src.custom_webhook import CustomWebhook, WebhookConfig
-from src.file_search.session import FileSearchSession
-from src.file_search.openai_assistant import OpenAIFileAssistant
+from config.constants import TMP_UPLOAD_DIR_NAME
+from config.redis_client import RedisClient
+from src.custom_webhook import (
+    CustomWebhook,
+    WebhookBatch,
+    WebhookConfig,
+    WebhookDeadLetters,
+    WebhookDeliveryError,
+)
+from src.file_search.session import (
+    SESSION_TTL,
+    FileSearchSession,
+    OpenAISessionState,
+)
 from src.services import ai_platform_src
+from src.services.answer_cache import AnswerCache
+from src.services.collection_cache import CollectionCache
+from src.services.polling_engine import PollingEngine
+from src.utils.fair_share import FairShareTask
+from src.utils.http_helper import HttpClient
+from src.utils.rate_limiter import RateLimiter
+from src.utils.task_progress import TaskProgress
+from src.utils.metrics import (
+    ANSWER_CACHE_LOOKUPS,
+    COLLECTION_CREATION,
+    TIME_TO_FIRST_ANSWER,
+    task_submitted_at,
+)
 
 logger = logging.getLogger()
 
+WEBHOOK_MAX_RETRIES = int(os.getenv("WEBHOOK_MAX_RETRIES", 8))
+WEBHOOK_RETRY_BACKOFF_MAX = int(os.getenv("WEBHOOK_RETRY_BACKOFF_MAX_SECS", 600))
+# model the pooled openai assistants are created with
+ASSISTANT_MODEL = "gpt-4o-mini"
+
+# independent queries of a task answered at once: the default & the most a request
+# may ask for (each one is a platform thread / openai run in flight)
+QUERY_CONCURRENCY_LIMIT = int(os.getenv("QUERY_CONCURRENCY_LIMIT", 20))
+QUERY_MAX_CONCURRENCY = min(
+    int(os.getenv("QUERY_MAX_CONCURRENCY", 5)), QUERY_CONCURRENCY_LIMIT
+)
+
+SESSION_SWEEP_BATCH = int(os.getenv("SESSION_SWEEP_BATCH", 100))
+SESSION_SWEEP_CONCURRENCY = int(os.getenv("SESSION_SWEEP_CONCURRENCY", 4))
+# sessions released per minute at most, across all the workers
+SESSION_SWEEP_BUDGET = RateLimiter(
+    "session_sweeper", "", rpm=int(os.getenv("SESSION_SWEEP_RPM", 60))
+)
+SESSION_SWEEP_LOCK_TIMEOUT = 30 * 60
+# upload dirs younger than this may belong to an upload in progress
+ORPHAN_UPLOAD_DIR_MIN_AGE = 60 * 60
+
+
+def _is_last_attempt(task: Task) -> bool:
+    """Whether a failure now is final, i.e. autoretry won't run the task again"""
+    max_retries = task.retry_kwargs.get("max_retries", task.max_retries)
+    return max_retries is not None and task.request.retries >= max_retries
+
+
+def _bounded_concurrency(max_concurrency: int) -> int:
+    """max_concurrency of a task clamped to 1..QUERY_CONCURRENCY_LIMIT"""
+    return max(1, min(int(max_concurrency), QUERY_CONCURRENCY_LIMIT))
+
+
+def _progress_publisher(task: Task, total: int) -> Callable[[int, str], None]:
+    """Callback publishing each answer of the running task as it completes"""
+    task_id = task.request.id
+    submitted_at = task_submitted_at(task)
+    # a retry answers every query again; the ones streamed by the earlier
+    # attempts aren't published twice
+    published = TaskProgress.published(task_id) if task.request.retries else set()
+    completed = itertools.count(len(published) + 1)
+
+    def on_answer(index: int, answer: str):
+        if index in published:
+            return
+        done = next(completed)
+        if done == 1:
+            TIME_TO_FIRST_ANSWER.labels(task.name).observe(time.time() - submitted_at)
+        TaskProgress.publish_answer(task, task_id, index, answer, done, total)
+
+    return on_answer
+
+
+def _cached_answers(
+    task: Task,
+    session: OpenAISessionState,
+    documents: list[str],
+    assistant_prompt: Optional[str],
+    model: str,
+    queries: list[str],
+    independent_queries: bool,
+) -> tuple[list[str], list[Optional[str]]]:
+    """
+    Answer cache keys of the queries & the answers already cached (None on a miss).
+    No keys if the cache can't be used for the session. Chained queries are served
+    from the cache only if all of them are cached; a live thread needs the earlier
+    questions asked on it to answer the later ones
+    """
+    misses = [None] * len(queries)
+    if not AnswerCache.enabled():
+        return [], misses
+    fingerprint = AnswerCache.fingerprint(documents, session.document_hashes or {})
+    if fingerprint is None:
+        logger.info("Content of the session's documents unknown; not caching")
+        return [], misses
+
+    keys = AnswerCache.keys_for(
+        fingerprint,
+        assistant_prompt,
+        model,
+        queries,
+        chained=not independent_queries,
+    )
+    cached = AnswerCache.get_many(keys)
+    if not independent_queries and None in cached:
+        cached = misses
+    hits = len(queries) - cached.count(None)
+    ANSWER_CACHE_LOOKUPS.labels(task.name, "hit").inc(hits)
+    ANSWER_CACHE_LOOKUPS.labels(task.name, "miss").inc(len(queries) - hits)
+    return keys, cached
+
+
+def _answer_cache_report(cached: list[Optional[str]]) -> dict:
+    hits = [answer is not None for answer in cached]
+    return {"hits": sum(hits), "misses": len(hits) - sum(hits), "cached": hits}
+
+
+async def _create_collection(
+    payload: ai_platform_src.CollectionCreatePayload,
+) -> tuple[str, int]:
+    """
+    Creates the collection & waits for it on the polling engine's event loop.
+    Returns the llm_service_id along with the no of status polls it needed
+    """
+    start = time.perf_counter()
+    job_id = await ai_platform_src.acreate_collection(payload)
+
+    # wait till the collection is created
+    collection: dict = await ai_platform_src.apoll_collection_job_status(job_id)
+    if not collection:
+        logger.info(collection)
+        logger.error("Collection creation failed")
+        raise HTTPException(
+            status_code=500,
+            detail="Collection creation failed; something went wrong",
+        )
+    logger.info("Collection created successfully")
+    COLLECTION_CREATION.observe(time.perf_counter() - start)
+
+    return collection["llm_service_id"], ai_platform_src.get_poll_count(job_id)
+
+
+async def _query_collection(
+    llm_service_id: str,
+    queries: list[str],
+    independent_queries: bool = False,
+    max_concurrency: int = 1,
+    on_answer: Optional[Callable[[int, str], None]] = None,
+) -> tuple[list[str], list[int]]:
+    """
+    Runs the queries on the polling engine's event loop; all the waiting on the ai
+    platform happens here without blocking a worker.
+    By default queries are chained on one thread; independent queries are each
+    answered on their own thread, at most max_concurrency at a time.
+    on_answer(index, answer) is called (off the loop) as soon as an answer is ready.
+    Returns the answers (in the order of queries) along with the no of status
+    polls each of them needed
+    """
+
+    async def answer(i: int, prompt: str, thread_id: Optional[str]):
+        logger.info("Starting query %s: %s", i, prompt)
+        # start a thread with the query
+        thread_id = await ai_platform_src.acreate_and_start_thread(
+            ai_platform_src.CreateAndStartThreadPayload(
+                question=prompt,
+                assistant_id=llm_service_id,
+                remove_citation=True,
+                thread_id=thread_id,
+            )
+        )
+        logger.info("Thread created successfully with ID: %s", thread_id)
+
+        response = await ai_platform_src.apoll_thread_result(thread_id=thread_id)
+        if on_answer:
+            await asyncio.get_running_loop().run_in_executor(
+                None, on_answer, i, response
+            )
+        return thread_id, response, ai_platform_src.get_poll_count(thread_id)
+
+    if independent_queries:
+        slots = asyncio.Semaphore(max_concurrency)
+
+        async def answer_independently(i: int, prompt: str):
+            async with slots:
+                return await answer(i, prompt, None)
+
+        answers = await asyncio.gather(
+            *(answer_independently(i, prompt) for i, prompt in enumerate(queries))
+        )
+        return [res for (_, res, _) in answers], [polls for (*_, polls) in answers]
+
+    results = []
+    polls = []
+
+    thread_id = None
+    for i, prompt in enumerate(queries):
+        # Use the thread_id from the previous iteration
+        thread_id, response, thread_polls = await answer(i, prompt, thread_id)
+        polls.append(thread_polls)
+        results.append(response)
+
+    return results, polls
+
 
 @shared_task(
     bind=True,
+    base=FairShareTask,
+    streams_progress=True,
     autoretry_for=(Exception,),
     retry_backoff=5,  # tasks will retry after 5, 10, 15... seconds
     retry_kwargs={"max_retries": 0},
@@ -27,7 +244,14 @@ def query_file_v1(
     queries: list[str],
     session_id: str,
     webhook_config: Optional[dict] = None,
+    independent_queries: bool = False,
+    max_concurrency: int = 1,
+    answer_cache: bool = False,
+    # read by the router & FairShareTask
+    priority: Optional[str] = None,
+    client_id: Optional[str] = None,
 ):
+    max_concurrency = _bounded_concurrency(max_concurrency)
     try:
         # get the session
         session = FileSearchSession.get(session_id)
@@ -36,62 +260,103 @@ def query_file_v1(
         if not session:
             raise Exception("Invalid session")
 
-        # create collection
-        job_id = ai_platform_src.create_collection(
-            ai_platform_src.CollectionCreatePayload(
-                instructions=assistant_prompt,
-                documents=session.document_ids,
-                model="gpt-4o",
-                temperature=0.000001,
-                batch_size=1,
-            )
+        engine = PollingEngine.get_instance()
+        polls = {"collection": 0, "threads": []}
+        on_answer = _progress_publisher(self, len(queries))
+
+        payload = ai_platform_src.CollectionCreatePayload(
+            instructions=assistant_prompt,
+            documents=session.document_ids,
+            model="gpt-4o",
+            temperature=0.000001,
+            batch_size=1,
         )
 
-        # wait till the collection is created
-        collection: dict = ai_platform_src.poll_collection_job_status(job_id)
-        if not collection:
-            logger.info(collection)
-            logger.error("Collection creation failed")
-            raise HTTPException(
-                status_code=500,
-                detail="Collection creation failed; something went wrong",
+        keys, cached = [], [None] * len(queries)
+        if answer_cache:
+            keys, cached = _cached_answers(
+                self,
+                session,
+                session.document_ids,
+                assistant_prompt,
+                payload.model,
+                queries,
+                independent_queries,
             )
-        logger.info("Collection created successfully")
-
-        results = []
-
-        thread_id = None
-        for i, prompt in enumerate(queries):
-            logger.info("Starting query %s: %s", i, prompt)
-            # start a thread with the query
-            thread_id = ai_platform_src.create_and_start_thread(
-                ai_platform_src.CreateAndStartThreadPayload(
-                    question=prompt,
-                    assistant_id=collection["llm_service_id"],
-                    remove_citation=True,
-                    thread_id=thread_id,  # Use the thread_id from the previous iteration
-                )
+        results = list(cached)
+        misses = [i for i, answer in enumerate(cached) if answer is None]
+        for i, answer in enumerate(cached):
+            if answer is not None:
+                on_answer(i, answer)
+
+        def create_collection() -> str:
+            llm_service_id, polls["collection"] = engine.run(
+                _create_collection(payload)
             )
-            logger.info("Thread created successfully with ID: %s", thread_id)
+            return llm_service_id
 
-            response = ai_platform_src.poll_thread_result(thread_id=thread_id)
+        if misses:
+            # reuse the collection if the same documents & prompt were queried before
+            llm_service_id, cached_collection = CollectionCache.get_or_create(
+                payload, create_collection
+            )
+            logger.info(
+                "Using collection %s (cached: %s)", llm_service_id, cached_collection
+            )
 
-            results.append(response)
+            answers, polls["threads"] = engine.run(
+                _query_collection(
+                    llm_service_id,
+                    [queries[i] for i in misses],
+                    independent_queries,
+                    max_concurrency,
+                    on_answer=lambda j, answer: on_answer(misses[j], answer),
+                )
+            )
+            for i, answer in zip(misses, answers):
+                results[i] = answer
+            if keys:
+                AnswerCache.set_many({keys[i]: results[i] for i in misses})
 
         if webhook_config:
             webhook = CustomWebhook(WebhookConfig(**webhook_config))
             logger.info(
-                f"Posting results to the webhook configured at {webhook.config.endpoint}"
+                f"Queueing results for the webhook configured at {webhook.config.endpoint}"
             )
-            res = webhook.post_result({"results": results, "session_id": session_id})
-            logger.info(f"Results posted to the webhook with res: {str(res)}")
+            webhook.send({"results": results, "session_id": session_id})
+
+        logger.info("Status polls made: %s", polls)
+        logger.info("Http connection pool stats: %s", HttpClient.pool_stats())
 
-        return {"result": results, "session_id": session_id}
+        result = {"result": results, "session_id": session_id, "polls": polls}
+        if answer_cache:
+            result["answer_cache"] = _answer_cache_report(cached)
+        return result
     except Exception as err:
         logger.error(traceback.format_exc())  # Log the full traceback
         raise Exception(traceback.format_exc())  # Raise with full traceback
 
 
+def _release_uploads(session: OpenAISessionState) -> None:
+    """
+    Deletes the session's platform documents (unless other open sessions hold
+    them too), the local copies of its uploads & finally the session itself
+    """
+    released = ai_platform_src.DOCUMENT_INDEX.released(
+        session.document_ids, session.document_hashes or {}, session.id
+    )
+
+    # collections built on these documents can't be reused anymore
+    CollectionCache.invalidate_documents(released)
+
+    for document_id in released:
+        logger.info(f"Deleting document {document_id}")
+        ai_platform_src.delete_document(document_id)
+    for local_fpath in session.local_fpaths:
+        Path(local_fpath).unlink(missing_ok=True)
+    FileSearchSession.remove(session.id)
+
+
 @shared_task(
     bind=True,
     autoretry_for=(Exception,),
@@ -108,9 +373,7 @@ def close_file_search_session_v1(self, session_id: str):
         if not session:
             raise Exception("Invalid session")
 
-        for document_id in session.document_ids:
-            logger.info(f"Deleting document {document_id}")
-            ai_platform_src.delete_document(document_id)
+        _release_uploads(session)
     except Exception as err:
         logger.error(traceback.format_exc())
         raise Exception(traceback.format_exc())
@@ -118,6 +381,8 @@ def close_file_search_session_v1(self, session_id: str):
 
 @shared_task(
     bind=True,
+    base=FairShareTask,
+    streams_progress=True,
     autoretry_for=(Exception,),
     retry_backoff=5,  # tasks will retry after 5, 10, 15... seconds
     retry_kwargs={"max_retries": 3},
@@ -131,32 +396,78 @@ def query_file(
     queries: list[str],
     session_id: str,
     webhook_config: Optional[dict] = None,
+    independent_queries: bool = False,
+    max_concurrency: int = 1,
+    answer_cache: bool = False,
+    # read by the router & FairShareTask
+    priority: Optional[str] = None,
+    client_id: Optional[str] = None,
 ):
-    fa = None
+    # imported here so the api (& workers not serving this task) skip the openai sdk
+    from src.file_search.assistant_pool import AssistantPool
+
+    max_concurrency = _bounded_concurrency(max_concurrency)
     try:
-        results = []
+        on_answer = _progress_publisher(self, len(queries))
 
-        fa = OpenAIFileAssistant(
-            openai_key,
-            session_id=session_id,
-            instructions=assistant_prompt,
-        )
-        for i, prompt in enumerate(queries):
-            logger.info("%s: %s", i, prompt)
-            response = fa.query(prompt)
-            results.append(response)
+        keys, cached = [], [None] * len(queries)
+        if answer_cache:
+            session = FileSearchSession.get(session_id)
+            if not session:
+                raise Exception("Invalid session")
+            keys, cached = _cached_answers(
+                self,
+                session,
+                session.local_fpaths,
+                assistant_prompt,
+                ASSISTANT_MODEL,
+                queries,
+                independent_queries,
+            )
+        results = list(cached)
+        misses = [i for i, answer in enumerate(cached) if answer is None]
+        for i, answer in enumerate(cached):
+            if answer is not None:
+                on_answer(i, answer)
 
-        logger.info(f"Results generated in the session {fa.session.id}")
+        if misses:
+            with AssistantPool.checkout(
+                openai_key, session_id, instructions=assistant_prompt
+            ) as fa:
+                if independent_queries:
+                    logger.info(
+                        "Answering %d independent queries, %d at a time",
+                        len(misses),
+                        max_concurrency,
+                    )
+                    answers = fa.query_independently(
+                        [queries[i] for i in misses],
+                        max_concurrency,
+                        lambda j, answer: on_answer(misses[j], answer),
+                    )
+                    for i, answer in zip(misses, answers):
+                        results[i] = answer
+                else:
+                    for i in misses:
+                        logger.info("%s: %s", i, queries[i])
+                        results[i] = fa.query(queries[i])
+                        on_answer(i, results[i])
+            if keys:
+                AnswerCache.set_many({keys[i]: results[i] for i in misses})
+
+        logger.info(f"Results generated in the session {session_id}")
 
         if webhook_config:
             webhook = CustomWebhook(WebhookConfig(**webhook_config))
             logger.info(
-                f"Posting results to the webhook configured at {webhook.config.endpoint}"
+                f"Queueing results for the webhook configured at {webhook.config.endpoint}"
             )
-            res = webhook.post_result({"results": results, "session_id": fa.session.id})
-            logger.info(f"Results posted to the webhook with res: {str(res)}")
+            webhook.send({"results": results, "session_id": session_id})
 
-        return {"result": results, "session_id": fa.session.id}
+        result = {"result": results, "session_id": session_id}
+        if answer_cache:
+            result["answer_cache"] = _answer_cache_report(cached)
+        return result
     except Exception as err:
         logger.error(traceback.format_exc())  # Log the full traceback
         raise Exception(traceback.format_exc())  # Raise with full traceback
@@ -171,9 +482,177 @@ def query_file(
     logger=logging.getLogger(),
 )
 def close_file_search_session(self, openai_key, session_id: str):
+    from src.file_search.assistant_pool import AssistantPool
+
     try:
-        fa = OpenAIFileAssistant(openai_key, session_id=session_id)
-        fa.close()
+        with AssistantPool.checkout(openai_key, session_id) as fa:
+            fa.close()
+        AssistantPool.invalidate(session_id)
     except Exception as err:
         logger.error(traceback.format_exc())
         raise Exception(traceback.format_exc())
+
+
+def _remove_orphan_upload_dirs() -> int:
+    """
+    Removes the upload dirs (tmp_uploads/<session_id>) of sessions no longer in
+    redis; dirs modified recently may belong to an upload still in progress
+    """
+    root = Path(TMP_UPLOAD_DIR_NAME)
+    if not root.is_dir():
+        return 0
+    cutoff = time.time() - ORPHAN_UPLOAD_DIR_MIN_AGE
+    dirs = [d for d in root.iterdir() if d.is_dir() and d.stat().st_mtime < cutoff]
+    removed = 0
+    for upload_dir, exists in zip(
+        dirs, FileSearchSession.exists([d.name for d in dirs])
+    ):
+        if not exists:
+            logger.info("Removing orphaned upload dir %s", upload_dir)
+            shutil.rmtree(upload_dir, ignore_errors=True)
+            removed += 1
+    return removed
+
+
+def _sweep_session(session_id: str) -> bool:
+    """Releases an expired session; whether it is gone now"""
+    last_used = FileSearchSession.last_used(session_id)
+    if last_used is None or last_used > time.time() - SESSION_TTL:
+        return False  # closed or used since it was picked
+
+    SESSION_SWEEP_BUDGET.acquire()
+    try:
+        session = FileSearchSession.get(session_id, touch=False)
+    except ValueError as err:
+        logger.warning("Unindexing %s; not a session: %s", session_id, err)
+        FileSearchSession.unindex(session_id)
+        return False
+
+    try:
+        if session is None:
+            # the key expired before it could be swept; nothing left to release
+            logger.warning("Session %s expired before it was released", session_id)
+            FileSearchSession.remove(session_id)
+        elif session.assistant_id:
+            # imported here so workers not serving openai sessions skip the sdk
+            from src.file_search.assistant_pool import AssistantPool
+
+            # not touched, so a failed close leaves the session expired for the
+            # next sweep
+            with AssistantPool.checkout(
+                os.getenv("OPENAI_API_KEY"), session_id, touch=False
+            ) as fa:
+                fa.close()
+            AssistantPool.invalidate(session_id)
+        else:
+            _release_uploads(session)
+    except Exception as err:
+        # stays indexed; the next sweep tries again
+        logger.error("Failed to release expired session %s: %s", session_id, err)
+        return False
+    logger.info("Released expired session %s", session_id)
+    return True
+
+
+@shared_task(
+    bind=True,
+    name="sweep_file_search_sessions",
+    logger=logging.getLogger(),
+)
+def sweep_file_search_sessions(self):
+    """
+    Run by celery beat every SESSION_SWEEP_INTERVAL_SECS. Releases (like the close
+    tasks do) up to SESSION_SWEEP_BATCH sessions idle for longer than their ttl,
+    SESSION_SWEEP_CONCURRENCY at a time & at most SESSION_SWEEP_RPM a minute, so
+    the sweep doesn't eat into the rate limits of live traffic. Also indexes
+    sessions stored before they had a ttl and removes orphaned upload dirs
+    """
+    lock = RedisClient.get_instance().lock(
+        "file_search_sessions:sweep_lock", timeout=SESSION_SWEEP_LOCK_TIMEOUT
+    )
+    if not lock.acquire(blocking=False):
+        logger.info("Another sweep is running; skipping this one")
+        return {"skipped": True}
+
+    try:
+        adopted = FileSearchSession.adopt(SESSION_SWEEP_BATCH)
+        expired = FileSearchSession.expired(SESSION_SWEEP_BATCH)
+        released = 0
+        if expired:
+            workers = min(SESSION_SWEEP_CONCURRENCY, len(expired))
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                released = sum(pool.map(_sweep_session, expired))
+        orphan_dirs = _remove_orphan_upload_dirs()
+    finally:
+        lock.release()
+
+    result = {
+        "adopted": adopted,
+        "expired": len(expired),
+        "released": released,
+        "orphan_dirs": orphan_dirs,
+    }
+    logger.info("Swept file search sessions: %s", result)
+    return result
+
+
+@shared_task(
+    bind=True,
+    autoretry_for=(WebhookDeliveryError,),
+    retry_backoff=2,  # retries after ~2, 4, 8... seconds, capped & jittered
+    retry_backoff_max=WEBHOOK_RETRY_BACKOFF_MAX,
+    retry_jitter=True,
+    retry_kwargs={"max_retries": WEBHOOK_MAX_RETRIES},
+    name="webhooks:deliver_webhook",
+    logger=logging.getLogger(),
+)
+def deliver_webhook(self, webhook_config: dict, payload: dict):
+    """
+    Posts a payload to a webhook; runs on the webhooks queue so the query
+    workers are free as soon as the answers exist
+    """
+    webhook = CustomWebhook(WebhookConfig(**webhook_config))
+    try:
+        res = webhook.post(payload)
+        logger.info(f"Results posted to the webhook with res: {str(res)}")
+        return res
+    except WebhookDeliveryError as err:
+        logger.error(
+            f"Failed to post webhook results to {webhook.config.endpoint}: {err}"
+        )
+        if not err.retryable or _is_last_attempt(self):
+            WebhookDeadLetters.add(webhook.config, payload, str(err))
+            return {"error": str(err)}
+        raise
+
+
+@shared_task(
+    bind=True,
+    name="webhooks:flush_webhook_batch",
+    logger=logging.getLogger(),
+)
+def flush_webhook_batch(self, key: str):
+    """Delivers the results buffered for a batching webhook as one post"""
+    config, items, more = WebhookBatch.take(key)
+    if items:
+        logger.info(f"Delivering {len(items)} result(s) to {config.endpoint}")
+        CustomWebhook(config).send_batch(items)
+    if more:
+        WebhookBatch.schedule(key)
+
+
+@shared_task(
+    bind=True,
+    name="webhooks:replay_webhook_dead_letters",
+    logger=logging.getLogger(),
+)
+def replay_webhook_dead_letters(self, count: int = 100):
+    """
+    Queues the oldest `count` dead-lettered deliveries again, e.g. once a receiver
+    that was down is back. Those that fail again are dead-lettered again
+    """
+    entries = WebhookDeadLetters.take(count)
+    for entry in entries:
+        deliver_webhook.delay(entry["webhook_config"], entry["payload"])
+    logger.info(f"Replaying {len(entries)} dead-lettered webhook deliveries")
+    return {"replayed": len(entries)}
@@ -0,0 +1,161 @@
+import os
+import random
+import logging
+from enum import Enum
+from typing import Optional
+from urllib.parse import urlparse
+
+from celery import Task
+from celery.exceptions import Ignore
+
+from config.redis_client import RedisClient, registered_script
+from src.utils.metrics import FAIR_SHARE_DEFERRALS
+
+logger = logging.getLogger()
+
+# queries with at least this many questions are bulk unless asked otherwise
+QUERY_BULK_MIN_QUERIES = int(os.getenv("QUERY_BULK_MIN_QUERIES", 10))
+# query tasks of one client running at once, per priority; 0 (the default) lifts
+# the limit
+TENANT_MAX_IN_FLIGHT = {
+    "interactive": int(os.getenv("TENANT_MAX_IN_FLIGHT_INTERACTIVE", 0)),
+    "bulk": int(os.getenv("TENANT_MAX_IN_FLIGHT_BULK", 0)),
+}
+# a task over its client's share goes back on its queue for about this long
+FAIR_SHARE_DEFER = float(os.getenv("FAIR_SHARE_DEFER_SECS", 5))
+# slots held by workers that died mid task are reclaimed after this
+FAIR_SHARE_SLOT_TTL = int(os.getenv("FAIR_SHARE_SLOT_TTL_SECS", 60 * 60))
+# queries that identify no client; they share no limit
+DEFAULT_TENANT = "default"
+# set on the messages of deferred tasks, which were already queued once
+DEFERRED_HEADER = "fair_share_deferred"
+
+# KEYS[1]: slots of a client & priority; ARGV: task id, limit, ttl
+# Takes a slot for the task unless the client is at its limit (slots past their
+# ttl don't count). Returns 1 if the task may run
+_ACQUIRE_SCRIPT = """
+local now = tonumber(redis.call('TIME')[1])
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', now)
+if not redis.call('ZSCORE', KEYS[1], ARGV[1])
+    and redis.call('ZCARD', KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], now + tonumber(ARGV[3]), ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class QueryPriority(str, Enum):
+    interactive = "interactive"
+    bulk = "bulk"
+
+
+def resolve_priority(priority: Optional[QueryPriority], queries: list[str]) -> str:
+    """The priority asked for; else bulk for QUERY_BULK_MIN_QUERIES or more queries"""
+    if priority:
+        return QueryPriority(priority).value
+    if len(queries) >= QUERY_BULK_MIN_QUERIES:
+        return QueryPriority.bulk.value
+    return QueryPriority.interactive.value
+
+
+def tenant_for(client_id: Optional[str], webhook_config=None) -> str:
+    """The client a query counts against: its client_id, else its webhook's host"""
+    if client_id:
+        return client_id
+    if webhook_config:
+        host = urlparse(webhook_config.endpoint).hostname
+        if host:
+            return host
+    return DEFAULT_TENANT
+
+
+class TenantSlots:
+    """
+    Query tasks running per client & priority, in redis (sorted sets of task ids
+    scored by when their slot lapses). Fails open; if redis is unreachable every
+    task runs
+    """
+
+    _prefix = "fair_share"
+
+    @classmethod
+    def key_for(cls, tenant: str, priority: str) -> str:
+        return f"{cls._prefix}:{priority}:{tenant}"
+
+    @classmethod
+    def acquire(cls, tenant: str, priority: str, task_id: str) -> bool:
+        limit = TENANT_MAX_IN_FLIGHT.get(priority, 0)
+        if limit <= 0:
+            return True
+        try:
+            script = registered_script(RedisClient.get_instance(), _ACQUIRE_SCRIPT)
+            return bool(
+                script(
+                    keys=[cls.key_for(tenant, priority)],
+                    args=[task_id, limit, FAIR_SHARE_SLOT_TTL],
+                )
+            )
+        except Exception as err:
+            logger.warning("Fair share slots unavailable: %s", err)
+            return True
+
+    @classmethod
+    def release(cls, tenant: str, priority: str, task_id: str) -> None:
+        if TENANT_MAX_IN_FLIGHT.get(priority, 0) <= 0:
+            return
+        try:
+            RedisClient.get_instance().zrem(cls.key_for(tenant, priority), task_id)
+        except Exception as err:
+            logger.warning(
+                "Failed to release the fair share slot of %s: %s", task_id, err
+            )
+
+
+class FairShareTask(Task):
+    """
+    Base of the query tasks. A task runs only while its client (the `client_id`
+    kwarg) has fewer than TENANT_MAX_IN_FLIGHT_<PRIORITY> tasks of its priority
+    running; otherwise it goes back on its queue after ~FAIR_SHARE_DEFER_SECS and
+    the worker moves on to other clients' work. Deferring doesn't count as a retry.
+    Tasks of no identified client aren't limited
+    """
+
+    def __call__(self, *args, **kwargs):
+        if self.request.called_directly:
+            # no request pushed yet (a plain function call); Task.__call__ does it
+            return super().__call__(*args, **kwargs)
+        tenant = kwargs.get("client_id") or DEFAULT_TENANT
+        if self.request.is_eager or tenant == DEFAULT_TENANT:
+            return self.run(*args, **kwargs)
+
+        priority = kwargs.get("priority") or QueryPriority.interactive.value
+        task_id = self.request.id
+        if not TenantSlots.acquire(tenant, priority, task_id):
+            self._defer(tenant, priority)
+        try:
+            # self.run, not Task.__call__, which would push a fresh request over the
+            # one the worker pushed (no id, no retries, no autoretry)
+            return self.run(*args, **kwargs)
+        finally:
+            TenantSlots.release(tenant, priority, task_id)
+
+    def _defer(self, tenant: str, priority: str) -> None:
+        """Re-publishes the task (same id) with a jittered delay & drops this run"""
+        logger.info(
+            "Client %s is at its %s share; deferring task %s",
+            tenant,
+            priority,
+            self.request.id,
+        )
+        FAIR_SHARE_DEFERRALS.labels(self.name, priority).inc()
+        headers = {**(self.request.headers or {}), DEFERRED_HEADER: True}
+        published_at = getattr(self.request, "published_at", None)
+        if published_at:
+            # the queue wait is measured from the original submission
+            headers["published_at"] = published_at
+        self.signature_from_request(
+            countdown=FAIR_SHARE_DEFER * random.uniform(0.5, 1.5), headers=headers
+        ).apply_async()
+        raise Ignore()
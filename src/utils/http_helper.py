@@ -1,66 +1,244 @@
+import os
+import asyncio
+import threading
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 import logging
+from typing import Optional
 from fastapi import HTTPException
 
+from src.utils.rate_limiter import RateLimiter
+
 logger = logging.getLogger()
 
+POOL_CONNECTIONS = int(os.getenv("HTTP_POOL_CONNECTIONS", 10))  # no of hosts to keep pools for
+POOL_MAXSIZE = int(os.getenv("HTTP_POOL_MAXSIZE", 20))  # max connections kept per host
+POOL_BLOCK = os.getenv("HTTP_POOL_BLOCK", "false").lower() == "true"
+DEFAULT_TIMEOUT = (
+    float(os.getenv("HTTP_CONNECT_TIMEOUT_SECS", 10)),
+    float(os.getenv("HTTP_READ_TIMEOUT_SECS", 60)),
+)
+ASYNC_DEFAULT_TIMEOUT = httpx.Timeout(DEFAULT_TIMEOUT[1], connect=DEFAULT_TIMEOUT[0])
 
-def http_post(endpoint: str, json: dict = None, files: dict = None, **kwargs) -> dict:
-    """make a POST request"""
+
+class HttpClient:
+    """
+    Singleton Class to instantiate a pooled, keep-alive http session per process.
+    Use this class anywhere in the code to make outbound http calls so that
+    connections (and tls handshakes) are reused across calls
+    """
+
+    lock = threading.Lock()
+    _session_instance = None
+    _pid = None
+
+    @classmethod
+    def get_instance(cls) -> requests.Session:
+        """
+        Returns the session for the current process.
+        The session is re-created if the process was forked (celery prefork) after it
+        was built, since sockets in the pool must not be shared between processes.
+        Pool sizes can be configured via HTTP_POOL_CONNECTIONS, HTTP_POOL_MAXSIZE and
+        HTTP_POOL_BLOCK (block instead of opening more than HTTP_POOL_MAXSIZE per host)
+        Returns:
+            requests.Session: The session instance.
+        """
+        if cls._session_instance is None or cls._pid != os.getpid():
+            if cls.lock.acquire(timeout=10):
+                if cls._session_instance is None or cls._pid != os.getpid():
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=POOL_CONNECTIONS,
+                        pool_maxsize=POOL_MAXSIZE,
+                        pool_block=POOL_BLOCK,
+                    )
+                    session.mount("http://", adapter)
+                    session.mount("https://", adapter)
+                    cls._session_instance = session
+                    cls._pid = os.getpid()
+                cls.lock.release()
+        return cls._session_instance
+
+    @classmethod
+    def reset_instance(cls) -> None:
+        """
+        Reset the instance to None. Called in the child after a fork; the inherited
+        session is dropped (not closed) since its sockets still belong to the parent
+        """
+        cls.lock = threading.Lock()
+        cls._session_instance = None
+        cls._pid = None
+
+    @classmethod
+    def pool_stats(cls) -> dict:
+        """
+        Connection reuse counters of the live pools in this process.
+        A hit is a request served over an already open connection, a miss is a
+        request that had to open a new one
+        """
+        stats = {"requests": 0, "hits": 0, "misses": 0, "pools": 0}
+        if cls._session_instance is None or cls._pid != os.getpid():
+            return stats
+
+        adapters = {id(a): a for a in cls._session_instance.adapters.values()}
+        for adapter in adapters.values():
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                stats["pools"] += 1
+                stats["requests"] += pool.num_requests
+                stats["misses"] += pool.num_connections
+        stats["hits"] = max(stats["requests"] - stats["misses"], 0)
+        return stats
+
+
+class AsyncHttpClient:
+    """
+    Pooled httpx.AsyncClient per event loop.
+    An AsyncClient's connections are bound to the loop that opened them, so a client
+    is created lazily for the running loop (and the current process)
+    """
+
+    _client_instance = None
+    _loop = None
+    _pid = None
+
+    @classmethod
+    def get_instance(cls) -> httpx.AsyncClient:
+        loop = asyncio.get_running_loop()
+        if (
+            cls._client_instance is None
+            or cls._loop is not loop
+            or cls._pid != os.getpid()
+        ):
+            cls._client_instance = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=POOL_CONNECTIONS * POOL_MAXSIZE,
+                    max_keepalive_connections=POOL_MAXSIZE,
+                ),
+                timeout=ASYNC_DEFAULT_TIMEOUT,
+            )
+            cls._loop = loop
+            cls._pid = os.getpid()
+        return cls._client_instance
+
+    @classmethod
+    def reset_instance(cls) -> None:
+        """
+        Reset the instance to None
+        """
+        cls._client_instance = None
+        cls._loop = None
+        cls._pid = None
+
+
+def _reset_after_fork():
+    HttpClient.reset_instance()
+    AsyncHttpClient.reset_instance()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _request(
+    method: str, endpoint: str, rate_limiter: Optional[RateLimiter] = None, **kwargs
+) -> requests.Response:
     headers = kwargs.pop("headers", {})
-    timeout = kwargs.pop("timeout", None)
+    timeout = kwargs.pop("timeout", DEFAULT_TIMEOUT)
 
+    if rate_limiter:
+        rate_limiter.acquire()
     try:
-        res = requests.post(
-            endpoint,
-            headers=headers,
-            timeout=timeout,
-            json=json,
-            files=files,
-            **kwargs,
+        res = HttpClient.get_instance().request(
+            method, endpoint, headers=headers, timeout=timeout, **kwargs
         )
     except Exception as error:
         logger.exception(error)
         raise HTTPException(500, "connection error") from error
+    if rate_limiter:
+        rate_limiter.learn(res.headers, res.status_code)
     try:
         res.raise_for_status()
     except Exception as error:
         logger.exception(error)
         raise HTTPException(res.status_code, res.text) from error
-    return res.json()
+    return res
+
+
+def http_post(endpoint: str, json: dict = None, files: dict = None, **kwargs) -> dict:
+    """make a POST request"""
+    return _request("POST", endpoint, json=json, files=files, **kwargs).json()
 
 
 def http_get(endpoint: str, **kwargs) -> dict:
     """make a GET request"""
-    headers = kwargs.pop("headers", {})
-    timeout = kwargs.pop("timeout", None)
+    return _request("GET", endpoint, **kwargs).json()
 
-    try:
-        res = requests.get(endpoint, headers=headers, timeout=timeout, **kwargs)
-    except Exception as error:
-        logger.exception(error)
-        raise HTTPException(500, "connection error") from error
-    try:
-        res.raise_for_status()
-    except Exception as error:
-        logger.exception(error)
-        raise HTTPException(res.status_code, res.text) from error
-    return res.json()
+
+def http_get_with_headers(endpoint: str, **kwargs) -> tuple[dict, dict]:
+    """make a GET request; returns the json body along with the response headers"""
+    res = _request("GET", endpoint, **kwargs)
+    return res.json(), res.headers
 
 
 def http_delete(endpoint: str, **kwargs) -> dict:
     """make a DELETE request"""
+    return _request("DELETE", endpoint, **kwargs).json()
+
+
+async def _async_request(
+    method: str, endpoint: str, rate_limiter: Optional[RateLimiter] = None, **kwargs
+) -> httpx.Response:
     headers = kwargs.pop("headers", {})
-    timeout = kwargs.pop("timeout", None)
+    timeout = kwargs.pop("timeout", ASYNC_DEFAULT_TIMEOUT)
 
+    if rate_limiter:
+        await rate_limiter.aacquire()
     try:
-        res = requests.delete(endpoint, headers=headers, timeout=timeout, **kwargs)
+        res = await AsyncHttpClient.get_instance().request(
+            method, endpoint, headers=headers, timeout=timeout, **kwargs
+        )
+    except HTTPException:
+        # raised by a streamed body, e.g. an upload over the size limit (413)
+        raise
     except Exception as error:
         logger.exception(error)
         raise HTTPException(500, "connection error") from error
+    if rate_limiter:
+        await rate_limiter.alearn(res.headers, res.status_code)
     try:
         res.raise_for_status()
     except Exception as error:
         logger.exception(error)
         raise HTTPException(res.status_code, res.text) from error
+    return res
+
+
+async def ahttp_post(
+    endpoint: str, json: dict = None, files: dict = None, **kwargs
+) -> dict:
+    """make a POST request without blocking the event loop"""
+    res = await _async_request("POST", endpoint, json=json, files=files, **kwargs)
+    return res.json()
+
+
+async def ahttp_get(endpoint: str, **kwargs) -> dict:
+    """make a GET request without blocking the event loop"""
+    res = await _async_request("GET", endpoint, **kwargs)
+    return res.json()
+
+
+async def ahttp_get_with_headers(endpoint: str, **kwargs) -> tuple[dict, dict]:
+    """make a GET request without blocking the event loop; returns body & headers"""
+    res = await _async_request("GET", endpoint, **kwargs)
+    return res.json(), res.headers
+
+
+async def ahttp_delete(endpoint: str, **kwargs) -> dict:
+    """make a DELETE request without blocking the event loop"""
+    res = await _async_request("DELETE", endpoint, **kwargs)
     return res.json()
@@ -0,0 +1,233 @@
+import os
+import time
+import inspect
+import logging
+import functools
+from typing import Callable
+
+from celery.signals import (
+    before_task_publish,
+    task_prerun,
+    task_postrun,
+    task_retry,
+    worker_init,
+)
+from fastapi import HTTPException, Request, Response
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Histogram,
+    generate_latest,
+    multiprocess,
+    start_http_server,
+    REGISTRY,
+)
+
+logger = logging.getLogger()
+
+# port of the worker side exporter; disabled if not set
+CELERY_METRICS_PORT = os.getenv("CELERY_METRICS_PORT")
+
+REQUEST_LATENCY = Histogram(
+    "llm_api_request_duration_seconds",
+    "Latency of the api requests",
+    ["method", "route", "status"],
+)
+TASK_RUNTIME = Histogram(
+    "llm_task_runtime_seconds",
+    "Time taken by a celery task to run",
+    ["task", "state"],
+    buckets=(0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, float("inf")),
+)
+TASK_QUEUE_WAIT = Histogram(
+    "llm_task_queue_wait_seconds",
+    "Time a celery task waited in the queue before a worker picked it up",
+    ["task"],
+    buckets=(0.05, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 300, float("inf")),
+)
+TASK_RETRIES = Counter(
+    "llm_task_retries_total",
+    "No of times a celery task was retried",
+    ["task"],
+)
+PLATFORM_CALL_LATENCY = Histogram(
+    "llm_ai_platform_call_duration_seconds",
+    "Latency of the calls made to the ai platform",
+    ["function", "status"],
+)
+PLATFORM_POLLS = Histogram(
+    "llm_ai_platform_polls_per_job",
+    "No of status polls it took for a platform job/thread to finish",
+    ["function"],
+    buckets=(1, 2, 3, 5, 8, 13, 21, 34, 55, float("inf")),
+)
+COLLECTION_CREATION = Histogram(
+    "llm_collection_creation_seconds",
+    "Time taken to create a collection on the ai platform & for it to be ready",
+    buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, float("inf")),
+)
+TIME_TO_FIRST_ANSWER = Histogram(
+    "llm_time_to_first_answer_seconds",
+    "Time from a query task being submitted till its first answer was ready",
+    ["task"],
+    buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600, float("inf")),
+)
+RATE_LIMIT_WAIT = Histogram(
+    "llm_rate_limit_wait_seconds",
+    "Time spent waiting on the shared rate limiter before an outbound call",
+    ["provider"],
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, float("inf")),
+)
+ANSWER_CACHE_LOOKUPS = Counter(
+    "llm_answer_cache_lookups_total",
+    "Questions looked up in the answer cache, by task & hit or miss",
+    ["task", "result"],
+)
+FAIR_SHARE_DEFERRALS = Counter(
+    "llm_fair_share_deferrals_total",
+    "Query tasks put back on their queue as the client had its share of workers",
+    ["task", "priority"],
+)
+
+
+def _registry() -> CollectorRegistry:
+    """
+    With several processes (uvicorn workers, celery prefork) set
+    PROMETHEUS_MULTIPROC_DIR so the metrics of every process are aggregated
+    """
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return registry
+    return REGISTRY
+
+
+def metrics_response() -> Response:
+    """Metrics in the prometheus exposition format; served at /metrics"""
+    return Response(generate_latest(_registry()), media_type=CONTENT_TYPE_LATEST)
+
+
+async def metrics_middleware(request: Request, call_next):
+    """Records the latency of every request by its route template"""
+    start = time.perf_counter()
+    status = 500
+    try:
+        response = await call_next(request)
+        status = response.status_code
+        return response
+    finally:
+        route = request.scope.get("route")
+        REQUEST_LATENCY.labels(
+            request.method, route.path if route else "unmatched", status
+        ).observe(time.perf_counter() - start)
+
+
+def track_platform_call(function: str) -> Callable:
+    """
+    Decorator recording latency & status of an ai platform call (sync or async).
+    Status is `ok` or the http status code of the HTTPException raised
+    """
+
+    def status_of(err: Exception) -> str:
+        return str(err.status_code) if isinstance(err, HTTPException) else "error"
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                status = "ok"
+                try:
+                    return await func(*args, **kwargs)
+                except Exception as err:
+                    status = status_of(err)
+                    raise
+                finally:
+                    PLATFORM_CALL_LATENCY.labels(function, status).observe(
+                        time.perf_counter() - start
+                    )
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            status = "ok"
+            try:
+                return func(*args, **kwargs)
+            except Exception as err:
+                status = status_of(err)
+                raise
+            finally:
+                PLATFORM_CALL_LATENCY.labels(function, status).observe(
+                    time.perf_counter() - start
+                )
+
+        return wrapper
+
+    return decorator
+
+
+def task_submitted_at(task) -> float:
+    """When the task was published; falls back to now if it wasn't stamped"""
+    return getattr(task.request, "published_at", None) or time.time()
+
+
+@before_task_publish.connect
+def _stamp_published_at(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault("published_at", time.time())
+
+
+_task_started: dict[str, float] = {}
+
+
+@task_prerun.connect
+def _on_task_prerun(task_id=None, task=None, **kwargs):
+    _task_started[task_id] = time.perf_counter()
+    published_at = getattr(task.request, "published_at", None)
+    if published_at:
+        TASK_QUEUE_WAIT.labels(task.name).observe(max(time.time() - published_at, 0))
+
+
+@task_postrun.connect
+def _on_task_postrun(task_id=None, task=None, state=None, **kwargs):
+    started = _task_started.pop(task_id, None)
+    if started is not None:
+        TASK_RUNTIME.labels(task.name, state or "UNKNOWN").observe(
+            time.perf_counter() - started
+        )
+
+
+@task_retry.connect
+def _on_task_retry(sender=None, **kwargs):
+    TASK_RETRIES.labels(getattr(sender, "name", "unknown")).inc()
+
+
+def _is_prefork(worker) -> bool:
+    from celery.concurrency import get_implementation
+    from celery.concurrency.prefork import TaskPool
+
+    pool_cls = getattr(worker, "pool_cls", None)
+    if pool_cls is None:
+        return False
+    return issubclass(get_implementation(pool_cls), TaskPool)
+
+
+@worker_init.connect
+def _start_worker_exporter(sender=None, **kwargs):
+    if not CELERY_METRICS_PORT:
+        return
+    if _is_prefork(sender) and not os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        # the exporter runs in the parent, tasks in the children; without a
+        # multiprocess dir it would only ever serve the parent's (empty) metrics.
+        # SystemExit as celery swallows exceptions raised by signal handlers
+        raise SystemExit(
+            "CELERY_METRICS_PORT with the prefork pool needs PROMETHEUS_MULTIPROC_DIR"
+        )
+    if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+        os.makedirs(os.getenv("PROMETHEUS_MULTIPROC_DIR"), exist_ok=True)
+    start_http_server(int(CELERY_METRICS_PORT), registry=_registry())
+    logger.info("Serving worker metrics on port %s", CELERY_METRICS_PORT)
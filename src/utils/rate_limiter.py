@@ -0,0 +1,209 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+import logging
+from typing import Mapping, Optional
+
+from config.redis_client import AsyncRedisClient, RedisClient, registered_script
+from src.utils.metrics import RATE_LIMIT_WAIT
+
+logger = logging.getLogger()
+
+RATE_LIMITER_ENABLED = os.getenv("RATE_LIMITER_ENABLED", "true").lower() == "true"
+# longest a caller sleeps in one go; a longer wait is retried after this
+RATE_LIMIT_MAX_WAIT = float(os.getenv("RATE_LIMIT_MAX_WAIT_SECS", 30))
+RATE_LIMIT_WINDOW = 60  # limits advertised by the providers are per minute
+
+# KEYS[1]: bucket; ARGV: cost, default capacity, default rate (tokens/sec), max wait
+# Refills the bucket & reserves `cost` tokens if they are available within max wait.
+# Returns the seconds to wait before the reserved tokens can be used
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'capacity', 'rate')
+local cost = tonumber(ARGV[1])
+local capacity = tonumber(b[3]) or tonumber(ARGV[2])
+local rate = tonumber(b[4]) or tonumber(ARGV[3])
+local tokens = tonumber(b[1]) or capacity
+local ts = tonumber(b[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+local wait = 0
+if tokens < cost then
+    wait = (cost - tokens) / rate
+end
+if wait <= tonumber(ARGV[4]) then
+    tokens = tokens - cost
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'capacity', capacity, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 3600)
+return tostring(wait)
+"""
+
+# KEYS[1]: bucket; ARGV: learnt capacity, learnt rate, default capacity,
+# default rate, remaining, pause secs ('' when not known)
+# Adopts the limits the provider reported and never holds more tokens than the
+# provider says remain; a pause drains the bucket so every worker backs off
+_LEARN_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+local b = redis.call('HMGET', KEYS[1], 'tokens', 'ts', 'capacity', 'rate')
+local capacity = tonumber(ARGV[1]) or tonumber(b[3]) or tonumber(ARGV[3])
+local rate = tonumber(ARGV[2]) or tonumber(b[4]) or tonumber(ARGV[4])
+local tokens = tonumber(b[1]) or capacity
+local ts = tonumber(b[2]) or now
+tokens = math.min(capacity, tokens + math.max(now - ts, 0) * rate)
+local remaining = tonumber(ARGV[5])
+if remaining then
+    tokens = math.min(tokens, remaining)
+end
+local pause = tonumber(ARGV[6])
+if pause and pause > 0 then
+    tokens = math.min(tokens, -pause * rate)
+end
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now, 'capacity', capacity, 'rate', rate)
+redis.call('EXPIRE', KEYS[1], 3600)
+return 1
+"""
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"h": 3600, "m": 60, "s": 1, "ms": 0.001}
+
+
+def parse_duration(value: str) -> Optional[float]:
+    """Seconds in a duration like `20ms`, `1.5s` or `6m0s`; None if it isn't one"""
+    value = value.strip()
+    parts = _DURATION_PART.findall(value)
+    if not parts or "".join(n + u for n, u in parts) != value:
+        return None
+    return sum(float(n) * _DURATION_UNITS[u] for n, u in parts)
+
+
+def _header_float(headers: Mapping, *names: str) -> Optional[float]:
+    for name in names:
+        value = headers.get(name)
+        if value is None:
+            continue
+        try:
+            return float(value)
+        except ValueError:
+            duration = parse_duration(value)
+            if duration is not None:
+                return duration
+    return None
+
+
+class RateLimiter:
+    """
+    Token bucket in redis shared by every worker calling a provider with the same
+    api key (and model). Callers acquire a token before each request and hand the
+    response headers back, so the bucket learns the real limits from the
+    x-ratelimit-* headers and drains on a 429 instead of every worker retrying.
+    Starts with `rpm` requests per minute until a limit is learnt.
+    Fails open; if redis is unreachable the call goes ahead unthrottled
+    """
+
+    _prefix = "rate_limit"
+
+    def __init__(self, provider: str, api_key: str, model: str = "default", rpm=60):
+        key_hash = hashlib.sha256((api_key or "").encode()).hexdigest()[:16]
+        self.provider = provider
+        self.key = f"{self._prefix}:{provider}:{key_hash}:{model}"
+        self.capacity = rpm
+        self.rate = rpm / RATE_LIMIT_WINDOW
+
+    def _acquire_args(self, cost: int) -> list:
+        return [cost, self.capacity, self.rate, RATE_LIMIT_MAX_WAIT]
+
+    def _learn_args(self, headers: Mapping, status_code: int) -> Optional[list]:
+        limit = _header_float(
+            headers, "x-ratelimit-limit-requests", "x-ratelimit-limit"
+        )
+        remaining = _header_float(
+            headers, "x-ratelimit-remaining-requests", "x-ratelimit-remaining"
+        )
+        pause = None
+        if status_code == 429:
+            pause = _header_float(headers, "retry-after", "x-ratelimit-reset-requests")
+            if pause is None:
+                pause = 1.0
+        if limit is None and remaining is None and pause is None:
+            return None
+        return [
+            "" if limit is None else limit,
+            "" if limit is None else limit / RATE_LIMIT_WINDOW,
+            self.capacity,
+            self.rate,
+            "" if remaining is None else remaining,
+            "" if pause is None else pause,
+        ]
+
+    def acquire(self, cost: int = 1) -> None:
+        """Blocks until `cost` requests may be made"""
+        if not RATE_LIMITER_ENABLED:
+            return
+        start = time.perf_counter()
+        try:
+            script = registered_script(RedisClient.get_instance(), _ACQUIRE_SCRIPT)
+            while True:
+                wait = float(script(keys=[self.key], args=self._acquire_args(cost)))
+                if wait <= 0:
+                    break
+                time.sleep(min(wait, RATE_LIMIT_MAX_WAIT))
+                if wait <= RATE_LIMIT_MAX_WAIT:
+                    break
+        except Exception as err:
+            logger.warning("Rate limiter %s unavailable: %s", self.key, err)
+        RATE_LIMIT_WAIT.labels(self.provider).observe(time.perf_counter() - start)
+
+    async def aacquire(self, cost: int = 1) -> None:
+        """Waits until `cost` requests may be made without blocking the event loop"""
+        if not RATE_LIMITER_ENABLED:
+            return
+        start = time.perf_counter()
+        try:
+            script = registered_script(
+                AsyncRedisClient.get_instance(), _ACQUIRE_SCRIPT
+            )
+            while True:
+                wait = float(
+                    await script(keys=[self.key], args=self._acquire_args(cost))
+                )
+                if wait <= 0:
+                    break
+                await asyncio.sleep(min(wait, RATE_LIMIT_MAX_WAIT))
+                if wait <= RATE_LIMIT_MAX_WAIT:
+                    break
+        except Exception as err:
+            logger.warning("Rate limiter %s unavailable: %s", self.key, err)
+        RATE_LIMIT_WAIT.labels(self.provider).observe(time.perf_counter() - start)
+
+    def learn(self, headers: Mapping, status_code: int) -> None:
+        """Update the bucket from a response's rate limit headers"""
+        if not RATE_LIMITER_ENABLED:
+            return
+        args = self._learn_args(headers, status_code)
+        if args is None:
+            return
+        try:
+            script = registered_script(RedisClient.get_instance(), _LEARN_SCRIPT)
+            script(keys=[self.key], args=args)
+        except Exception as err:
+            logger.warning("Rate limiter %s unavailable: %s", self.key, err)
+
+    async def alearn(self, headers: Mapping, status_code: int) -> None:
+        if not RATE_LIMITER_ENABLED:
+            return
+        args = self._learn_args(headers, status_code)
+        if args is None:
+            return
+        try:
+            script = registered_script(AsyncRedisClient.get_instance(), _LEARN_SCRIPT)
+            await script(keys=[self.key], args=args)
+        except Exception as err:
+            logger.warning("Rate limiter %s unavailable: %s", self.key, err)
+
+    def pause(self, secs: float) -> None:
+        """Make every worker on this bucket hold off for `secs`"""
+        self.learn({"retry-after": str(secs)}, 429)
@@ -0,0 +1,151 @@
+import os
+import json
+import logging
+import asyncio
+from typing import AsyncIterator
+
+from celery import Task, current_app, states
+from celery.signals import before_task_publish, task_postrun
+
+from config.redis_client import RedisClient, AsyncRedisClient
+from src.utils.fair_share import DEFERRED_HEADER
+
+logger = logging.getLogger()
+
+PROGRESS_TTL = int(os.getenv("TASK_PROGRESS_TTL_SECS", 24 * 60 * 60))
+PROGRESS_STATE = "PROGRESS"
+
+
+class TaskProgress:
+    """
+    Publishes the answers of a running query task as soon as each one is ready.
+    Every answer is appended to a redis stream per task (read by the SSE endpoint)
+    and the task's state is set to PROGRESS with the no of answers done so far.
+    Tasks declared with `streams_progress=True` get their stream opened when they
+    are published and closed by a done event once their final state is stored
+    """
+
+    _redis_client = RedisClient.get_instance()
+    _prefix = "task_progress"
+
+    @classmethod
+    def stream_key(cls, task_id: str) -> str:
+        return f"{cls._prefix}:{task_id}"
+
+    @classmethod
+    def _add(cls, task_id: str, event: str, data: dict) -> None:
+        key = cls.stream_key(task_id)
+        pipe = cls._redis_client.pipeline()
+        pipe.xadd(key, {"event": event, "data": json.dumps(data)})
+        pipe.expire(key, PROGRESS_TTL)
+        pipe.execute()
+
+    @classmethod
+    def publish_answer(
+        cls, task: Task, task_id: str, index: int, answer: str, completed: int, total: int
+    ) -> None:
+        """
+        Publish the answer to query no `index`; `completed` is the no of answers
+        done so far (answers can complete out of order)
+        """
+        try:
+            cls._add(task_id, "answer", {"index": index, "answer": answer})
+            task.update_state(
+                task_id=task_id,
+                state=PROGRESS_STATE,
+                meta={"completed": completed, "total": total},
+            )
+        except Exception as err:
+            # progress is best effort; the final result still has every answer
+            logger.error("Failed to publish progress of task %s: %s", task_id, err)
+
+    @classmethod
+    def published(cls, task_id: str) -> set[int]:
+        """Indices of the answers already in the task's stream"""
+        try:
+            entries = cls._redis_client.xrange(cls.stream_key(task_id))
+        except Exception as err:
+            logger.error("Failed to read progress of task %s: %s", task_id, err)
+            return set()
+        return {
+            json.loads(fields[b"data"])["index"]
+            for _, fields in entries
+            if fields[b"event"] == b"answer"
+        }
+
+    @classmethod
+    def open(cls, task_id: str) -> None:
+        """Starts the stream of a task that was just queued"""
+        try:
+            cls._add(task_id, "queued", {})
+        except Exception as err:
+            logger.error("Failed to open the progress of task %s: %s", task_id, err)
+
+    @classmethod
+    def publish_done(cls, task_id: str, status: str) -> None:
+        """Marks the end of the stream; status is the final celery state"""
+        try:
+            cls._add(task_id, "done", {"status": status})
+        except Exception as err:
+            logger.error("Failed to publish completion of task %s: %s", task_id, err)
+
+    @classmethod
+    async def exists(cls, task_id: str) -> bool:
+        """Whether the task has a stream, i.e. it was queued in the last ttl"""
+        redis = AsyncRedisClient.get_instance()
+        return bool(await redis.exists(cls.stream_key(task_id)))
+
+    @classmethod
+    async def listen(
+        cls, task_id: str, timeout: float, heartbeat: float = 15
+    ) -> AsyncIterator[tuple[str, dict]]:
+        """
+        Yields (event, data) for the task from the start of its stream, till the
+        done event or the timeout. Yields ("heartbeat", {}) every `heartbeat`
+        seconds of silence so proxies keep the connection open
+        """
+        # xread blocks holding its connection; kept off the pool of the lookups
+        redis = AsyncRedisClient.get_blocking_instance()
+        key = cls.stream_key(task_id)
+        last_id = "0"
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+
+        while loop.time() < deadline:
+            block = min(heartbeat, max(deadline - loop.time(), 0.001))
+            entries = await redis.xread({key: last_id}, block=int(block * 1000))
+            if not entries:
+                yield "heartbeat", {}
+                continue
+            for _, messages in entries:
+                for message_id, fields in messages:
+                    last_id = message_id
+                    event = fields[b"event"].decode()
+                    if event == "queued":
+                        continue
+                    yield event, json.loads(fields[b"data"])
+                    if event == "done":
+                        return
+
+
+def _streams_progress(task_name: str) -> bool:
+    task = current_app.tasks.get(task_name)
+    return bool(getattr(task, "streams_progress", False))
+
+
+@before_task_publish.connect
+def _open_progress(sender=None, headers=None, **kwargs):
+    # so the SSE endpoint can tell a queued task from an unknown id; retries &
+    # deferrals publish the task again, its stream is already open
+    if not headers or headers.get("retries") or headers.get(DEFERRED_HEADER):
+        return
+    if _streams_progress(sender):
+        TaskProgress.open(headers["id"])
+
+
+@task_postrun.connect
+def _publish_progress_done(task_id=None, task=None, state=None, **kwargs):
+    # postrun is sent after the result is stored, so a client fetching the result
+    # on done gets it; retries & deferrals aren't final
+    if state in states.READY_STATES and getattr(task, "streams_progress", False):
+        TaskProgress.publish_done(task_id, state)
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+from typing import Optional
+
+from celery import current_app, states
+from celery.backends.base import KeyValueStoreBackend
+from celery.result import AsyncResult
+from celery.signals import task_postrun
+
+from config.redis_client import RedisClient, AsyncRedisClient
+
+logger = logging.getLogger()
+
+
+class TaskStatus:
+    """
+    Status of celery tasks read straight off the result backend, many at a time.
+    With a key value backend (redis) all the task metas are fetched in one MGET
+    """
+
+    @staticmethod
+    def _compact(
+        task_id: str, meta: dict, include_result: bool, include_traceback: bool
+    ) -> dict:
+        status = meta.get("status", states.PENDING)
+        failed = status in states.EXCEPTION_STATES
+        result = {
+            "id": task_id,
+            "status": status,
+            "error": str(meta.get("result")) if failed else None,
+        }
+        if include_result:
+            result["result"] = None if failed else meta.get("result")
+        if include_traceback:
+            result["err_trace"] = meta.get("traceback")
+        return result
+
+    @classmethod
+    def _metas(cls, task_ids: list[str]) -> list[dict]:
+        backend = current_app.backend
+        if not isinstance(backend, KeyValueStoreBackend):
+            # no bulk read; one round trip per task
+            return [
+                {
+                    "status": res.status,
+                    "result": res.result,
+                    "traceback": res.traceback,
+                }
+                for res in (AsyncResult(task_id) for task_id in task_ids)
+            ]
+
+        values = backend.mget([backend.get_key_for_task(t) for t in task_ids])
+        return [
+            (
+                backend.decode_result(value)
+                if value
+                else {"status": states.PENDING, "result": None}
+            )
+            for value in values
+        ]
+
+    @classmethod
+    def many(
+        cls,
+        task_ids: list[str],
+        include_result: bool = True,
+        include_traceback: bool = False,
+    ) -> list[dict]:
+        """
+        Compact status of every task, in the order of task_ids; the traceback of
+        failed tasks only if asked for. Unknown ids are reported as PENDING (like
+        AsyncResult does)
+        """
+        unique_ids = list(dict.fromkeys(task_ids))
+        metas = dict(zip(unique_ids, cls._metas(unique_ids)))
+        return [
+            cls._compact(task_id, metas[task_id], include_result, include_traceback)
+            for task_id in task_ids
+        ]
+
+
+class TaskCompletion:
+    """
+    Notifies waiting api requests the moment a task finishes, without polling the
+    result backend. Workers publish the final state of every task on the redis
+    channel `task_done:{task_id}` once its result is stored; each api process holds
+    a single pattern subscription and wakes up the requests waiting on that task
+    """
+
+    _prefix = "task_done"
+    _waiters: dict[str, set[asyncio.Future]] = {}
+    _listener: Optional[asyncio.Task] = None
+    _ready: Optional[asyncio.Event] = None
+
+    @classmethod
+    def publish(cls, task_id: str, state: str) -> None:
+        try:
+            RedisClient.get_instance().publish(f"{cls._prefix}:{task_id}", state)
+        except Exception as err:
+            # waiters still see the state once their timeout is up
+            logger.error("Failed to publish completion of task %s: %s", task_id, err)
+
+    @classmethod
+    async def _listen(cls, ready: asyncio.Event) -> None:
+        pubsub = AsyncRedisClient.get_blocking_instance().pubsub()
+        try:
+            await pubsub.psubscribe(f"{cls._prefix}:*")
+            ready.set()
+            async for message in pubsub.listen():
+                if message["type"] != "pmessage":
+                    continue
+                task_id = message["channel"].decode().split(":", 1)[1]
+                for waiter in cls._waiters.pop(task_id, ()):
+                    if not waiter.done():
+                        waiter.set_result(message["data"].decode())
+        except Exception as err:
+            logger.error("Task completion listener stopped: %s", err)
+        finally:
+            await pubsub.aclose()
+
+    @classmethod
+    async def _ensure_listener(cls) -> None:
+        if cls._listener is None or cls._listener.done():
+            cls._ready = asyncio.Event()
+            cls._listener = asyncio.create_task(cls._listen(cls._ready))
+        ready = asyncio.ensure_future(cls._ready.wait())
+        await asyncio.wait([ready, cls._listener], return_when=asyncio.FIRST_COMPLETED)
+        ready.cancel()  # if the listener died before subscribing
+
+    @classmethod
+    async def subscribe(cls, task_id: str) -> asyncio.Future:
+        """
+        Future resolved with the final state of the task. Subscribe before
+        checking the task's current state so a completion in between isn't missed
+        """
+        await cls._ensure_listener()
+        waiter = asyncio.get_running_loop().create_future()
+        cls._waiters.setdefault(task_id, set()).add(waiter)
+        return waiter
+
+    @classmethod
+    def unsubscribe(cls, task_id: str, waiter: asyncio.Future) -> None:
+        waiters = cls._waiters.get(task_id)
+        if waiters is not None:
+            waiters.discard(waiter)
+            if not waiters:
+                cls._waiters.pop(task_id, None)
+
+
+@task_postrun.connect
+def _publish_task_done(task_id=None, state=None, **kwargs):
+    # postrun is sent after the result is stored; retries aren't final
+    if state in states.READY_STATES:
+        TaskCompletion.publish(task_id, state)
@@ -0,0 +1,89 @@
+import os
+import hashlib
+import logging
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+import anyio
+from fastapi import UploadFile, HTTPException
+
+logger = logging.getLogger()
+
+UPLOAD_CHUNK_SIZE = 1024 * 1024  # 1MB
+MAX_UPLOAD_SIZE = int(os.getenv("MAX_UPLOAD_SIZE_BYTES", 50 * 1024 * 1024))
+
+
+def check_upload_size(file: UploadFile) -> None:
+    """Rejects the upload early if its (known) size is above MAX_UPLOAD_SIZE"""
+    if file.size is not None and file.size > MAX_UPLOAD_SIZE:
+        raise HTTPException(
+            status_code=413,
+            detail=f"File too large; max upload size is {MAX_UPLOAD_SIZE} bytes",
+        )
+
+
+def content_hasher() -> "hashlib._Hash":
+    """Hash identifying a document by its content, fed while the upload streams"""
+    return hashlib.sha256()
+
+
+def file_sha256(fpath: str) -> Optional[str]:
+    """Content hash of a file on disk; None if it can't be read"""
+    hasher = content_hasher()
+    try:
+        with open(fpath, "rb") as f:
+            while chunk := f.read(UPLOAD_CHUNK_SIZE):
+                hasher.update(chunk)
+    except OSError:
+        return None
+    return hasher.hexdigest()
+
+
+async def iter_upload(
+    file: UploadFile, hasher: Optional["hashlib._Hash"] = None
+) -> AsyncIterator[bytes]:
+    """
+    Yields the uploaded file in chunks of UPLOAD_CHUNK_SIZE without blocking the
+    event loop (UploadFile.read offloads to a thread once the file is on disk).
+    Raises 413 as soon as more than MAX_UPLOAD_SIZE bytes have been read.
+    Every chunk is fed to `hasher` if one is given
+    """
+    size = 0
+    while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_UPLOAD_SIZE:
+            raise HTTPException(
+                status_code=413,
+                detail=f"File too large; max upload size is {MAX_UPLOAD_SIZE} bytes",
+            )
+        if hasher is not None:
+            hasher.update(chunk)
+        yield chunk
+
+
+async def save_upload(
+    file: UploadFile, fpath: Path, hasher: Optional["hashlib._Hash"] = None
+) -> None:
+    """
+    Streams the uploaded file to fpath chunk by chunk with async disk writes; at
+    most one chunk is held in memory. A partially written file is removed on error
+    """
+    try:
+        async with await anyio.open_file(fpath, "wb") as buffer:
+            async for chunk in iter_upload(file, hasher):
+                await buffer.write(chunk)
+    except Exception:
+        await anyio.Path(fpath).unlink(missing_ok=True)
+        raise
+
+
+async def hash_upload(file: UploadFile) -> str:
+    """
+    Content hash of the upload, read in chunks without blocking the event loop.
+    The file is rewound afterwards so it can be streamed again
+    """
+    hasher = content_hasher()
+    async for _ in iter_upload(file, hasher):
+        pass
+    await file.seek(0)
+    return hasher.hexdigest()
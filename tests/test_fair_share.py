@@ -0,0 +1,95 @@
+import unittest
+from unittest import mock
+
+from celery import Celery, states
+from celery.app.trace import build_tracer
+
+from src.utils.fair_share import DEFERRED_HEADER, FairShareTask, TenantSlots
+
+
+class FairShareTaskTest(unittest.TestCase):
+    """
+    Runs FairShareTask subclasses the way a worker does (build_tracer, not eager),
+    so the task sees the request the worker pushed
+    """
+
+    def setUp(self):
+        self.app = Celery("test", broker="memory://", backend="cache+memory://")
+        self.seen = []
+
+        @self.app.task(
+            bind=True,
+            base=FairShareTask,
+            autoretry_for=(ValueError,),
+            retry_kwargs={"max_retries": 3},
+            name="fair_share_test",
+            shared=False,
+        )
+        def query(task, fail: bool = False, client_id=None, priority=None):
+            self.seen.append(
+                {
+                    "id": task.request.id,
+                    "retries": task.request.retries,
+                    "called_directly": task.request.called_directly,
+                }
+            )
+            if fail:
+                raise ValueError("failed")
+            return "ok"
+
+        self.task = query
+        self.acquire = mock.patch.object(TenantSlots, "acquire", return_value=True)
+        self.release = mock.patch.object(TenantSlots, "release")
+        self.acquired = self.acquire.start()
+        self.released = self.release.start()
+        self.addCleanup(mock.patch.stopall)
+
+    def trace(self, task_id: str, retries: int = 0, **kwargs):
+        tracer = build_tracer(self.task.name, self.task, app=self.app, eager=False)
+        request = {"id": task_id, "retries": retries, "delivery_info": {}}
+        return tracer(task_id, (), kwargs, request)
+
+    def test_run_sees_the_worker_request(self):
+        self.trace("task-1", retries=1, client_id="acme", priority="bulk")
+
+        self.assertEqual(
+            self.seen, [{"id": "task-1", "retries": 1, "called_directly": False}]
+        )
+        self.acquired.assert_called_once_with("acme", "bulk", "task-1")
+        self.released.assert_called_once_with("acme", "bulk", "task-1")
+        self.assertEqual(self.task.AsyncResult("task-1").state, states.SUCCESS)
+
+    def test_autoretry_still_retries(self):
+        self.trace("task-2", fail=True, client_id="acme")
+
+        self.assertEqual(self.task.AsyncResult("task-2").state, states.RETRY)
+        self.released.assert_called_once_with("acme", "interactive", "task-2")
+
+    def test_eager_run_keeps_its_request(self):
+        result = self.task.apply(kwargs={"client_id": "acme"})
+
+        self.assertEqual(result.get(), "ok")
+        self.assertEqual(self.seen[0]["id"], result.id)
+        self.acquired.assert_not_called()
+
+    def test_over_the_share_is_deferred_without_running(self):
+        self.acquired.return_value = False
+        with mock.patch.object(FairShareTask, "signature_from_request") as deferred:
+            self.trace("task-3", client_id="acme")
+
+        deferred.return_value.apply_async.assert_called_once()
+        self.assertTrue(deferred.call_args.kwargs["headers"][DEFERRED_HEADER])
+        self.assertEqual(self.seen, [])
+        self.released.assert_not_called()
+
+    def test_unidentified_client_is_not_limited(self):
+        self.acquired.return_value = False
+        self.trace("task-4")
+
+        self.assertEqual(len(self.seen), 1)
+        self.acquired.assert_not_called()
+        self.released.assert_not_called()
+
+
+if __name__ == "__main__":
+    unittest.main()